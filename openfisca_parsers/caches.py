@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+
+
+# OpenFisca -- A versatile microsimulation software
+# By: OpenFisca Team <contact@openfisca.fr>
+#
+# Copyright (C) 2011, 2012, 2013, 2014, 2015 OpenFisca Team
+# https://github.com/openfisca
+#
+# This file is part of OpenFisca.
+#
+# OpenFisca is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# OpenFisca is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Persistent on-disk caches shared by the lib2to3-based parsers"""
+
+
+import cPickle
+import errno
+import gc
+import hashlib
+import json
+import logging
+import os
+import sys
+import tempfile
+
+
+log = logging.getLogger(__name__)
+
+
+class AbstractCache(object):
+    dir = None
+    max_size = None  # Maximum total size (in bytes) of the files of the cache, None for unlimited
+    size = None  # Estimated total size of the files of the cache: measured by evict(), then updated by write()
+    suffix = None
+
+    def __init__(self, dir, max_size = None):
+        dir = os.path.abspath(dir)
+        try:
+            os.makedirs(dir)
+        except OSError as exception:
+            if exception.errno != errno.EEXIST:
+                raise
+        self.dir = dir
+        if max_size is not None:
+            self.max_size = max_size
+
+    def evict(self):
+        """When the size of the cache exceeds max_size, remove the least recently used files down to 90% of max_size.
+
+        This lists the whole directory, so write() calls it only when the estimated size exceeds max_size. The margin
+        left by the eviction avoids listing the directory again at each of the next writes.
+        """
+        if self.max_size is None:
+            return
+        entries = []
+        total_size = 0
+        for filename in os.listdir(self.dir):
+            if not filename.endswith(self.suffix):
+                continue
+            file_path = os.path.join(self.dir, filename)
+            try:
+                stat = os.stat(file_path)
+            except OSError:
+                # File has been removed by a concurrent process.
+                continue
+            entries.append((stat.st_mtime, stat.st_size, file_path))
+            total_size += stat.st_size
+        if total_size > self.max_size:
+            target_size = self.max_size * 9 // 10
+            for mtime, size, file_path in sorted(entries):
+                try:
+                    os.remove(file_path)
+                except OSError:
+                    continue
+                total_size -= size
+                if total_size <= target_size:
+                    break
+        self.size = total_size
+
+    def get_file_path(self, key):
+        return os.path.join(self.dir, key + self.suffix)
+
+    def read(self, key):
+        """Return the content of the file of the entry, or None when entry is missing."""
+        file_path = self.get_file_path(key)
+        try:
+            with open(file_path, 'rb') as cache_file:
+                content = cache_file.read()
+        except IOError as exception:
+            if exception.errno != errno.ENOENT:
+                raise
+            return None
+        # Touch the file to mark it as recently used.
+        try:
+            os.utime(file_path, None)
+        except OSError:
+            pass
+        return content
+
+    def write(self, key, content):
+        file_path = self.get_file_path(key)
+        replaced_size = 0
+        if self.max_size is not None and self.size is not None:
+            try:
+                replaced_size = os.path.getsize(file_path)
+            except OSError:
+                pass
+        # Write to a temporary file first, so that concurrent processes never read a partial entry.
+        file_descriptor, temporary_file_path = tempfile.mkstemp(dir = self.dir, suffix = '.tmp')
+        try:
+            with os.fdopen(file_descriptor, 'wb') as cache_file:
+                cache_file.write(content)
+            os.rename(temporary_file_path, file_path)
+        except:
+            if os.path.exists(temporary_file_path):
+                os.remove(temporary_file_path)
+            raise
+        if self.max_size is None:
+            return
+        if self.size is None:
+            # First write => Measure the size of the cache (and evict the files beyond max_size).
+            self.evict()
+            return
+        # Files written by concurrent processes are counted at the next eviction.
+        self.size += len(content) - replaced_size
+        if self.size > self.max_size:
+            self.evict()
+
+
+class TreesCache(AbstractCache):
+    """Cache of the lib2to3 trees of Python sources, keyed by the hash of the source and of the grammar"""
+    format_version = 1  # Increment it when the content of the cache files changes.
+    grammar_hash_by_id = None
+    max_size = 256 * 1024 * 1024
+    suffix = '.pickle'
+
+    def __init__(self, dir, max_size = None):
+        super(TreesCache, self).__init__(dir, max_size = max_size)
+        self.grammar_hash_by_id = {}
+
+    def get_grammar_hash(self, grammar):
+        grammar_hash = self.grammar_hash_by_id.get(id(grammar))
+        if grammar_hash is None:
+            grammar_hash = hashlib.sha1(repr((
+                sys.version,
+                sorted(grammar.keywords.iteritems()),
+                sorted(grammar.symbol2number.iteritems()),
+                sorted(grammar.tokens.iteritems()),
+                ))).hexdigest()
+            self.grammar_hash_by_id[id(grammar)] = grammar_hash
+        return grammar_hash
+
+    def get_key(self, grammar, source):
+        if isinstance(source, unicode):
+            source = source.encode('utf-8')
+        return hashlib.sha1('{}\n{}\n{}'.format(self.format_version, self.get_grammar_hash(grammar), source)
+            ).hexdigest()
+
+    def load(self, grammar, source):
+        """Return the tree of the given source, or None when it is not in cache."""
+        key = self.get_key(grammar, source)
+        content = self.read(key)
+        if content is None:
+            return None
+        # Unpickling a tree creates lots of objects, which needlessly triggers the cyclic garbage collector.
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            return cPickle.loads(content)
+        except Exception:
+            log.warning(u'Ignoring invalid lib2to3 tree in cache file {}'.format(self.get_file_path(key)))
+            return None
+        finally:
+            if gc_enabled:
+                gc.enable()
+
+    def dump(self, grammar, source, node):
+        try:
+            content = cPickle.dumps(node, cPickle.HIGHEST_PROTOCOL)
+        except RuntimeError:
+            # Tree is too deep to be pickled.
+            return
+        self.write(self.get_key(grammar, source), content)
+
+
+class ResultsCache(AbstractCache):
+    """Cache of the results of formulas analyses, invalidated as soon as a source file they depend on changes
+
+    The keys of the entries include the hash of the sources of the parser modules, so that results extracted by
+    another version of the parser are never reused.
+    """
+    code_hash = None  # Hash of the sources of the modules of openfisca_parsers, computed at first use
+    file_hash_by_path = None  # Hash of each dependency, read once: sources are assumed not to change while running
+    format_version = 2  # Increment it when the content of the cache files changes.
+    max_size = 64 * 1024 * 1024
+    suffix = '.json'
+
+    def __init__(self, dir, max_size = None):
+        super(ResultsCache, self).__init__(dir, max_size = max_size)
+        self.file_hash_by_path = {}
+
+    def get_code_hash(self):
+        code_hash = self.code_hash
+        if code_hash is None:
+            package_dir = os.path.dirname(os.path.abspath(__file__))
+            code_hash = hashlib.sha1()
+            for filename in sorted(os.listdir(package_dir)):
+                if not filename.endswith('.py'):
+                    continue
+                with open(os.path.join(package_dir, filename), 'rb') as source_file:
+                    code_hash.update('{}\n{}\n'.format(filename, source_file.read()))
+            self.code_hash = code_hash = code_hash.hexdigest()
+        return code_hash
+
+    def get_file_hash(self, file_path):
+        """Return the hash of the content of a file, or None when file doesn't exist."""
+        if file_path in self.file_hash_by_path:
+            return self.file_hash_by_path[file_path]
+        try:
+            with open(file_path, 'rb') as source_file:
+                file_hash = hashlib.sha1(source_file.read()).hexdigest()
+        except IOError as exception:
+            if exception.errno != errno.ENOENT:
+                raise
+            file_hash = None
+        self.file_hash_by_path[file_path] = file_hash
+        return file_hash
+
+    def get_key(self, *items):
+        """Return the key of an entry from JSON-compatible items (kind of analysis, hash of source, etc)."""
+        return hashlib.sha1(json.dumps([self.format_version, self.get_code_hash()] + list(items), sort_keys = True)
+            ).hexdigest()
+
+    def load(self, key):
+        """Return the value of the entry, or None when it is missing or when one of its source files has changed."""
+        content = self.read(key)
+        if content is None:
+            return None
+        try:
+            entry = json.loads(content)
+        except ValueError:
+            log.warning(u'Ignoring invalid result in cache file {}'.format(self.get_file_path(key)))
+            return None
+        for file_path, file_hash in entry['dependencies'].iteritems():
+            if self.get_file_hash(file_path) != file_hash:
+                return None
+        return entry['value']
+
+    def dump(self, key, value, dependencies_file_path = None):
+        self.write(key, json.dumps(dict(
+            dependencies = dict(
+                (file_path, self.get_file_hash(file_path))
+                for file_path in (dependencies_file_path or [])
+                ),
+            value = value,
+            )))
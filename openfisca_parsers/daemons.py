@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+
+
+# OpenFisca -- A versatile microsimulation software
+# By: OpenFisca Team <contact@openfisca.fr>
+#
+# Copyright (C) 2011, 2012, 2013, 2014, 2015 OpenFisca Team
+# https://github.com/openfisca
+#
+# This file is part of OpenFisca.
+#
+# OpenFisca is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# OpenFisca is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Daemon keeping warm parsers of a tax-benefit system, answering queries about its formulas over a Unix socket
+
+The protocol is a JSON object per line. A request is an object with a "query" name and its arguments, for example
+{"query": "input_variables", "names": ["irpp"]}. Its response is {"result": ...} or, when the query fails,
+{"error": failure} (see failures.get_failure). A request whose arguments don't match those of its query, or naming
+variables that are not in the tax-benefit system, fails in the "request" phase. A connection may send several requests,
+each answered in turn.
+"""
+
+
+import collections
+import errno
+import inspect
+import json
+import lib2to3.pgen2.driver
+import lib2to3.pygram
+import lib2to3.pytree
+import logging
+import os
+import socket
+import tempfile
+
+from . import dependency_graphs, failures, input_variables_extractors
+
+
+log = logging.getLogger(__name__)
+
+
+class Daemon(object):
+    """Server answering queries about the formulas of a tax-benefit system, keeping its parsers between queries
+
+    Queries are answered one at a time, because parsers are not thread-safe. The dependency graph (with the modules
+    parsed by its extractor) and the Julia parser (with its trees) are kept until a "reset" query. Neither the
+    tax-benefit system nor the Python modules of the country package are ever reloaded: the daemon must be restarted
+    when formulas, functions or variables of the country package are edited.
+    """
+    country_package = None
+    dependency_graph = None  # Built at first query that needs it, then kept until a reset
+    julia_parser = None  # Built at first "julia" query, then kept until a reset
+    queries_name = ('input_variables', 'julia', 'ping', 'reset', 'shutdown', 'source_formulas')
+    results_cache = None
+    socket_path = None
+    stopped = False  # Set by a "shutdown" query
+    tax_benefit_system = None
+    timeout = None  # Maximum duration (in seconds) of the parsing of a formula, None for no limit
+    trees_cache = None
+
+    def __init__(self, country_package, tax_benefit_system, socket_path, results_cache = None, timeout = None,
+            trees_cache = None):
+        self.country_package = country_package
+        self.results_cache = results_cache
+        self.socket_path = socket_path
+        self.tax_benefit_system = tax_benefit_system
+        self.timeout = timeout
+        self.trees_cache = trees_cache
+
+    def get_dependency_graph(self):
+        dependency_graph = self.dependency_graph
+        if dependency_graph is None:
+            self.dependency_graph = dependency_graph = dependency_graphs.DependencyGraph(self.tax_benefit_system,
+                extractor = input_variables_extractors.setup(self.tax_benefit_system, keep_modules = True,
+                    results_cache = self.results_cache, trees_cache = self.trees_cache))
+        return dependency_graph
+
+    def get_julia_parser(self):
+        julia_parser = self.julia_parser
+        if julia_parser is None:
+            from .scripts import formulas_to_julia
+
+            self.julia_parser = julia_parser = formulas_to_julia.Parser(
+                country_package = self.country_package,
+                driver = lib2to3.pgen2.driver.Driver(lib2to3.pygram.python_grammar, convert = lib2to3.pytree.convert,
+                    logger = log),
+                tax_benefit_system = self.tax_benefit_system,
+                trees_cache = self.trees_cache,
+                )
+        return julia_parser
+
+    def get_request_error(self, message):
+        """Return the failure of an invalid request, structured like failures.get_failure."""
+        return collections.OrderedDict((
+            ('phase', u'request'),
+            ('type', u'ValueError'),
+            ('message', message),
+            ('traceback', None),
+            ))
+
+    def handle_request(self, request):
+        """Return the response to a request (a dict, already decoded from JSON)."""
+        query = request.get('query') if isinstance(request, dict) else None
+        if query not in self.queries_name:
+            return dict(error = self.get_request_error(u'Unknown query: {}. Expected one of: {}'.format(query,
+                u', '.join(self.queries_name))))
+        query_method = getattr(self, 'query_' + query)
+        arguments_name, _, _, defaults = inspect.getargspec(query_method)
+        arguments_name = arguments_name[1:]  # Skip self.
+        required_arguments_name = arguments_name[:len(arguments_name) - len(defaults or ())]
+        unexpected_arguments_name = sorted(
+            name
+            for name in request
+            if name != 'query' and name not in arguments_name
+            )
+        if unexpected_arguments_name:
+            return dict(error = self.get_request_error(u'Unexpected arguments for query {}: {}. Expected: {}'.format(
+                query, u', '.join(unexpected_arguments_name), u', '.join(arguments_name) or u'none')))
+        missing_arguments_name = [
+            name
+            for name in required_arguments_name
+            if name not in request
+            ]
+        if missing_arguments_name:
+            return dict(error = self.get_request_error(u'Missing arguments for query {}: {}'.format(query,
+                u', '.join(missing_arguments_name))))
+        arguments = dict(
+            (str(name), value)
+            for name, value in request.iteritems()
+            if name != 'query'
+            )
+        names = arguments.get('names')
+        if names is not None:
+            # Reject unknown variables for every query, instead of answering as if they were input variables.
+            if not isinstance(names, list):
+                return dict(error = self.get_request_error(u'Expected a list of variable names, got: {}'.format(
+                    json.dumps(names))))
+            unknown_names = [
+                name
+                for name in names
+                if not isinstance(name, basestring) or name not in self.tax_benefit_system.column_by_name
+                ]
+            if unknown_names:
+                return dict(error = self.get_request_error(u'Unknown variables: {}'.format(
+                    u', '.join(json.dumps(name) for name in unknown_names))))
+        try:
+            result = query_method(**arguments)
+        except Exception:
+            return dict(error = failures.get_failure(query))
+        return dict(result = result)
+
+    def query_input_variables(self, names):
+        """Return the input variables & parameters of the formulas of the given variables (None for input variables)."""
+        dependency_graph = self.get_dependency_graph()
+        result = collections.OrderedDict()
+        for name in names:
+            input_variables_name = failures.call_with_timeout(self.timeout, dependency_graph.get_input_variables_name,
+                name)
+            result[name] = collections.OrderedDict((
+                ('input_variables', input_variables_name),
+                ('parameters', dependency_graph.get_parameters_name(name)),
+                ))
+        return result
+
+    def query_julia(self, names):
+        """Return the Julia sources of the given formulas, and of the non-formula functions they call."""
+        from openfisca_core import formulas
+
+        from .scripts import formulas_to_julia
+
+        parser = self.get_julia_parser()
+        # Keep the trees & the legislation index of the parser, but wrap the modules again, to register the non-formula
+        # functions called by the given formulas, and only them.
+        parser.python_module_by_name.clear()
+        parser.non_formula_function_by_name.clear()
+        julia_source_by_name = collections.OrderedDict()
+        for name in names:
+            column = self.tax_benefit_system.column_by_name[name]
+            parser.column = column
+            formula_class = column.formula_class
+            if issubclass(formula_class, formulas.SimpleFormula) and formula_class.function is None:
+                julia_source_by_name[name] = parser.source_julia_column_without_function()
+            elif issubclass(formula_class, formulas.AbstractEntityToEntity):
+                julia_source_by_name[name] = formulas_to_julia.generate_entity_to_entity_julia_source(column,
+                    parser = parser)
+            else:
+                formula_class_wrapper = failures.call_with_timeout(self.timeout, parser.FormulaClassFileInput.parse,
+                    formula_class, parser = parser)
+                julia_source_by_name[name] = failures.call_with_timeout(self.timeout,
+                    lambda: formula_class_wrapper.juliaize().source_julia(depth = 0))
+        return collections.OrderedDict((
+            ('formulas', julia_source_by_name),
+            ('functions', collections.OrderedDict(
+                (name, function_wrapper.juliaize().source_julia(depth = 0))
+                for name, function_wrapper in parser.non_formula_function_by_name.iteritems()
+                )),
+            ))
+
+    def query_ping(self):
+        return u'pong'
+
+    def query_reset(self):
+        """Forget the parsed modules & the extracted variables, to free their memory.
+
+        This doesn't pick up edited formulas: the sources of the country package, like the hashes of its files in the
+        results cache, are read once per process (see Daemon).
+        """
+        self.dependency_graph = None
+        self.julia_parser = None
+
+    def query_shutdown(self):
+        self.stopped = True
+
+    def query_source_formulas(self, names, dependents = False):
+        """Return the formulas needed to compute the given variables, and optionally the formulas that use them."""
+        dependency_graph = self.get_dependency_graph()
+        return collections.OrderedDict((
+            ('source_formulas', sorted(failures.call_with_timeout(self.timeout, dependency_graph.get_source_formulas,
+                names))),
+            ('dependents', sorted(dependency_graph.get_dependents(names)) if dependents else None),
+            ))
+
+    def serve_connection(self, connection):
+        connection_file = connection.makefile('rwb')
+        try:
+            for line in iter(connection_file.readline, ''):
+                if not line.strip():
+                    continue
+                try:
+                    request = json.loads(line)
+                except ValueError:
+                    response = dict(error = failures.get_failure('request'))
+                else:
+                    response = self.handle_request(request)
+                connection_file.write(json.dumps(response) + '\n')
+                connection_file.flush()
+                if self.stopped:
+                    break
+        finally:
+            connection_file.close()
+
+    def serve_forever(self):
+        """Answer the requests of the clients, until a "shutdown" query."""
+        try:
+            os.remove(self.socket_path)
+        except OSError as exception:
+            if exception.errno != errno.ENOENT:
+                raise
+        server_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            server_socket.bind(self.socket_path)
+            server_socket.listen(5)
+            log.info(u'Listening on {}'.format(self.socket_path))
+            while not self.stopped:
+                connection, address = server_socket.accept()
+                try:
+                    self.serve_connection(connection)
+                except socket.error:
+                    log.exception(u'Connection to client lost')
+                finally:
+                    connection.close()
+        finally:
+            server_socket.close()
+            os.remove(self.socket_path)
+
+
+def get_default_socket_path(country_package_name):
+    return os.path.join(tempfile.gettempdir(), u'openfisca_parsers-{}.sock'.format(country_package_name))
+
+
+def send_request(socket_path, request):
+    """Send a request to the daemon listening on the given socket and return its response."""
+    client_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client_socket.connect(socket_path)
+        connection_file = client_socket.makefile('rwb')
+        try:
+            connection_file.write(json.dumps(request) + '\n')
+            connection_file.flush()
+            line = connection_file.readline()
+        finally:
+            connection_file.close()
+    finally:
+        client_socket.close()
+    assert line, "Daemon closed the connection without answering"
+    return json.loads(line, object_pairs_hook = collections.OrderedDict)
@@ -0,0 +1,510 @@
+# -*- coding: utf-8 -*-
+
+
+# OpenFisca -- A versatile microsimulation software
+# By: OpenFisca Team <contact@openfisca.fr>
+#
+# Copyright (C) 2011, 2012, 2013, 2014, 2015 OpenFisca Team
+# https://github.com/openfisca
+#
+# This file is part of OpenFisca.
+#
+# OpenFisca is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# OpenFisca is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Graph of the dependencies between the variables of a tax-benefit system"""
+
+
+import collections
+import logging
+import struct
+import zipfile
+
+from . import input_variables_extractors, parameter_tries
+
+
+log = logging.getLogger(__name__)
+
+
+def decode_names(names_data, names_offset):
+    data = names_data.tobytes()
+    return [
+        data[start:stop].decode('utf-8')
+        for start, stop in zip(names_offset[:-1].tolist(), names_offset[1:].tolist())
+        ]
+
+
+def encode_names(names):
+    """Return the UTF-8 encoded names, concatenated in an array of bytes, and the array of their offsets."""
+    import numpy as np
+
+    names_data = [
+        name.encode('utf-8')
+        for name in names
+        ]
+    names_offset = np.zeros(len(names_data) + 1, dtype = np.int32)
+    names_offset[1:] = np.cumsum([len(name_data) for name_data in names_data])
+    return np.array(bytearray(b''.join(names_data)), dtype = np.uint8), names_offset
+
+
+def encode_neighbours(neighbours_name_by_name, names, id_by_name):
+    """Return the ids of the neighbours of every name, concatenated in an array, and the array of their offsets."""
+    import numpy as np
+
+    neighbours_id = []
+    neighbours_offset = np.zeros(len(names) + 1, dtype = np.int32)
+    for index, name in enumerate(names):
+        neighbours_id.extend(sorted(
+            id_by_name[neighbour_name]
+            for neighbour_name in neighbours_name_by_name.get(name) or []
+            ))
+        neighbours_offset[index + 1] = len(neighbours_id)
+    return np.array(neighbours_id, dtype = np.int32), neighbours_offset
+
+
+def get_levels(input_variables_name_by_name):
+    """Group variables in levels, so that the formulas of each level use only variables of the previous levels.
+
+    Variables that depend on each other (through a cycle of formulas) can't be ordered. They are put in the same level
+    and returned as a cycle. A formula that uses itself (for another period, etc) is not a cycle.
+
+    Return the levels and the cycles, as lists of sorted lists of names.
+    """
+    components = get_strongly_connected_components(input_variables_name_by_name)
+    component_index_by_name = dict(
+        (name, component_index)
+        for component_index, component in enumerate(components)
+        for name in component
+        )
+    # Components are sorted so that the dependencies of a component come before it.
+    component_level_by_index = []
+    cycles = []
+    levels = []
+    for component_index, component in enumerate(components):
+        component_level = 0
+        for name in component:
+            for input_variable_name in input_variables_name_by_name.get(name) or []:
+                input_variable_component_index = component_index_by_name[input_variable_name]
+                if input_variable_component_index != component_index:
+                    component_level = max(component_level,
+                        component_level_by_index[input_variable_component_index] + 1)
+        component_level_by_index.append(component_level)
+        if len(component) > 1:
+            cycles.append(component)
+        while len(levels) <= component_level:
+            levels.append([])
+        levels[component_level].extend(component)
+    for level in levels:
+        level.sort()
+    cycles.sort()
+    return levels, cycles
+
+
+def get_strongly_connected_components(neighbours_name_by_name):
+    """Return the strongly connected components of a graph, using Tarjan's algorithm.
+
+    Each component is a sorted list of names, and every component comes after the components of the neighbours of its
+    names.
+    """
+    components = []
+    index_by_name = {}
+    low_link_by_name = {}
+    stack = []
+    stacked_names = set()
+    for root_name in sorted(neighbours_name_by_name):
+        if root_name in index_by_name:
+            continue
+        index_by_name[root_name] = low_link_by_name[root_name] = len(index_by_name)
+        stack.append(root_name)
+        stacked_names.add(root_name)
+        # Depth-first search without recursion, to support long chains of dependencies.
+        remaining = [(root_name, iter(neighbours_name_by_name.get(root_name) or []))]
+        while remaining:
+            name, neighbours_name = remaining[-1]
+            for neighbour_name in neighbours_name:
+                if neighbour_name not in index_by_name:
+                    index_by_name[neighbour_name] = low_link_by_name[neighbour_name] = len(index_by_name)
+                    stack.append(neighbour_name)
+                    stacked_names.add(neighbour_name)
+                    remaining.append((neighbour_name, iter(neighbours_name_by_name.get(neighbour_name) or [])))
+                    break
+                if neighbour_name in stacked_names:
+                    low_link_by_name[name] = min(low_link_by_name[name], index_by_name[neighbour_name])
+            else:
+                remaining.pop()
+                if remaining:
+                    parent_name = remaining[-1][0]
+                    low_link_by_name[parent_name] = min(low_link_by_name[parent_name], low_link_by_name[name])
+                if low_link_by_name[name] == index_by_name[name]:
+                    component = []
+                    while True:
+                        component_name = stack.pop()
+                        stacked_names.remove(component_name)
+                        component.append(component_name)
+                        if component_name == name:
+                            break
+                    components.append(sorted(component))
+    return components
+
+
+def load_npz(file_path, mmap_mode = None):
+    """Return the arrays of a .npz file, by name.
+
+    Unlike numpy.load, uncompressed arrays are memory-mapped when mmap_mode is given (for example 'r').
+    """
+    import numpy as np
+
+    array_by_name = {}
+    with open(file_path, 'rb') as npz_file, zipfile.ZipFile(npz_file) as zip_file:
+        for info in zip_file.infolist():
+            assert info.filename.endswith('.npy'), info.filename
+            name = info.filename[:-len('.npy')]
+            if mmap_mode is None or info.compress_type != zipfile.ZIP_STORED:
+                array_by_name[name] = np.lib.format.read_array(zip_file.open(info))
+                continue
+            # Skip the local header of the zip entry, whose extra field may differ from the central directory one.
+            npz_file.seek(info.header_offset)
+            local_header = npz_file.read(30)
+            filename_length, extra_length = struct.unpack('<HH', local_header[26:30])
+            npz_file.seek(info.header_offset + 30 + filename_length + extra_length)
+            version = np.lib.format.read_magic(npz_file)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(npz_file)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(npz_file)
+            if dtype.hasobject or not shape or 0 in shape:
+                # Scalars & empty arrays can't be memory-mapped.
+                npz_file.seek(info.header_offset + 30 + filename_length + extra_length)
+                array_by_name[name] = np.lib.format.read_array(npz_file)
+                continue
+            array_by_name[name] = np.memmap(file_path, dtype = dtype, mode = mmap_mode, offset = npz_file.tell(),
+                order = 'F' if fortran_order else 'C', shape = shape)
+    return array_by_name
+
+
+class CompactDependencyGraph(object):
+    """Dependency graph stored in flat NumPy arrays, cheap to hold in memory, to save in a .npz file and to load
+
+    Variables & parameters are identified by the indexes of their names in sorted lists. The ids of the input
+    variables of variable i are input_variables_id[input_variables_offset[i]:input_variables_offset[i + 1]] (compressed
+    sparse row format). Parameters ids are stored the same way. Names are stored UTF-8 encoded, in arrays of bytes.
+    """
+    format_version = 1  # Increment it when the arrays of the graph change.
+    has_formula = None  # Boolean array: False for input variables & for unknown variables
+    input_variables_id = None  # Ids of the input variables of all variables, concatenated
+    input_variables_offset = None  # Offsets of the input variables of each variable in input_variables_id
+    parameter_id_by_name = None  # Computed at first use
+    parameters_id = None  # Ids of the parameters of all variables, concatenated
+    parameters_name = None  # Decoded at first use
+    parameters_name_data = None  # UTF-8 encoded names of the parameters, concatenated
+    parameters_name_offset = None
+    parameters_offset = None  # Offsets of the parameters of each variable in parameters_id
+    variable_id_by_name = None  # Computed at first use
+    variables_name = None  # Decoded at first use
+    variables_name_data = None  # UTF-8 encoded names of the variables, concatenated
+    variables_name_offset = None
+
+    def __init__(self, has_formula = None, input_variables_id = None, input_variables_offset = None,
+            parameters_id = None, parameters_name_data = None, parameters_name_offset = None, parameters_offset = None,
+            variables_name_data = None, variables_name_offset = None):
+        variables_count = len(variables_name_offset) - 1
+        assert len(has_formula) == variables_count
+        self.has_formula = has_formula
+        assert len(input_variables_offset) == variables_count + 1
+        assert input_variables_offset[-1] == len(input_variables_id)
+        self.input_variables_id = input_variables_id
+        self.input_variables_offset = input_variables_offset
+        assert len(parameters_offset) == variables_count + 1
+        assert parameters_offset[-1] == len(parameters_id)
+        self.parameters_id = parameters_id
+        self.parameters_offset = parameters_offset
+        assert parameters_name_offset[-1] == len(parameters_name_data)
+        self.parameters_name_data = parameters_name_data
+        self.parameters_name_offset = parameters_name_offset
+        assert variables_name_offset[-1] == len(variables_name_data)
+        self.variables_name_data = variables_name_data
+        self.variables_name_offset = variables_name_offset
+
+    @classmethod
+    def from_dependency_graph(cls, dependency_graph):
+        dependency_graph.complete_graph()
+        return cls.from_dicts(dependency_graph.input_variables_name_by_name,
+            dependency_graph.parameters_name_by_name)
+
+    @classmethod
+    def from_dicts(cls, input_variables_name_by_name, parameters_name_by_name):
+        """Create a compact graph from the names of the input variables & parameters of each variable.
+
+        The names of the input variables & parameters are None for input variables.
+        """
+        import numpy as np
+
+        variables_name = set(input_variables_name_by_name)
+        for input_variables_name in input_variables_name_by_name.itervalues():
+            variables_name.update(input_variables_name or [])
+        variables_name = sorted(variables_name)
+        variable_id_by_name = dict(
+            (name, variable_id)
+            for variable_id, name in enumerate(variables_name)
+            )
+        parameters_name = set()
+        for variable_parameters_name in parameters_name_by_name.itervalues():
+            parameters_name.update(variable_parameters_name or [])
+        parameters_name = sorted(parameters_name)
+        parameter_id_by_name = dict(
+            (name, parameter_id)
+            for parameter_id, name in enumerate(parameters_name)
+            )
+
+        input_variables_id, input_variables_offset = encode_neighbours(input_variables_name_by_name, variables_name,
+            variable_id_by_name)
+        parameters_id, parameters_offset = encode_neighbours(parameters_name_by_name, variables_name,
+            parameter_id_by_name)
+        parameters_name_data, parameters_name_offset = encode_names(parameters_name)
+        variables_name_data, variables_name_offset = encode_names(variables_name)
+        self = cls(
+            has_formula = np.array(
+                [
+                    input_variables_name_by_name.get(name) is not None
+                    for name in variables_name
+                    ],
+                dtype = np.bool,
+                ),
+            input_variables_id = input_variables_id,
+            input_variables_offset = input_variables_offset,
+            parameters_id = parameters_id,
+            parameters_name_data = parameters_name_data,
+            parameters_name_offset = parameters_name_offset,
+            parameters_offset = parameters_offset,
+            variables_name_data = variables_name_data,
+            variables_name_offset = variables_name_offset,
+            )
+        self.parameter_id_by_name = parameter_id_by_name
+        self.parameters_name = parameters_name
+        self.variable_id_by_name = variable_id_by_name
+        self.variables_name = variables_name
+        return self
+
+    def get_input_variables_id(self, variable_id):
+        """Return the ids of the input variables of a variable, or None for an input variable."""
+        if not self.has_formula[variable_id]:
+            return None
+        return self.input_variables_id[
+            self.input_variables_offset[variable_id]:self.input_variables_offset[variable_id + 1]]
+
+    def get_evaluation_order(self):
+        """Return the levels of the variables (see get_levels()) and the dependency cycles."""
+        return get_levels(dict(
+            (name, self.get_input_variables_name(name))
+            for name in self.get_variables_name()
+            ))
+
+    def get_input_variables_name(self, name):
+        """Return the names of the input variables of a variable, or None for an input variable."""
+        input_variables_id = self.get_input_variables_id(self.get_variable_id(name))
+        if input_variables_id is None:
+            return None
+        variables_name = self.get_variables_name()
+        return [
+            variables_name[input_variable_id]
+            for input_variable_id in input_variables_id.tolist()
+            ]
+
+    def get_parameter_id(self, name):
+        if self.parameter_id_by_name is None:
+            self.parameter_id_by_name = dict(
+                (parameter_name, parameter_id)
+                for parameter_id, parameter_name in enumerate(self.get_parameters_name())
+                )
+        return self.parameter_id_by_name[name]
+
+    def get_parameters_id(self, variable_id):
+        """Return the ids of the parameters of a variable, or None for an input variable."""
+        if not self.has_formula[variable_id]:
+            return None
+        return self.parameters_id[self.parameters_offset[variable_id]:self.parameters_offset[variable_id + 1]]
+
+    def get_parameters_name(self, name = None):
+        """Return the names of the parameters of a variable (None for an input variable), or of all the parameters."""
+        if self.parameters_name is None:
+            self.parameters_name = decode_names(self.parameters_name_data, self.parameters_name_offset)
+        if name is None:
+            return self.parameters_name
+        parameters_id = self.get_parameters_id(self.get_variable_id(name))
+        if parameters_id is None:
+            return None
+        return [
+            self.parameters_name[parameter_id]
+            for parameter_id in parameters_id.tolist()
+            ]
+
+    def get_variable_id(self, name):
+        if self.variable_id_by_name is None:
+            self.variable_id_by_name = dict(
+                (variable_name, variable_id)
+                for variable_id, variable_name in enumerate(self.get_variables_name())
+                )
+        return self.variable_id_by_name[name]
+
+    def get_variables_name(self):
+        if self.variables_name is None:
+            self.variables_name = decode_names(self.variables_name_data, self.variables_name_offset)
+        return self.variables_name
+
+    @classmethod
+    def load(cls, file_path, mmap_mode = 'r'):
+        """Load a graph saved by save(). Its arrays are memory-mapped, unless mmap_mode is None."""
+        array_by_name = load_npz(file_path, mmap_mode = mmap_mode)
+        format_version = int(array_by_name.pop('format_version'))
+        assert format_version == cls.format_version, "Unexpected format version {} of dependency graph {}".format(
+            format_version, file_path)
+        return cls(**array_by_name)
+
+    def save(self, file_path):
+        """Save the graph in an uncompressed .npz file, so that its arrays can be memory-mapped by load()."""
+        import numpy as np
+
+        with open(file_path, 'wb') as npz_file:
+            np.savez(
+                npz_file,
+                format_version = np.array(self.format_version),
+                has_formula = self.has_formula,
+                input_variables_id = self.input_variables_id,
+                input_variables_offset = self.input_variables_offset,
+                parameters_id = self.parameters_id,
+                parameters_name_data = self.parameters_name_data,
+                parameters_name_offset = self.parameters_name_offset,
+                parameters_offset = self.parameters_offset,
+                variables_name_data = self.variables_name_data,
+                variables_name_offset = self.variables_name_offset,
+                )
+
+
+class DependencyGraph(object):
+    """Variables of a tax-benefit system, linked to the input variables & parameters used by their formulas
+
+    The input variables of a formula are extracted at the first query that needs them, then kept for the next queries.
+    """
+    complete = False  # True when the input variables of every column have been extracted
+    extractor = None  # An input_variables_extractors.Parser
+    input_variables_name_by_name = None  # Names of the variables used by each formula (None for input variables)
+    parameters_name_by_name = None  # Names of the parameters used by each formula (None for input variables)
+    tax_benefit_system = None
+    users_name_by_name = None  # Names of the formulas using each variable, computed when graph is complete
+
+    def __init__(self, tax_benefit_system, extractor = None):
+        self.tax_benefit_system = tax_benefit_system
+        if extractor is None:
+            extractor = input_variables_extractors.setup(tax_benefit_system, keep_modules = True)
+        self.extractor = extractor
+        self.input_variables_name_by_name = {}
+        self.parameters_name_by_name = {}
+
+    def complete_graph(self):
+        """Extract the input variables of every column that has not been queried yet."""
+        if self.complete:
+            return
+        names = [
+            name
+            for name in self.tax_benefit_system.column_by_name.iterkeys()
+            if name not in self.input_variables_name_by_name
+            ]
+        names_by_name = input_variables_extractors.extract_all(self.tax_benefit_system, names = names,
+            extractor = self.extractor)
+        for name, (input_variables_name, parameters_name) in names_by_name.iteritems():
+            self.input_variables_name_by_name[name] = input_variables_name
+            self.parameters_name_by_name[name] = parameters_name
+        self.complete = True
+
+    def get_dependencies(self, names, recursive = True):
+        """Return the names of the variables used by the formulas of the given variables.
+
+        When recursive is True, the variables used by these variables are also returned, etc. The given variables are
+        not included, unless they depend on themselves.
+        """
+        return self.walk(names, self.get_input_variables_name, recursive = recursive)
+
+    def get_dependents(self, names, recursive = True):
+        """Return the names of the formulas that use the given variables (directly or not, depending on recursive)."""
+        self.complete_graph()
+        if self.users_name_by_name is None:
+            users_name_by_name = collections.defaultdict(list)
+            for name, input_variables_name in sorted(self.input_variables_name_by_name.iteritems()):
+                for input_variable_name in input_variables_name or []:
+                    users_name_by_name[input_variable_name].append(name)
+            self.users_name_by_name = dict(users_name_by_name)
+        return self.walk(names, lambda name: self.users_name_by_name.get(name), recursive = recursive)
+
+    def get_evaluation_order(self):
+        """Return the levels of the variables (see get_levels()) and the dependency cycles."""
+        self.complete_graph()
+        return get_levels(self.input_variables_name_by_name)
+
+    def get_input_variables_name(self, name):
+        """Return the names of the variables used by the formula of a variable, or None for an input variable.
+
+        Names that are not variables of the tax-benefit system (misspelled calculations, etc) have no dependency.
+        """
+        if name in self.input_variables_name_by_name:
+            return self.input_variables_name_by_name[name]
+        if name in self.tax_benefit_system.column_by_name:
+            input_variables_name, parameters_name = input_variables_extractors.extract_all(self.tax_benefit_system,
+                names = [name], extractor = self.extractor)[name]
+        else:
+            log.warning(u'Unknown variable {}'.format(name))
+            input_variables_name, parameters_name = None, None
+        self.input_variables_name_by_name[name] = input_variables_name
+        self.parameters_name_by_name[name] = parameters_name
+        return input_variables_name
+
+    def get_parameters_name(self, name):
+        """Return the names of the parameters used by the formula of a variable, or None for an input variable."""
+        self.get_input_variables_name(name)
+        return self.parameters_name_by_name[name]
+
+    def get_parameters_trie(self, names = None):
+        """Return the trie of the parameters used by the formulas of the given variables (default: of every variable).
+
+        For example, graph.get_parameters_trie().iter_names(['prelevements_sociaux']) iterates over the names of the
+        parameters of node prelevements_sociaux that are used by formulas.
+        """
+        if names is None:
+            self.complete_graph()
+            names = self.tax_benefit_system.column_by_name.iterkeys()
+        parameters_trie = parameter_tries.ParameterTrie()
+        for name in names:
+            for parameter_name in self.get_parameters_name(name) or []:
+                parameters_trie.add(parameter_name.split(u'.'))
+        return parameters_trie
+
+    def get_source_formulas(self, names):
+        """Return the names of the formulas needed to compute the given variables, including their own formulas."""
+        names = set(names)
+        return set(
+            name
+            for name in names.union(self.get_dependencies(names))
+            if self.get_input_variables_name(name) is not None
+            )
+
+    def walk(self, names, get_neighbours_name, recursive = True):
+        found_names = set()
+        remaining_names = list(names)
+        while remaining_names:
+            name = remaining_names.pop()
+            for neighbour_name in get_neighbours_name(name) or []:
+                if neighbour_name not in found_names:
+                    found_names.add(neighbour_name)
+                    if recursive:
+                        remaining_names.append(neighbour_name)
+        return found_names
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+
+# OpenFisca -- A versatile microsimulation software
+# By: OpenFisca Team <contact@openfisca.fr>
+#
+# Copyright (C) 2011, 2012, 2013, 2014, 2015 OpenFisca Team
+# https://github.com/openfisca
+#
+# This file is part of OpenFisca.
+#
+# OpenFisca is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# OpenFisca is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Structured failures of the conversion of columns, to continue batch runs after the formulas that fail"""
+
+
+import collections
+import signal
+import sys
+import traceback
+
+
+class Summary(object):
+    """Failures of a batch run (of columns, and of the other functions they call), summarized at the end of the run"""
+    columns_count = 0  # Number of columns processed, failing or not
+    failure_by_name = None
+
+    def __init__(self):
+        self.failure_by_name = collections.OrderedDict()
+
+    def add_column(self, column_name, failure = None):
+        self.columns_count += 1
+        if failure is not None:
+            self.failure_by_name[column_name] = failure
+
+    def add_failure(self, name, failure):
+        """Add the failure of a column already added, or of a function that is not a column."""
+        self.failure_by_name[name] = failure
+
+    def iter_report_lines(self):
+        failure_by_name = self.failure_by_name
+        yield u'Failures: {} (for {} columns)'.format(len(failure_by_name), self.columns_count)
+        if not failure_by_name:
+            return
+        yield u'Failures by type:'
+        for (phase, type), count in sorted(collections.Counter(
+                (failure['phase'], failure['type'])
+                for failure in failure_by_name.itervalues()
+                ).iteritems(), key = lambda item: (-item[1], item[0])):
+            yield u'  {:6d}  {} ({})'.format(count, type, phase)
+        yield u'Failing columns & functions:'
+        for name, failure in failure_by_name.iteritems():
+            message_lines = failure['message'].strip().splitlines()
+            yield u'  {} ({}): {}{}'.format(name, failure['phase'], failure['type'],
+                u': {}'.format(message_lines[0][:120]) if message_lines else u'')
+
+
+class Timeout(Exception):
+    pass
+
+
+def call_with_timeout(timeout, function, *args, **kwargs):
+    """Call a function, raising Timeout when it lasts more than the given number of seconds (None for no limit).
+
+    The timeout uses SIGALRM, so it must be called from the main thread of a process (worker processes included).
+    """
+    if timeout is None:
+        return function(*args, **kwargs)
+
+    def raise_timeout(signal_number, frame):
+        raise Timeout('Timeout after {} seconds'.format(timeout))
+
+    previous_handler = signal.signal(signal.SIGALRM, raise_timeout)
+    signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        return function(*args, **kwargs)
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous_handler)
+
+
+def get_failure(phase):
+    """Return a JSON-compatible description of the exception being handled, that occurred in the given phase."""
+    exception_type, exception, exception_traceback = sys.exc_info()
+    try:
+        message = unicode(exception)
+    except UnicodeError:
+        message = str(exception).decode('utf-8', 'replace')
+    return collections.OrderedDict((
+        ('phase', phase),
+        ('type', exception_type.__name__),
+        ('message', message),
+        ('traceback', traceback.format_exc().decode('utf-8', 'replace')),
+        ))
@@ -31,14 +31,19 @@ from __future__ import division
 import collections
 import inspect
 import itertools
+import lib2to3.pgen2.parse
 import lib2to3.pgen2.token
+import lib2to3.pgen2.tokenize
 import lib2to3.pygram
 import lib2to3.pytree
 import os
 import textwrap
+import types
 
-import numpy as np
-from openfisca_core import conv
+# numpy & openfisca_core are slow to import: they are imported by the functions that need them, so that scripts
+# that don't parse formulas start quickly.
+
+from . import legislation_indexes
 
 
 symbols = lib2to3.pygram.python_symbols  # Note: symbols is a module.
@@ -54,31 +59,117 @@ lib2to3.pytree.Leaf.__unicode__ = lambda self: self.prefix.decode('utf-8') + (se
     )
 
 
+# Source Spans
+
+
+def get_node_position(node):
+    """Return the type of a lib2to3 node and the positions (line, column) of its first & last characters."""
+    first_leaf = last_leaf = node
+    while first_leaf.children:
+        first_leaf = first_leaf.children[0]
+    while last_leaf.children:
+        last_leaf = last_leaf.children[-1]
+    return node.type, (first_leaf.lineno, first_leaf.column), (last_leaf.lineno, last_leaf.column + len(
+        last_leaf.value))
+
+
+class SourceSpan(object):
+    """Position of a lib2to3 node in its source, standing for the node once its tree has been released
+
+    A span is printed like its node, by parsing its source again. See Parser.low_memory.
+    """
+    __slots__ = ('parser', 'position', 'source')
+
+    def __init__(self, node, source, parser):
+        self.parser = parser
+        self.position = get_node_position(node)
+        self.source = source
+
+    def __repr__(self):
+        return repr(self.get_node())
+
+    def __str__(self):
+        return str(self.get_node())
+
+    def __unicode__(self):
+        return unicode(self.get_node())
+
+    def get_node(self):
+        position = self.position
+        node_type = position[0]
+        for node in self.parser.parse_source(self.source).pre_order():
+            if node.type == node_type and get_node_position(node) == position:
+                return node
+        assert False, "Node not found at position {} of source:\n{}".format(position, self.source)
+
+
 # Abstract Wrappers
 
 
+class WrapperType(type):
+    """Metaclass of the wrappers, storing the attributes declared in their class bodies in __slots__
+
+    Wrappers declare their attributes as class attributes, with their default values (usually None). To save the
+    memory of a __dict__ per wrapper, these attributes become slots & their default values are moved to
+    default_by_name, where AbstractWrapper.__getattr__ finds them while the attributes are not set. Subclasses (and
+    their mixins, which must declare empty __slots__) keep declaring their attributes the same way.
+    """
+    def __new__(metaclass, name, bases, attributes):
+        default_by_name = {}
+        for base in reversed(bases):
+            default_by_name.update(getattr(base, 'default_by_name', None) or {})
+        if '__slots__' not in attributes:
+            slots = []
+            for attribute_name, value in attributes.items():
+                if attribute_name.startswith('__') or isinstance(value, (classmethod, property, staticmethod, type,
+                        types.FunctionType)):
+                    continue
+                del attributes[attribute_name]
+                if attribute_name not in default_by_name:
+                    # Attributes redeclared by a subclass keep the slot of their base class.
+                    slots.append(attribute_name)
+                default_by_name[attribute_name] = value
+            attributes['__slots__'] = tuple(sorted(slots))
+        attributes['default_by_name'] = default_by_name
+        return super(WrapperType, metaclass).__new__(metaclass, name, bases, attributes)
+
+
 class AbstractWrapper(object):
+    __metaclass__ = WrapperType
     container = None  # The wrapper directly containing this wrapper
+    guess_generation = None  # The generation of the parser when guessed_by_expected was filled
+    guessed_by_expected = None  # Memo of the results of guess(), by expected wrapper class (depth while in progress)
     hint = None  # A wrapper that is the hinted type of this wrapper
     node = None  # The lib2to3 node
     parser = None
 
     def __init__(self, container = None, hint = None, node = None, parser = None):
-        if container is not None:
-            assert isinstance(container, AbstractWrapper), "Invalid container {} for node:\n{}\n\n{}".format(container,
+        if parser is None or parser.strict:
+            # Structural validation: these checks catch bugs of the parser, not errors in the parsed formulas.
+            assert container is None or isinstance(container, AbstractWrapper), \
+                "Invalid container {} for node:\n{}\n\n{}".format(container, repr(node), unicode(node).encode('utf-8'))
+            assert hint is None or isinstance(hint, AbstractWrapper), "Invalid hint {} for node:\n{}\n\n{}".format(
+                hint, repr(node), unicode(node).encode('utf-8'))
+            assert node is None or isinstance(node, lib2to3.pytree.Base), "Invalid node:\n{}\n\n{}".format(
                 repr(node), unicode(node).encode('utf-8'))
-            self.container = container
-        if hint is not None:
-            assert isinstance(hint, AbstractWrapper), "Invalid hint {} for node:\n{}\n\n{}".format(hint, repr(node),
-                unicode(node).encode('utf-8'))
-            self.hint = hint
-        if node is not None:
-            assert isinstance(node, lib2to3.pytree.Base), "Invalid node:\n{}\n\n{}".format(repr(node),
+            assert isinstance(parser, Parser), "Invalid parser {} for node:\n{}\n\n{}".format(parser, repr(node),
                 unicode(node).encode('utf-8'))
-            self.node = node
-        assert isinstance(parser, Parser), "Invalid parser {} for node:\n{}\n\n{}".format(parser, repr(node),
-            unicode(node).encode('utf-8'))
+        # Unlike the attributes of subclasses, these ones are set even when None, because reading an attribute that is
+        # not set calls __getattr__, which is slow for attributes read as often as these ones.
+        self.container = container
+        self.guessed_by_expected = None
+        self.hint = hint
+        self.node = node
         self.parser = parser
+        if parser.low_memory and node is not None:
+            parser.wrappers_with_node.append(self)
+
+    def __getattr__(self, name):
+        # Called only when the attribute is not set: return the default value declared by the class.
+        try:
+            return self.default_by_name[name]
+        except KeyError:
+            raise AttributeError("'{}' object has no attribute '{}'".format(self.__class__.__name__, name))
 
     @property
     def containing_class(self):
@@ -101,7 +192,11 @@ class AbstractWrapper(object):
             return None
         return container.containing_module
 
-    def guess(self, expected):
+    def compute_guess(self, expected):
+        """Return a wrapper of class expected that describes this wrapper, or None.
+
+        This is the method to override in subclasses. Use guess() to query the guessed wrappers.
+        """
         assert issubclass(expected, AbstractWrapper)
         if isinstance(self, expected):
             return self
@@ -111,6 +206,78 @@ class AbstractWrapper(object):
                 return guessed
         return None
 
+    def get_node(self):
+        """Return the lib2to3 node of the wrapper, parsing its source again when its tree has been released."""
+        node = self.node
+        if isinstance(node, SourceSpan):
+            self.node = node = node.get_node()
+            self.parser.wrappers_with_node.append(self)
+        return node
+
+    def get_attributes(self):
+        """Return the attributes set on the wrapper, by name (wrappers have no __dict__)."""
+        attributes = {}
+        for name in self.default_by_name:
+            try:
+                attributes[name] = object.__getattribute__(self, name)
+            except AttributeError:
+                # Attribute is not set.
+                continue
+        return attributes
+
+    def guess(self, expected):
+        """Return a wrapper of class expected that describes this wrapper, or None.
+
+        Guesses are memoized until the parser changes a state they may depend on (see Parser.guess_generation), unless
+        Parser.memoize_guesses is False. A guess that depends on itself returns None instead of recursing infinitely,
+        even when guesses are not memoized. A guess that got this None from a guess still in progress outside of it is
+        incomplete, so it is not memoized.
+        """
+        if isinstance(self, expected):
+            return self
+        parser = self.parser
+        if parser.column is not parser.guess_column:
+            parser.guess_column = parser.column
+            parser.guess_generation += 1
+        guessed_by_expected = self.guessed_by_expected
+        if guessed_by_expected is None or self.guess_generation != parser.guess_generation:
+            self.guessed_by_expected = guessed_by_expected = {}
+            self.guess_generation = parser.guess_generation
+        elif expected in guessed_by_expected:
+            guessed = guessed_by_expected[expected]
+            if isinstance(guessed, int):
+                # Cycle: the guess is in progress, at this depth.
+                if parser.guess_cycle_depth is None or guessed < parser.guess_cycle_depth:
+                    parser.guess_cycle_depth = guessed
+                return None
+            return guessed
+        depth = parser.guess_depth
+        outer_cycle_depth = parser.guess_cycle_depth
+        guessed_by_expected[expected] = depth
+        parser.guess_cycle_depth = None
+        parser.guess_depth = depth + 1
+        try:
+            guessed = self.compute_guess(expected)
+        except:
+            guessed_by_expected.pop(expected, None)
+            parser.guess_cycle_depth = outer_cycle_depth
+            raise
+        finally:
+            parser.guess_depth = depth
+        cycle_depth = parser.guess_cycle_depth
+        if cycle_depth is None or cycle_depth >= depth:
+            if parser.memoize_guesses:
+                guessed_by_expected[expected] = guessed
+            else:
+                del guessed_by_expected[expected]
+            parser.guess_cycle_depth = outer_cycle_depth
+        else:
+            # The guess used an outer guess in progress => Compute it again at its next call.
+            del guessed_by_expected[expected]
+            parser.guess_cycle_depth = cycle_depth if outer_cycle_depth is None \
+                else min(cycle_depth, outer_cycle_depth)
+        return guessed
+
 
 # Level-1 Wrappers
 
@@ -126,8 +293,8 @@ class AndExpression(AbstractWrapper):
         assert isinstance(operator, basestring)
         self.operator = operator
 
-    def guess(self, expected):
-        guessed = super(AndExpression, self).guess(expected)
+    def compute_guess(self, expected):
+        guessed = super(AndExpression, self).compute_guess(expected)
         if guessed is not None:
             return guessed
 
@@ -188,8 +355,8 @@ class AndTest(AbstractWrapper):
         assert isinstance(operator, basestring)
         self.operator = operator
 
-    def guess(self, expected):
-        guessed = super(AndTest, self).guess(expected)
+    def compute_guess(self, expected):
+        guessed = super(AndTest, self).compute_guess(expected)
         if guessed is not None:
             return guessed
 
@@ -241,8 +408,8 @@ class ArithmeticExpression(AbstractWrapper):
         assert len(items) >= 3 and (len(items) & 1)
         self.items = items
 
-    def guess(self, expected):
-        guessed = super(ArithmeticExpression, self).guess(expected)
+    def compute_guess(self, expected):
+        guessed = super(ArithmeticExpression, self).compute_guess(expected)
         if guessed is not None:
             return guessed
 
@@ -307,6 +474,7 @@ class Array(AbstractWrapper):
                 "Unexpected value for entity class: {} of type {}".format(entity_class, type(entity_class))
             self.entity_class = entity_class
         if value is not None:
+            import numpy as np
             assert isinstance(value, np.ndarray), "Unexpected value for array: {} of type {}".format(value,
                 type(value))
             self.value = value
@@ -358,11 +526,12 @@ class Assignment(AbstractWrapper):
     def __init__(self, container = None, hint = None, left = None, node = None, operator = None, parser = None,
             right = None):
         super(Assignment, self).__init__(container = container, hint = hint, node = node, parser = parser)
-        assert isinstance(left, list)
+        if parser.strict:
+            assert isinstance(left, list)
+            assert isinstance(operator, basestring)
+            assert isinstance(right, list)
         self.left = left
-        assert isinstance(operator, basestring)
         self.operator = operator
-        assert isinstance(right, list)
         self.right = right
 
         if len(left) == len(right) and operator == '=':
@@ -437,13 +606,14 @@ class Attribute(AbstractWrapper):
 
     def __init__(self, container = None, hint = None, name = None, node = None, parser = None, subject = None):
         super(Attribute, self).__init__(container = container, hint = hint, node = node, parser = parser)
-        assert isinstance(name, basestring)
+        if parser.strict:
+            assert isinstance(name, basestring)
+            assert isinstance(subject, AbstractWrapper)
         self.name = name
-        assert isinstance(subject, AbstractWrapper)
         self.subject = subject
 
-    def guess(self, expected):
-        guessed = super(Attribute, self).guess(expected)
+    def compute_guess(self, expected):
+        guessed = super(Attribute, self).compute_guess(expected)
         if guessed is not None:
             return guessed
 
@@ -451,19 +621,18 @@ class Attribute(AbstractWrapper):
         if issubclass(parser.Boolean, expected):
             compact_node_wrapper = self.subject.guess(parser.CompactNode)
             if compact_node_wrapper is not None:
-                child_json = compact_node_wrapper.value['children'][self.name]
-                child_type = child_json['@type']
-                if child_type == u'Parameter' and child_json.get('format') == 'boolean':
+                legislation_index = parser.get_legislation_index()
+                child_path = compact_node_wrapper.get_child_path(self.name)
+                child_type = legislation_index.type_by_path[child_path]
+                if child_type == u'Parameter' and legislation_index.format_by_path.get(child_path) == 'boolean':
                     return parser.Boolean(parser = parser)
         elif issubclass(parser.CompactNode, expected):
             compact_node = self.subject.guess(parser.CompactNode)
             if compact_node is not None:
-                child_json = compact_node.value['children'].get(self.name)
-                if child_json is not None:
-                    child_type = child_json['@type']
-                    if child_type == u'Node':
-                        return parser.CompactNode(is_reference = compact_node.is_reference, name = self.name,
-                            parent = compact_node, parser = parser, value = child_json)
+                child_type = parser.get_legislation_index().type_by_path.get(compact_node.get_child_path(self.name))
+                if child_type == u'Node':
+                    return parser.CompactNode(is_reference = compact_node.is_reference, name = self.name,
+                        parent = compact_node, parser = parser)
         elif issubclass(parser.Date, expected):
             if self.name == 'date':
                 period = self.subject.guess(parser.Period)
@@ -497,9 +666,10 @@ class Attribute(AbstractWrapper):
                     return parser.Number(parser = parser)
             compact_node_wrapper = self.subject.guess(parser.CompactNode)
             if compact_node_wrapper is not None:
-                child_json = compact_node_wrapper.value['children'][self.name]
-                child_type = child_json['@type']
-                if child_type == u'Parameter' and child_json.get('format') != 'boolean':
+                legislation_index = parser.get_legislation_index()
+                child_path = compact_node_wrapper.get_child_path(self.name)
+                child_type = legislation_index.type_by_path[child_path]
+                if child_type == u'Parameter' and legislation_index.format_by_path.get(child_path) != 'boolean':
                     return parser.Number(parser = parser)
         elif issubclass(parser.String, expected):
             if self.name == '__name__':
@@ -509,8 +679,7 @@ class Attribute(AbstractWrapper):
         elif issubclass(parser.TaxScale, expected):
             compact_node_wrapper = self.subject.guess(parser.CompactNode)
             if compact_node_wrapper is not None:
-                child_json = compact_node_wrapper.value['children'][self.name]
-                child_type = child_json['@type']
+                child_type = parser.get_legislation_index().type_by_path[compact_node_wrapper.get_child_path(self.name)]
                 if child_type == u'Scale':
                     return parser.TaxScale(parser = parser)
         elif issubclass(parser.UniformDictionary, expected):
@@ -558,31 +727,30 @@ class Call(AbstractWrapper):
     def __init__(self, container = None, hint = None, keyword_argument = None, named_arguments = None, node = None,
             parser = None, positional_arguments = None, star_argument = None, subject = None):
         super(Call, self).__init__(container = container, hint = hint, node = node, parser = parser)
+        if parser.strict:
+            assert keyword_argument is None or isinstance(keyword_argument, AbstractWrapper)
+            assert named_arguments is None or isinstance(named_arguments, collections.OrderedDict)
+            assert positional_arguments is None or isinstance(positional_arguments, list)
+            assert star_argument is None or isinstance(star_argument, AbstractWrapper)
+            assert isinstance(subject, AbstractWrapper)
         if keyword_argument is not None:
-            assert isinstance(keyword_argument, AbstractWrapper)
             self.keyword_argument = keyword_argument
         if named_arguments is None:
             named_arguments = collections.OrderedDict()
-        else:
-            assert isinstance(named_arguments, collections.OrderedDict)
         self.named_arguments = named_arguments
         if positional_arguments is None:
             positional_arguments = []
-        else:
-            assert isinstance(positional_arguments, list)
         self.positional_arguments = positional_arguments
         if star_argument is not None:
-            assert isinstance(star_argument, AbstractWrapper)
             self.star_argument = star_argument
-        assert isinstance(subject, AbstractWrapper)
         self.subject = subject
 
         function = subject.guess(parser.Function)
         if function is not None:
             function.parse_call(self)
 
-    def guess(self, expected):
-        guessed = super(Call, self).guess(expected)
+    def compute_guess(self, expected):
+        guessed = super(Call, self).compute_guess(expected)
         if guessed is not None:
             return guessed
 
@@ -598,8 +766,7 @@ class Call(AbstractWrapper):
                             ),
                         parser = parser,
                         )
-            assert function.returns, "Function {} has no return statement".format(function.name)
-            return function.returns[-1].guess(expected)
+            return function.guess_call_return(self, expected)
 
         if issubclass(parser.Array, expected):
             function = self.subject.guess(parser.Variable)
@@ -736,7 +903,6 @@ class Call(AbstractWrapper):
                             return parser.CompactNode(
                                 is_reference = bool(reference),
                                 parser = parser,
-                                value = parser.tax_benefit_system.get_legislation(),
                                 )
         elif issubclass(parser.Date, expected):
             function = self.subject.guess(parser.Variable)
@@ -1006,26 +1172,21 @@ class ClassFileInput(AbstractWrapper):
 
     @classmethod
     def parse(cls, class_definition, parser = None):
-        source_lines, line_number = inspect.getsourcelines(class_definition)
-        source = textwrap.dedent(''.join(source_lines))
-        node = parser.driver.parse_string(source)
-        assert node.type == symbols.file_input, "Unexpected file input type:\n{}\n\n{}".format(repr(node),
+        node = parser.get_definition_node(class_definition)
+        assert node.type == symbols.classdef, "Unexpected class definition type:\n{}\n\n{}".format(repr(node),
             unicode(node).encode('utf-8'))
-        children = node.children
-        assert len(children) == 2 and children[0].type == symbols.classdef and children[1].type == tokens.ENDMARKER, \
-            "Unexpected node children in:\n{}\n\n{}".format(repr(node), unicode(node).encode('utf-8'))
         python_module = inspect.getmodule(class_definition)
         if parser.country_package is not None:
             assert python_module.__file__.startswith(os.path.dirname(parser.country_package.__file__)), \
-                "Requested class is defined outside country_package:\n{}".format(source)
+                "Requested class is defined outside country_package:\n{}".format(unicode(node).encode('utf-8'))
         module = parser.python_module_by_name.get(python_module.__name__)
         if module is None:
-            parser.python_module_by_name[python_module.__name__] = module = parser.Module(node, python = python_module,
-                parser = parser)
+            parser.python_module_by_name[python_module.__name__] = module = parser.Module(
+                parser.get_file_input_node(node), python = python_module, parser = parser)
         self = cls(parser = parser)
         class_definition_class = self.get_class_class(parser = parser)
         try:
-            return class_definition_class.parse(children[0], container = module, parser = parser)
+            return class_definition_class.parse(node, container = module, parser = parser)
         except:
             if node is not None:
                 print "An exception occurred in node:\n{}\n\n{}".format(repr(node), unicode(node).encode('utf-8'))
@@ -1033,12 +1194,12 @@ class ClassFileInput(AbstractWrapper):
 
 
 class CompactNode(AbstractWrapper):
+    """A node of the legislation, whose children are described by the legislation index of the parser"""
     is_reference = True
     name = None
     parent = None  # Parent Compact Node wrapper
-    value = None  # Law node JSON
 
-    def __init__(self, is_reference = False, name = None, parent = None, parser = None, value = None):
+    def __init__(self, is_reference = False, name = None, parent = None, parser = None):
         super(CompactNode, self).__init__(parser = parser)
         if not is_reference:
             self.is_reference = False
@@ -1048,9 +1209,11 @@ class CompactNode(AbstractWrapper):
         if parent is not None:
             assert isinstance(parent, CompactNode)
             self.parent = parent
-        if value is not None:
-            assert isinstance(value, dict)
-            self.value = value
+
+    def get_child_path(self, name):
+        """Return the path of a child of the node in the legislation index."""
+        path = self.path
+        return u'{}.{}'.format(path, name) if path else name
 
     def iter_names(self):
         parent = self.parent
@@ -1074,15 +1237,16 @@ class Comparison(AbstractWrapper):
     def __init__(self, container = None, hint = None, left = None, node = None, operator = None, parser = None,
             right = None):
         super(Comparison, self).__init__(container = container, hint = hint, node = node, parser = parser)
-        assert isinstance(left, AbstractWrapper)
+        if parser.strict:
+            assert isinstance(left, AbstractWrapper)
+            assert isinstance(operator, basestring)
+            assert isinstance(right, AbstractWrapper)
         self.left = left
-        assert isinstance(operator, basestring)
         self.operator = operator
-        assert isinstance(right, AbstractWrapper)
         self.right = right
 
-    def guess(self, expected):
-        guessed = super(Comparison, self).guess(expected)
+    def compute_guess(self, expected):
+        guessed = super(Comparison, self).compute_guess(expected)
         if guessed is not None:
             return guessed
 
@@ -1185,6 +1349,7 @@ class DatedHolder(AbstractWrapper):
                 "Unexpected value for column: {} of type {}".format(column, type(column))
             self.column = column
         if value is not None:
+            import numpy as np
             assert isinstance(value, np.ndarray), "Unexpected value for array: {} of type {}".format(value,
                 type(value))
             self.value = value
@@ -1270,8 +1435,8 @@ class Enum(AbstractWrapper):
         if value is not None:
             self.value = value
 
-    def guess(self, expected):
-        guessed = super(Enum, self).guess(expected)
+    def compute_guess(self, expected):
+        guessed = super(Enum, self).compute_guess(expected)
         if guessed is not None:
             return guessed
 
@@ -1309,13 +1474,14 @@ class Expression(AbstractWrapper):
 
     def __init__(self, container = None, hint = None, node = None, operands = None, operator = None, parser = None):
         super(Expression, self).__init__(container = container, hint = hint, node = node, parser = parser)
-        assert isinstance(operands, list)
+        if parser.strict:
+            assert isinstance(operands, list)
+            assert isinstance(operator, basestring)
         self.operands = operands
-        assert isinstance(operator, basestring)
         self.operator = operator
 
-    def guess(self, expected):
-        guessed = super(Expression, self).guess(expected)
+    def compute_guess(self, expected):
+        guessed = super(Expression, self).compute_guess(expected)
         if guessed is not None:
             return guessed
 
@@ -1538,6 +1704,11 @@ class Function(AbstractWrapper):
             variable = default
         return variable
 
+    def guess_call_return(self, call, expected):
+        """Return a wrapper of class expected that describes the value returned to a call of the function, or None."""
+        assert self.returns, "Function {} has no return statement".format(self.name)
+        return self.returns[-1].guess(expected)
+
     @classmethod
     def parse(cls, node, container = None, parser = None):
         try:
@@ -1559,7 +1730,7 @@ class Function(AbstractWrapper):
 
     def parse_body(self):
         parser = self.parser
-        children = self.node.children
+        children = self.get_node().children
         assert len(children) == 5
 
         self.body_parsed = True
@@ -1601,9 +1772,26 @@ class Function(AbstractWrapper):
 
             self.parse_body()
 
+    def reset(self):
+        """Forget the body parsed at the first call, so that it is parsed again with the arguments of the next call."""
+        parser = self.parser
+        parameters_name = set(self.positional_parameters)
+        parameters_name.update(self.named_parameters)
+        parameters_name.add(self.keyword_name)
+        parameters_name.add(self.star_name)
+        self.body_parsed = False
+        del self.body[:]
+        del self.returns[:]
+        parser.guess_generation += 1
+        self.variable_by_name = collections.OrderedDict(
+            (name, parser.Variable(container = self, name = name, parser = parser))
+            for name in self.variable_by_name
+            if name in parameters_name
+            )
+
     def parse_parameters(self):
         parser = self.parser
-        children = self.node.children
+        children = self.get_node().children
         assert len(children) == 5
 
         parameters = children[2]
@@ -1723,27 +1911,21 @@ class FunctionFileInput(AbstractWrapper):
 
     @classmethod
     def parse(cls, function, parser = None):
-        source_lines, line_number = inspect.getsourcelines(function)
-        source = textwrap.dedent(''.join(source_lines))
-        # print source
-        node = parser.driver.parse_string(source)
-        assert node.type == symbols.file_input, "Unexpected file input type:\n{}\n\n{}".format(repr(node),
+        node = parser.get_definition_node(function)
+        assert node.type == symbols.funcdef, "Unexpected function definition type:\n{}\n\n{}".format(repr(node),
             unicode(node).encode('utf-8'))
-        children = node.children
-        assert len(children) == 2 and children[0].type == symbols.funcdef and children[1].type == tokens.ENDMARKER, \
-            "Unexpected node children in:\n{}\n\n{}".format(repr(node), unicode(node).encode('utf-8'))
         python_module = inspect.getmodule(function)
         if parser.country_package is not None:
             assert python_module.__file__.startswith(os.path.dirname(parser.country_package.__file__)), \
-                "Requested class is defined outside country_package:\n{}".format(source)
+                "Requested class is defined outside country_package:\n{}".format(unicode(node).encode('utf-8'))
         module = parser.python_module_by_name.get(python_module.__name__)
         if module is None:
-            parser.python_module_by_name[python_module.__name__] = module = parser.Module(node, python = python_module,
-                parser = parser)
+            parser.python_module_by_name[python_module.__name__] = module = parser.Module(
+                parser.get_file_input_node(node), python = python_module, parser = parser)
         self = cls(parser = parser)
         function_class = self.get_function_class(parser = parser)
         try:
-            return function_class.parse(children[0], container = module, parser = parser)
+            return function_class.parse(node, container = module, parser = parser)
         except:
             if node is not None:
                 print "An exception occurred in node:\n{}\n\n{}".format(repr(node), unicode(node).encode('utf-8'))
@@ -1813,13 +1995,14 @@ class Key(AbstractWrapper):
 
     def __init__(self, container = None, hint = None, node = None, parser = None, subject = None, value = None):
         super(Key, self).__init__(container = container, hint = hint, node = node, parser = parser)
-        assert isinstance(subject, AbstractWrapper)
+        if parser.strict:
+            assert isinstance(subject, AbstractWrapper)
+            assert isinstance(value, AbstractWrapper)
         self.subject = subject
-        assert isinstance(value, AbstractWrapper)
         self.value = value
 
-    def guess(self, expected):
-        guessed = super(Key, self).guess(expected)
+    def compute_guess(self, expected):
+        guessed = super(Key, self).compute_guess(expected)
         if guessed is not None:
             return guessed
 
@@ -2049,81 +2232,8 @@ class Module(AbstractWrapper):
         if python is not None:
             # Python module
             self.python = python
-        self.variable_by_name = collections.OrderedDict(sorted(dict(
-            and_ = parser.Variable(container = self, name = u'and_', parser = parser),
-            around = parser.Variable(container = self, name = u'around', parser = parser),
-            apply_along_axis = parser.Variable(container = self, name = u'apply_along_axis', parser = parser),
-            array = parser.Variable(container = self, name = u'array', parser = parser),
-            CAT = parser.Variable(container = self, name = u'CAT', parser = parser,
-                value = parser.Enum(parser = parser)),
-            ceil = parser.Variable(container = self, name = u'ceil', parser = parser),
-            CHEF = parser.Variable(container = self, name = u'CHEF', parser = parser,
-                value = parser.Number(parser = parser, value = 0)),
-            # combine_tax_scales = parser.Variable(container = self, name = u'combine_tax_scales', parser = parser),
-            CONJ = parser.Variable(container = self, name = u'CONJ', parser = parser,
-                value = parser.Number(parser = parser, value = 1)),
-            CREF = parser.Variable(container = self, name = u'CREF', parser = parser,
-                value = parser.Number(parser = parser, value = 1)),
-            date = parser.Variable(container = self, name = u'date', parser = parser),
-            datetime64 = parser.Variable(container = self, name = u'datetime64', parser = parser),
-            dict = parser.Variable(container = self, name = u'dict', parser = parser),
-            # ENFS = parser.Variable(container = self, name = u'ENFS', parser = parser,
-            #     value = parser.UniformList(parser = parser, value = parser.Number(parser = parser, value = x))),
-            ENFS = parser.Variable(container = self, name = u'ENFS', parser = parser),
-            floor = parser.Variable(container = self, name = u'floor', parser = parser),
-            fromiter = parser.Variable(container = self, name = u'fromiter', parser = parser),
-            fsolve = parser.Variable(container = self, name = u'fsolve', parser = parser),
-            hasattr = parser.Variable(container = self, name = u'hasattr', parser = parser),
-            holidays = parser.Variable(container = self, name = u'holidays', parser = parser),
-            int16 = parser.Variable(container = self, name = u'int16', parser = parser,
-                value = parser.Type(parser = parser, value = np.int16)),
-            int32 = parser.Variable(container = self, name = u'int32', parser = parser,
-                value = parser.Type(parser = parser, value = np.int32)),
-            izip = parser.Variable(container = self, name = u'izip', parser = parser),
-            law = parser.Variable(container = self, name = u'law', parser = parser,
-                value = parser.CompactNode(parser = parser, value = parser.tax_benefit_system.get_legislation())),
-            len = parser.Variable(container = self, name = u'len', parser = parser),
-            log = parser.Variable(container = self, name = u'log', parser = parser,
-                value = parser.Logger(parser = parser)),
-            MarginalRateTaxScale = parser.Variable(container = self, name = u'MarginalRateTaxScale', parser = parser),
-            max = parser.Variable(container = self, name = u'max', parser = parser),
-            max_ = parser.Variable(container = self, name = u'max_', parser = parser),
-            math = parser.Variable(container = self, name = u'math', parser = parser),
-            min_ = parser.Variable(container = self, name = u'min_', parser = parser),
-            not_ = parser.Variable(container = self, name = u'not_', parser = parser),
-            ones = parser.Variable(container = self, name = u'ones', parser = parser),
-            or_ = parser.Variable(container = self, name = u'or_', parser = parser),
-            original_busday_count = parser.Variable(container = self, name = u'original_busday_count', parser = parser),
-            PAC1 = parser.Variable(container = self, name = u'PAC1', parser = parser,
-                value = parser.Number(parser = parser, value = 2)),
-            PAC2 = parser.Variable(container = self, name = u'PAC2', parser = parser,
-                value = parser.Number(parser = parser, value = 3)),
-            PAC3 = parser.Variable(container = self, name = u'PAC3', parser = parser,
-                value = parser.Number(parser = parser, value = 4)),
-            PART = parser.Variable(container = self, name = u'PART', parser = parser,
-                value = parser.Number(parser = parser, value = 1)),
-            partial = parser.Variable(container = self, name = u'partial', parser = parser),
-            PREF = parser.Variable(container = self, name = u'PREF', parser = parser,
-                value = parser.Number(parser = parser, value = 0)),
-            round = parser.Variable(container = self, name = u'round', parser = parser),
-            round_ = parser.Variable(container = self, name = u'round_', parser = parser),
-            # scale_tax_scales = parser.Variable(container = self, name = u'scale_tax_scales', parser = parser),
-            SCOLARITE_COLLEGE = parser.Variable(container = self, name = u'SCOLARITE_COLLEGE', parser = parser,
-                value = parser.Number(parser = parser, value = 1)),
-            sorted = parser.Variable(container = self, name = u'sorted', parser = parser),
-            startswith = parser.Variable(container = self, name = u'startswith', parser = parser),
-            TAUX_DE_PRIME = parser.Variable(container = self, name = u'TAUX_DE_PRIME', parser = parser,
-                value = parser.Number(parser = parser, value = 1 / 4)),
-            # TaxScalesTree = parser.Variable(container = self, name = u'TaxScalesTree', parser = parser),
-            timedelta64 = parser.Variable(container = self, name = u'timedelta64', parser = parser),
-            ValueError = parser.Variable(container = self, name = u'ValueError', parser = parser),
-            VOUS = parser.Variable(container = self, name = u'VOUS', parser = parser,
-                value = parser.Number(parser = parser, value = 0)),
-            where = parser.Variable(container = self, name = u'where', parser = parser),
-            xor_ = parser.Variable(container = self, name = u'xor_', parser = parser),
-            zeros = parser.Variable(container = self, name = u'zeros', parser = parser),
-            zone_apl_by_depcom = parser.Variable(container = self, name = u'zone_apl_by_depcom', parser = parser),
-            ).iteritems()))
+        # Note: Builtin variables are shared by every module. They are not stored in variable_by_name.
+        self.variable_by_name = collections.OrderedDict()
 
     @property
     def containing_module(self):
@@ -2131,6 +2241,8 @@ class Module(AbstractWrapper):
 
     def get_variable(self, name, default = UnboundLocalError, parser = None):
         variable = self.variable_by_name.get(name, None)
+        if variable is None:
+            variable = parser.get_builtin_variable(name)
         if variable is None:
             value = getattr(self.python, name, UnboundLocalError)
             if value is UnboundLocalError:
@@ -2145,11 +2257,23 @@ class Module(AbstractWrapper):
             # Declare function before parsing if to avoid infinite parsing when it is recursive.
             self.variable_by_name[name] = variable = parser.Variable(container = self, name = name,
                 parser = parser)
-            function = parser.FunctionFileInput.parse(value, parser = parser)
+            try:
+                function = parser.FunctionFileInput.parse(value, parser = parser)
+            except:
+                # Don't keep a variable without value, so that parsing is attempted (and fails) again next time.
+                del self.variable_by_name[name]
+                raise
             assert isinstance(function, parser.Function), function
             variable.value = function
         return variable
 
+    def iter_functions(self):
+        """Iterate over the parsed functions used by the Python module (including the imported ones)."""
+        for variable in self.variable_by_name.itervalues():
+            function = variable.value
+            if isinstance(function, self.parser.Function):
+                yield function
+
 
 class NoneWrapper(AbstractWrapper):
     pass
@@ -2164,8 +2288,8 @@ class NotTest(AbstractWrapper):
         assert isinstance(value, AbstractWrapper)
         self.value = value
 
-    def guess(self, expected):
-        guessed = super(NotTest, self).guess(expected)
+    def compute_guess(self, expected):
+        guessed = super(NotTest, self).compute_guess(expected)
         if guessed is not None:
             return guessed
 
@@ -2230,11 +2354,12 @@ class ParentheticalExpression(AbstractWrapper):
     def __init__(self, container = None, hint = None, node = None, parser = None, value = None):
         super(ParentheticalExpression, self).__init__(container = container, hint = hint, node = node,
             parser = parser)
-        assert isinstance(value, AbstractWrapper)
+        if parser.strict:
+            assert isinstance(value, AbstractWrapper)
         self.value = value
 
-    def guess(self, expected):
-        guessed = super(ParentheticalExpression, self).guess(expected)
+    def compute_guess(self, expected):
+        guessed = super(ParentheticalExpression, self).compute_guess(expected)
         if guessed is not None:
             return guessed
 
@@ -2283,11 +2408,12 @@ class Return(AbstractWrapper):
 
     def __init__(self, container = None, hint = None, node = None, parser = None, value = None):
         super(Return, self).__init__(container = container, hint = hint, node = node, parser = parser)
-        assert isinstance(value, AbstractWrapper)
+        if parser.strict:
+            assert isinstance(value, AbstractWrapper)
         self.value = value
 
-    def guess(self, expected):
-        guessed = super(Return, self).guess(expected)
+    def compute_guess(self, expected):
+        guessed = super(Return, self).compute_guess(expected)
         if guessed is not None:
             return guessed
 
@@ -2311,6 +2437,8 @@ class Return(AbstractWrapper):
 
         containing_function = self.containing_function
         containing_function.returns.append(self)
+        # The guesses of the calls of the function depend on its last return.
+        parser.guess_generation += 1
 
         return self
 
@@ -2405,8 +2533,8 @@ class Term(AbstractWrapper):
         assert len(items) >= 3 and (len(items) & 1)
         self.items = items
 
-    def guess(self, expected):
-        guessed = super(Term, self).guess(expected)
+    def compute_guess(self, expected):
+        guessed = super(Term, self).compute_guess(expected)
         if guessed is not None:
             return guessed
 
@@ -2554,8 +2682,8 @@ class UniformDictionary(AbstractWrapper):
         assert isinstance(value, AbstractWrapper)
         self.value = value
 
-    def guess(self, expected):
-        guessed = super(UniformDictionary, self).guess(expected)
+    def compute_guess(self, expected):
+        guessed = super(UniformDictionary, self).compute_guess(expected)
         if guessed is not None:
             return guessed
 
@@ -2589,21 +2717,32 @@ class UniformIterator(AbstractWrapper):
 
 class Variable(AbstractWrapper):
     name = None
-    value = None  # A value wrapper
+    value_wrapper = None  # The value wrapper, see value property
 
     def __init__(self, container = None, hint = None, name = None, node = None, parser = None, value = None):
         super(Variable, self).__init__(container = container, hint = hint, node = node, parser = parser)
-        assert isinstance(name, basestring)
+        if parser.strict:
+            assert isinstance(name, basestring)
+            assert value is None or isinstance(value, AbstractWrapper)
         self.name = name
         if value is not None:
-            assert isinstance(value, AbstractWrapper)
             self.value = value
 
     def __repr__(self):
         return u'<Variable {}>'.format(self.name)
 
-    def guess(self, expected):
-        guessed = super(Variable, self).guess(expected)
+    @property
+    def value(self):
+        return self.value_wrapper
+
+    @value.setter
+    def value(self, value):
+        # Guesses may depend on the value of any variable.
+        self.parser.guess_generation += 1
+        self.value_wrapper = value
+
+    def compute_guess(self, expected):
+        guessed = super(Variable, self).compute_guess(expected)
         if guessed is not None:
             return guessed
 
@@ -2632,8 +2771,8 @@ class XorExpression(AbstractWrapper):
         assert isinstance(operator, basestring)
         self.operator = operator
 
-    def guess(self, expected):
-        guessed = super(XorExpression, self).guess(expected)
+    def compute_guess(self, expected):
+        guessed = super(XorExpression, self).compute_guess(expected)
         if guessed is not None:
             return guessed
 
@@ -2682,7 +2821,6 @@ class FormulaClass(Class):
 
 
 class FormulaClassFileInput(ClassFileInput):
-    # Caution: This is not the whole module, but only a dummy "module" containing only the formula.
     @classmethod
     def get_class_class(cls, parser = None):
         return parser.FormulaClass
@@ -2734,7 +2872,7 @@ class FormulaFunction(Function):
 # Default Parser
 
 
-class Parser(conv.State):
+class Parser(object):
     AndExpression = AndExpression
     AndTest = AndTest
     Array = Array
@@ -2744,6 +2882,7 @@ class Parser(conv.State):
     Assignment = Assignment
     Attribute = Attribute
     Boolean = Boolean
+    builtin_variable_by_name = None  # Variables shared by every module, built only once (see get_builtin_variable)
     Call = Call
     Class = Class
     ClassFileInput = ClassFileInput
@@ -2756,6 +2895,7 @@ class Parser(conv.State):
     DateTime64 = DateTime64
     DatedHolder = DatedHolder
     Decorator = Decorator
+    definition_node_by_name_by_file_path = None  # Cache of the top-level lib2to3 definitions of each parsed module
     Dictionary = Dictionary
     driver = None
     Entity = Entity
@@ -2772,31 +2912,43 @@ class Parser(conv.State):
     Function = Function
     # FunctionCall = FunctionCall
     FunctionFileInput = FunctionFileInput
+    guess_column = None  # The column of the guesses of the current generation
+    guess_cycle_depth = None  # Lowest depth of the guesses in progress reached by a cycle in the current guess
+    guess_depth = 0  # Number of guesses in progress
+    guess_generation = 0  # Incremented each time a state used by guesses changes, to invalidate memoized guesses
     Holder = Holder
     If = If
     Instant = Instant
+    keep_modules = False  # When True, module wrappers & their parsed functions are kept from one formula to the next
     Key = Key
     Lambda = Lambda
+    legislation_index = None  # Index of the nodes of the legislation, built at first use (see get_legislation_index)
+    low_memory = False  # When True, the lib2to3 trees are released after each column (see release_trees)
     List = List
     ListGenerator = ListGenerator
     Logger = Logger
     # Math = Math
+    memoize_guesses = True  # Set to False to compute every guess again (for debugging)
     Module = Module
     NoneWrapper = NoneWrapper
     NotTest = NotTest
     Number = Number
     ParentheticalExpression = ParentheticalExpression
     Period = Period
+    parsed_tree_by_source = None  # In low-memory mode, trees parsed since the last release, by source
+    profiler = None  # Optional profiler of the time spent in each phase of the parsing (see profilers.Profiler)
     python_module_by_name = None
     Raise = Raise
     Return = Return
     Role = Role
     Simulation = Simulation
     StemNode = StemNode
+    strict = True  # Set to False (trusted mode) to skip the structural validation of the wrappers, for speed
     String = String
     # Structure = Structure
     tax_benefit_system = None
     TaxScale = TaxScale
+    trees_cache = None  # Optional persistent cache of lib2to3 trees (see caches.TreesCache)
     # TaxScalesTree = TaxScalesTree
     Term = Term
     Test = Test
@@ -2807,14 +2959,108 @@ class Parser(conv.State):
     UniformIterator = UniformIterator
     # UniformList = UniformList
     Variable = Variable
+    wrappers_with_node = None  # In low-memory mode, wrappers whose lib2to3 node must be released at the next release
     XorExpression = XorExpression
 
-    def __init__(self, country_package = None, driver = None, tax_benefit_system = None):
+    def __init__(self, country_package = None, driver = None, keep_modules = False, legislation_index = None,
+            low_memory = False, profiler = None, strict = True, tax_benefit_system = None, trees_cache = None):
         if country_package is not None:
             self.country_package = country_package
+        self.definition_node_by_name_by_file_path = {}
         self.driver = driver
+        self.keep_modules = keep_modules
+        if legislation_index is not None:
+            self.legislation_index = legislation_index
+        if low_memory:
+            self.low_memory = True
+            self.parsed_tree_by_source = {}
+            self.wrappers_with_node = []
+        self.profiler = profiler
         self.python_module_by_name = {}
+        if not strict:
+            self.strict = False
         self.tax_benefit_system = tax_benefit_system
+        self.trees_cache = trees_cache
+
+    def build_builtin_variable_by_name(self):
+        import numpy as np
+
+        parser = self
+        return collections.OrderedDict(sorted(dict(
+            and_ = parser.Variable(name = u'and_', parser = parser),
+            around = parser.Variable(name = u'around', parser = parser),
+            apply_along_axis = parser.Variable(name = u'apply_along_axis', parser = parser),
+            array = parser.Variable(name = u'array', parser = parser),
+            CAT = parser.Variable(name = u'CAT', parser = parser,
+                value = parser.Enum(parser = parser)),
+            ceil = parser.Variable(name = u'ceil', parser = parser),
+            CHEF = parser.Variable(name = u'CHEF', parser = parser,
+                value = parser.Number(parser = parser, value = 0)),
+            # combine_tax_scales = parser.Variable(name = u'combine_tax_scales', parser = parser),
+            CONJ = parser.Variable(name = u'CONJ', parser = parser,
+                value = parser.Number(parser = parser, value = 1)),
+            CREF = parser.Variable(name = u'CREF', parser = parser,
+                value = parser.Number(parser = parser, value = 1)),
+            date = parser.Variable(name = u'date', parser = parser),
+            datetime64 = parser.Variable(name = u'datetime64', parser = parser),
+            dict = parser.Variable(name = u'dict', parser = parser),
+            # ENFS = parser.Variable(name = u'ENFS', parser = parser,
+            #     value = parser.UniformList(parser = parser, value = parser.Number(parser = parser, value = x))),
+            ENFS = parser.Variable(name = u'ENFS', parser = parser),
+            floor = parser.Variable(name = u'floor', parser = parser),
+            fromiter = parser.Variable(name = u'fromiter', parser = parser),
+            fsolve = parser.Variable(name = u'fsolve', parser = parser),
+            hasattr = parser.Variable(name = u'hasattr', parser = parser),
+            holidays = parser.Variable(name = u'holidays', parser = parser),
+            int16 = parser.Variable(name = u'int16', parser = parser,
+                value = parser.Type(parser = parser, value = np.int16)),
+            int32 = parser.Variable(name = u'int32', parser = parser,
+                value = parser.Type(parser = parser, value = np.int32)),
+            izip = parser.Variable(name = u'izip', parser = parser),
+            law = parser.Variable(name = u'law', parser = parser,
+                value = parser.CompactNode(parser = parser)),
+            len = parser.Variable(name = u'len', parser = parser),
+            log = parser.Variable(name = u'log', parser = parser,
+                value = parser.Logger(parser = parser)),
+            MarginalRateTaxScale = parser.Variable(name = u'MarginalRateTaxScale', parser = parser),
+            max = parser.Variable(name = u'max', parser = parser),
+            max_ = parser.Variable(name = u'max_', parser = parser),
+            math = parser.Variable(name = u'math', parser = parser),
+            min_ = parser.Variable(name = u'min_', parser = parser),
+            not_ = parser.Variable(name = u'not_', parser = parser),
+            ones = parser.Variable(name = u'ones', parser = parser),
+            or_ = parser.Variable(name = u'or_', parser = parser),
+            original_busday_count = parser.Variable(name = u'original_busday_count', parser = parser),
+            PAC1 = parser.Variable(name = u'PAC1', parser = parser,
+                value = parser.Number(parser = parser, value = 2)),
+            PAC2 = parser.Variable(name = u'PAC2', parser = parser,
+                value = parser.Number(parser = parser, value = 3)),
+            PAC3 = parser.Variable(name = u'PAC3', parser = parser,
+                value = parser.Number(parser = parser, value = 4)),
+            PART = parser.Variable(name = u'PART', parser = parser,
+                value = parser.Number(parser = parser, value = 1)),
+            partial = parser.Variable(name = u'partial', parser = parser),
+            PREF = parser.Variable(name = u'PREF', parser = parser,
+                value = parser.Number(parser = parser, value = 0)),
+            round = parser.Variable(name = u'round', parser = parser),
+            round_ = parser.Variable(name = u'round_', parser = parser),
+            # scale_tax_scales = parser.Variable(name = u'scale_tax_scales', parser = parser),
+            SCOLARITE_COLLEGE = parser.Variable(name = u'SCOLARITE_COLLEGE', parser = parser,
+                value = parser.Number(parser = parser, value = 1)),
+            sorted = parser.Variable(name = u'sorted', parser = parser),
+            startswith = parser.Variable(name = u'startswith', parser = parser),
+            TAUX_DE_PRIME = parser.Variable(name = u'TAUX_DE_PRIME', parser = parser,
+                value = parser.Number(parser = parser, value = 1 / 4)),
+            # TaxScalesTree = parser.Variable(name = u'TaxScalesTree', parser = parser),
+            timedelta64 = parser.Variable(name = u'timedelta64', parser = parser),
+            ValueError = parser.Variable(name = u'ValueError', parser = parser),
+            VOUS = parser.Variable(name = u'VOUS', parser = parser,
+                value = parser.Number(parser = parser, value = 0)),
+            where = parser.Variable(name = u'where', parser = parser),
+            xor_ = parser.Variable(name = u'xor_', parser = parser),
+            zeros = parser.Variable(name = u'zeros', parser = parser),
+            zone_apl_by_depcom = parser.Variable(name = u'zone_apl_by_depcom', parser = parser),
+            ).iteritems()))
 
     @property
     def entity_class(self):
@@ -2822,7 +3068,17 @@ class Parser(conv.State):
             return None
         return self.tax_benefit_system.entity_class_by_key_plural[self.column.entity_key_plural]
 
+    def get_builtin_variable(self, name):
+        """Return the variable of a builtin name (numpy function, role, legislation, etc), or None."""
+        builtin_variable_by_name = self.builtin_variable_by_name
+        if builtin_variable_by_name is None:
+            # Builtins are built only once, when the first module needs them, and must never be modified.
+            self.builtin_variable_by_name = builtin_variable_by_name = self.build_builtin_variable_by_name()
+        return builtin_variable_by_name.get(name)
+
     def get_cell_wrapper(self, container = None, type = None):
+        import numpy as np
+
         wrapper_class = {
             None: self.Number,
             np.bool: self.Boolean,
@@ -2835,11 +3091,79 @@ class Parser(conv.State):
             return wrapper_class(container = container, parser = self, type = type)
         return wrapper_class(container = container, parser = self)
 
-    def parse_power(self, node, container = None):
-        assert isinstance(node, lib2to3.pytree.Base), "Invalid node:\n{}\n\n{}".format(repr(node),
+    def get_definition_node(self, definition):
+        """Return the lib2to3 node (classdef or funcdef) of a Python class or function.
+
+        The source file containing the definition is parsed only once per parser, and every class or function defined
+        at its top-level (decorated or not) shares the resulting tree. When the definition can't be found in this tree
+        (nested function, unparsable module, etc), only the source of the definition is parsed, without its
+        decorators.
+        """
+        source_lines, line_index = self.profile('source', inspect.findsource, definition)
+        definition_node_by_name = self.get_definition_node_by_name(self.profile('source', inspect.getsourcefile,
+            definition), source_lines)
+        node = definition_node_by_name.get(definition.__name__)
+        if node is not None:
+            # The source of a decorated definition starts at its first decorator.
+            first_node = node.parent if node.parent.type == symbols.decorated else node
+            if first_node.get_lineno() == line_index + 1:
+                return node
+
+        source = textwrap.dedent(''.join(inspect.getblock(source_lines[line_index:])))
+        node = self.parse_source(source)
+        assert node.type == symbols.file_input, "Unexpected file input type:\n{}\n\n{}".format(repr(node),
             unicode(node).encode('utf-8'))
-        assert isinstance(container, AbstractWrapper), "Invalid container {} for node:\n{}\n\n{}".format(container,
-            repr(node), unicode(node).encode('utf-8'))
+        children = node.children
+        assert len(children) == 2 and children[1].type == tokens.ENDMARKER, \
+            "Unexpected node children in:\n{}\n\n{}".format(repr(node), unicode(node).encode('utf-8'))
+        definition_node = children[0]
+        if definition_node.type == symbols.decorated:
+            definition_node = definition_node.children[-1]
+        assert definition_node.type in (symbols.classdef, symbols.funcdef), \
+            "Unexpected definition type:\n{}\n\n{}".format(repr(node), unicode(node).encode('utf-8'))
+        return definition_node
+
+    def get_definition_node_by_name(self, file_path, source_lines):
+        definition_node_by_name = self.definition_node_by_name_by_file_path.get(file_path)
+        if definition_node_by_name is None:
+            self.definition_node_by_name_by_file_path[file_path] = definition_node_by_name = {}
+            source = ''.join(source_lines)
+            if not source.endswith('\n'):
+                source += '\n'
+            try:
+                node = self.parse_source(source)
+            except (lib2to3.pgen2.parse.ParseError, lib2to3.pgen2.tokenize.TokenError):
+                # Module can't be parsed as a whole => Its definitions will be parsed one by one.
+                return definition_node_by_name
+            assert node.type == symbols.file_input, "Unexpected file input type:\n{}\n\n{}".format(repr(node),
+                unicode(node).encode('utf-8'))
+            for child in node.children:
+                if child.type == symbols.decorated:
+                    child = child.children[-1]
+                if child.type in (symbols.classdef, symbols.funcdef):
+                    definition_node_by_name.setdefault(child.children[1].value, child)
+        return definition_node_by_name
+
+    def get_file_input_node(self, node):
+        while node.parent is not None:
+            node = node.parent
+        assert node.type == symbols.file_input, "Unexpected file input type:\n{}\n\n{}".format(repr(node),
+            unicode(node).encode('utf-8'))
+        return node
+
+    def get_legislation_index(self):
+        legislation_index = self.legislation_index
+        if legislation_index is None:
+            self.legislation_index = legislation_index = legislation_indexes.LegislationIndex.from_legislation_json(
+                self.tax_benefit_system.get_legislation())
+        return legislation_index
+
+    def parse_power(self, node, container = None):
+        if self.strict:
+            assert isinstance(node, lib2to3.pytree.Base), "Invalid node:\n{}\n\n{}".format(repr(node),
+                unicode(node).encode('utf-8'))
+            assert isinstance(container, AbstractWrapper), "Invalid container {} for node:\n{}\n\n{}".format(
+                container, repr(node), unicode(node).encode('utf-8'))
 
         assert node.type == symbols.power, "Unexpected power type:\n{}\n\n{}".format(repr(node),
             unicode(node).encode('utf-8'))
@@ -2872,11 +3196,78 @@ class Parser(conv.State):
                 subject = self.Key.parse(subject, trailer, container = container, parser = self)
         return subject
 
+    def profile(self, phase, function, *args, **kwargs):
+        """Call a function, charging its duration to the given phase when the parser has a profiler."""
+        profiler = self.profiler
+        if profiler is None:
+            return function(*args, **kwargs)
+        return profiler.call(phase, function, *args, **kwargs)
+
+    def release_trees(self):
+        """In low-memory mode, replace the lib2to3 nodes of the wrappers with source spans, to free the trees.
+
+        To call once a column is processed. Trees are parsed again when a released node is needed: to parse the body of
+        a function at its next call (see AbstractWrapper.get_node) or to print a node in an error message.
+        """
+        if not self.low_memory:
+            return
+        source_by_tree_id = dict(
+            (id(tree), source)
+            for source, tree in self.parsed_tree_by_source.iteritems()
+            )
+        for wrapper in self.wrappers_with_node:
+            node = wrapper.node
+            if not isinstance(node, lib2to3.pytree.Base):
+                # Node has already been released.
+                continue
+            tree = node
+            while tree.parent is not None:
+                tree = tree.parent
+            wrapper.node = SourceSpan(node, source_by_tree_id[id(tree)], self)
+        del self.wrappers_with_node[:]
+        self.definition_node_by_name_by_file_path.clear()
+        self.parsed_tree_by_source.clear()
+
+    def reset_modules(self):
+        """Forget the state left by the parsing of a formula, before parsing the next one."""
+        if self.keep_modules:
+            # Keep module wrappers & their functions, but parse again the body of each function at its next call,
+            # because it depends on the arguments given by the formula.
+            for module in self.python_module_by_name.itervalues():
+                for function in module.iter_functions():
+                    function.reset()
+        else:
+            self.python_module_by_name.clear()
+        self.release_trees()
+
+    def parse_source(self, source):
+        """Parse a Python source into a lib2to3 tree, using the persistent trees cache when there is one.
+
+        In low-memory mode, a source is parsed only once between two releases of the trees.
+        """
+        if self.low_memory:
+            node = self.parsed_tree_by_source.get(source)
+            if node is not None:
+                return node
+        trees_cache = self.trees_cache
+        if trees_cache is None:
+            node = self.profile('parse', self.driver.parse_string, source)
+        else:
+            grammar = self.driver.grammar
+            node = self.profile('parse', trees_cache.load, grammar, source)
+            if node is None:
+                node = self.profile('parse', self.driver.parse_string, source)
+                self.profile('parse', trees_cache.dump, grammar, source, node)
+        if self.low_memory:
+            self.parsed_tree_by_source[source] = node
+        return node
+
     def parse_suite(self, node, container = None):
-        assert isinstance(node, lib2to3.pytree.Base), "Invalid node:\n{}\n\n{}".format(repr(node),
-            unicode(node).encode('utf-8'))
-        assert isinstance(container, AbstractWrapper), "Invalid container {} for node:\n{}\n\n{}".format(container,
-            repr(node), unicode(node).encode('utf-8'))
+        if self.strict:
+            assert isinstance(node, lib2to3.pytree.Base), "Invalid node:\n{}\n\n{}".format(repr(node),
+                unicode(node).encode('utf-8'))
+            assert isinstance(container, AbstractWrapper), "Invalid container {} for node:\n{}\n\n{}".format(
+                container, repr(node), unicode(node).encode('utf-8'))
 
         if node.type == symbols.suite:
             children = node.children
@@ -2941,10 +3332,11 @@ class Parser(conv.State):
         return body
 
     def parse_value(self, node, container = None):
-        assert isinstance(node, lib2to3.pytree.Base), "Invalid node:\n{}\n\n{}".format(repr(node),
-            unicode(node).encode('utf-8'))
-        assert isinstance(container, AbstractWrapper), "Invalid container {} for node:\n{}\n\n{}".format(container,
-            repr(node), unicode(node).encode('utf-8'))
+        if self.strict:
+            assert isinstance(node, lib2to3.pytree.Base), "Invalid node:\n{}\n\n{}".format(repr(node),
+                unicode(node).encode('utf-8'))
+            assert isinstance(container, AbstractWrapper), "Invalid container {} for node:\n{}\n\n{}".format(
+                container, repr(node), unicode(node).encode('utf-8'))
 
         if node.type == symbols.and_expr:
             return self.AndExpression.parse(node, container = container, parser = self)
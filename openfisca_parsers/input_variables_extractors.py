@@ -26,17 +26,22 @@
 """Extract input variables from Python formulas using lib2to3."""
 
 
+import collections
+import hashlib
+import inspect
+import itertools
 import lib2to3.pgen2.driver
 import lib2to3.pygram
 import lib2to3.pytree
 import logging
 
-from openfisca_core import formulas
-
-from . import formulas_parsers_2to3
+from . import failures, formulas_parsers_2to3, legislation_indexes, parameter_tries
 
 
 log = logging.getLogger(__name__)
+# Classes of the guesses of the value returned by a function, that are kept in the summaries of its calls
+returned_classes_name = ('Array', 'CompactNode', 'DatedHolder', 'Holder', 'Instant', 'Period', 'String',
+    'UniformDictionary', 'UniformIterator')
 
 
 class Attribute(formulas_parsers_2to3.Attribute):
@@ -44,18 +49,27 @@ class Attribute(formulas_parsers_2to3.Attribute):
         super(Attribute, self).__init__(container = container, hint = hint, name = name, node = node, parser = parser,
             subject = subject)
 
-        compact_node = self.subject.guess(parser.CompactNode)
+        parser.profile('collect', self.collect_parameter)
+
+    def collect_parameter(self):
+        compact_node = self.subject.guess(self.parser.CompactNode)
         if compact_node is not None:
-            parser.parameters.add(tuple(compact_node.iter_names()) + (self.name,))
+            self.parser.parameters.add(itertools.chain(compact_node.iter_names(), (self.name,)))
 
 
 class Call(formulas_parsers_2to3.Call):
+    function_summary = None  # Summary of the called function for the arguments of the call (see Function.parse_call)
+
     def __init__(self, container = None, hint = None, keyword_argument = None, named_arguments = None, node = None,
             parser = None, positional_arguments = None, star_argument = None, subject = None):
         super(Call, self).__init__(container = container, hint = hint, keyword_argument = keyword_argument,
             named_arguments = named_arguments, node = node, parser = parser,
             positional_arguments = positional_arguments, star_argument = star_argument, subject = subject)
 
+        parser.profile('collect', self.collect_input_variable)
+
+    def collect_input_variable(self):
+        parser = self.parser
         if self.subject.name in ('calculate', 'calculate_add', 'calculate_add_divide', 'calculate_divide', 'compute',
                 'compute_add', 'compute_add_divide', 'compute_divide', 'get_array'):
             # TODO: Guess input_variable instead of assuming that it is a string with a "value" attribute.
@@ -81,11 +95,189 @@ class Call(formulas_parsers_2to3.Call):
             assert False, "Unexpected class for input variable: {}".format(input_variable)
 
 
+class Function(formulas_parsers_2to3.Function):
+    parsing_body = False  # True while the body is parsed to summarize a call (see summarize)
+    source_hash = None  # SHA-1 of the source of the function, computed at its first summarized call
+
+    def get_argument_key(self, value):
+        """Return a hashable description of the value of an argument, or None when it can't be described.
+
+        Two values with the same description give the same input variables & parameters to the function: variable
+        names come from strings (or from the name of the formula), parameters from legislation nodes. A value that
+        can't be described (like the formula itself, or the result of an expression) is assumed to depend on the
+        formula, whose name is added to its description.
+        """
+        parser = self.parser
+        while isinstance(value, parser.Variable):
+            value = value.value
+        if value is None or isinstance(value, (parser.Dictionary, parser.Function, parser.Lambda,
+                parser.UniformDictionary)):
+            return None
+        if isinstance(value, (parser.Number, parser.String)):
+            return (value.__class__.__name__, value.value)
+        if isinstance(value, (parser.List, parser.Tuple)):
+            items_key = tuple(
+                self.get_argument_key(item)
+                for item in value.value
+                )
+            return None if None in items_key else (value.__class__.__name__, items_key)
+        if isinstance(value, parser.Attribute) and value.name == '__name__':
+            # Assume this is "self.__class__.__name__", like Call.collect_input_variable.
+            return ('__name__', parser.column.name)
+        try:
+            compact_node = value.guess(parser.CompactNode)
+        except AssertionError:
+            return None
+        if compact_node is not None:
+            return ('CompactNode', tuple(compact_node.iter_names()))
+        if isinstance(value, (parser.Instant, parser.Period, parser.Simulation)):
+            # Same simulation & periods for every formula: they give no variable name nor parameter.
+            return (value.__class__.__name__,)
+        return (value.__class__.__name__, parser.column.name)
+
+    def get_call_key(self, call):
+        """Return the key of the summary of a call of the function, or None when the call can't be summarized.
+
+        Only module-level functions are summarized, because the other ones may use the variables of their container.
+        The key contains the hash of the source of the function, so that a changed function gets new summaries.
+        """
+        parser = self.parser
+        if not isinstance(self.container, parser.Module) or call.keyword_argument is not None \
+                or call.star_argument is not None:
+            return None
+        arguments_key = []
+        for argument in call.positional_arguments:
+            argument_key = self.get_argument_key(argument)
+            if argument_key is None:
+                return None
+            arguments_key.append(argument_key)
+        for name, argument in sorted(call.named_arguments.iteritems()):
+            argument_key = self.get_argument_key(argument)
+            if argument_key is None:
+                return None
+            arguments_key.append((name, argument_key))
+        if self.source_hash is None:
+            self.source_hash = hashlib.sha1(unicode(self.get_node()).encode('utf-8')).hexdigest()
+        return (self.container.python.__name__, self.name, self.source_hash, tuple(arguments_key))
+
+    def guess_call_return(self, call, expected):
+        summary = call.function_summary
+        if summary is None:
+            return super(Function, self).guess_call_return(call, expected)
+        assert summary.returned_by_expected is not None, "Function {} has no return statement".format(self.name)
+        return summary.returned_by_expected.get(expected)
+
+    def parse_call(self, call):
+        """Add the input variables & parameters of a call of the function to the ones of the formula.
+
+        The body of the function is parsed once for each distinct value of its arguments (see get_call_key). The next
+        calls with the same arguments, in this formula or in the next ones, reuse the summary of this parsing.
+        """
+        parser = self.parser
+        key = None if self.parsing_body else self.get_call_key(call)
+        if key is None:
+            # Parse the body once per formula, with the arguments of its first call. A recursive call does nothing.
+            super(Function, self).parse_call(call)
+            return
+        summary = parser.function_summary_by_key.get(key)
+        if summary is None:
+            parser.function_summary_by_key[key] = summary = self.summarize(call)
+        else:
+            parser.input_variables.update(summary.input_variables)
+            for parameter_name in summary.parameters_name:
+                parser.parameters.add(parameter_name.split(u'.'))
+            parser.functions_file_path.update(summary.functions_file_path)
+        call.function_summary = summary
+
+    def summarize(self, call):
+        """Parse the body of the function for the arguments of a call and return its summary."""
+        parser = self.parser
+        if self.body_parsed:
+            # The body has been parsed for the arguments of another call.
+            self.reset()
+        formula_input_variables = parser.input_variables
+        formula_parameters = parser.parameters
+        formula_functions_file_path = parser.functions_file_path
+        parser.input_variables = input_variables = set()
+        parser.parameters = parameters_trie = parameter_tries.ParameterTrie()
+        parser.functions_file_path = functions_file_path = set([inspect.getsourcefile(self.container.python)])
+        self.parsing_body = True
+        try:
+            super(Function, self).parse_call(call)
+        finally:
+            self.parsing_body = False
+            parser.input_variables = formula_input_variables
+            parser.parameters = formula_parameters
+            parser.functions_file_path = formula_functions_file_path
+            # Even when the parsing fails, the variables found before the failure are used by the formula.
+            formula_input_variables.update(input_variables)
+            parameters_name = list(parameters_trie.iter_names())
+            for parameter_name in parameters_name:
+                formula_parameters.add(parameter_name.split(u'.'))
+            formula_functions_file_path.update(functions_file_path)
+        if self.returns:
+            # Keep the guesses of the returned value instead of the Return wrappers, which would keep alive the
+            # wrappers (and the trees) of the parsed body, of its module and of the calling formula.
+            returned_by_expected = {}
+            for class_name in returned_classes_name:
+                expected = getattr(parser, class_name)
+                try:
+                    guessed = self.returns[-1].guess(expected)
+                except AssertionError:
+                    continue
+                if guessed is not None and guessed.container is None:
+                    returned_by_expected[expected] = guessed
+        else:
+            returned_by_expected = None
+        return FunctionSummary(
+            functions_file_path = functions_file_path,
+            input_variables = input_variables,
+            parameters_name = parameters_name,
+            returned_by_expected = returned_by_expected,
+            )
+
+
+class FunctionSummary(object):
+    """What a call of a module-level function adds to the formula calling it, for given values of its arguments"""
+    functions_file_path = None  # Source files of the function & of the functions it calls
+    input_variables = None  # Names of the variables used by the function & by the functions it calls
+    parameters_name = None  # Names of the parameters used by the function & by the functions it calls
+    returned_by_expected = None  # Guesses of the returned value, by expected class, or None without return statement
+
+    def __init__(self, functions_file_path = None, input_variables = None, parameters_name = None,
+            returned_by_expected = None):
+        self.functions_file_path = functions_file_path
+        self.input_variables = input_variables
+        self.parameters_name = parameters_name
+        self.returned_by_expected = returned_by_expected
+
+
 class Parser(formulas_parsers_2to3.Parser):
     Attribute = Attribute
     Call = Call
+    failure = None  # Failure of the last extraction, when the parsing of the formula stopped before its end
+    Function = Function
+    function_summary_by_key = None  # Summaries of the calls of module-level functions, by key (see Function)
+    results_cache = None  # Optional persistent cache of extracted input variables & parameters (see caches)
 
-    def get_input_variables_and_parameters(self, column):
+    def __init__(self, country_package = None, driver = None, keep_modules = False, legislation_index = None,
+            low_memory = False, profiler = None, results_cache = None, strict = True, tax_benefit_system = None,
+            trees_cache = None):
+        super(Parser, self).__init__(country_package = country_package, driver = driver, keep_modules = keep_modules,
+            legislation_index = legislation_index, low_memory = low_memory, profiler = profiler, strict = strict,
+            tax_benefit_system = tax_benefit_system, trees_cache = trees_cache)
+        self.function_summary_by_key = {}
+        self.results_cache = results_cache
+
+    def extract_input_variables_and_parameters(self, column):
+        """Return the input variables & parameters of a column.
+
+        When the parsing of the formula fails, return the variables found before the failure, which is kept in
+        self.failure.
+        """
+        from openfisca_core import formulas
+
+        self.failure = None
         formula_class = column.formula_class
         assert formula_class is not None, "Column {} has no formula".format(column.name)
         if issubclass(formula_class, formulas.AbstractEntityToEntity):
@@ -93,31 +285,143 @@ class Parser(formulas_parsers_2to3.Parser):
         if issubclass(formula_class, formulas.SimpleFormula) and formula_class.function is None:
             # Input variable
             return None, None
+        results_cache = self.results_cache
+        if results_cache is not None:
+            result_key = results_cache.get_key(
+                u'input_variables_and_parameters',
+                column.name,
+                hashlib.sha1(self.profile('source', inspect.getsource, formula_class)).hexdigest(),
+                self.get_legislation_hash(),
+                )
+            result = results_cache.load(result_key)
+            if result is not None:
+                input_variables, parameters, self.failure = result
+                return set(input_variables), set(parameters)
         self.column = column
+        self.functions_file_path = set()
         self.input_variables = input_variables = set()
-        self.parameters = parameters = set()
+        self.parameters = parameters_trie = parameter_tries.ParameterTrie()
         try:
-            self.FormulaClassFileInput.parse(formula_class, parser = self)
+            self.profile('build', self.FormulaClassFileInput.parse, formula_class, parser = self)
         except AssertionError:
             # When parsing fails, assume that all input variables have already been parsed.
-            pass
-        for names_tuple in parameters.copy():
-            for i in range(len(names_tuple)):
-                parameters.discard(names_tuple[:i])
-        parameters = set(
-            u'.'.join(names_tuple)
-            for names_tuple in parameters
-            )
+            self.failure = failures.get_failure('build')
+        except:
+            # Don't let the state of this formula leak into the next ones.
+            del self.column
+            del self.functions_file_path
+            del self.input_variables
+            del self.parameters
+            self.reset_modules()
+            raise
+        # Only the leaves of the trie are parameters: law.ir is not a parameter when law.ir.bareme is used.
+        parameters = set(parameters_trie.iter_names())
+        if results_cache is not None:
+            # The result depends on the source files of every module used to parse the formula.
+            if self.keep_modules:
+                # Modules are shared by all formulas => Keep only the ones whose functions have been called.
+                dependencies_file_path = set(
+                    inspect.getsourcefile(function.container.python)
+                    for module in self.python_module_by_name.itervalues()
+                    for function in module.iter_functions()
+                    if function.body_parsed
+                    )
+            else:
+                dependencies_file_path = set(
+                    inspect.getsourcefile(module.python)
+                    for module in self.python_module_by_name.itervalues()
+                    )
+            # Summarized calls reuse the functions parsed for previous formulas.
+            dependencies_file_path.update(self.functions_file_path)
+            dependencies_file_path.add(inspect.getsourcefile(formula_class))
+            results_cache.dump(result_key, [sorted(input_variables), sorted(parameters), self.failure],
+                dependencies_file_path = sorted(dependencies_file_path))
         del self.column
+        del self.functions_file_path
         del self.input_variables
         del self.parameters
-        self.python_module_by_name.clear()
+        self.reset_modules()
         return input_variables, parameters
 
+    def get_input_variables_and_parameters(self, column):
+        profiler = self.profiler
+        if profiler is None:
+            return self.extract_input_variables_and_parameters(column)
+        profiler.start_column(column.name, module_name = column.formula_class.__module__)
+        try:
+            return profiler.call('collect', self.extract_input_variables_and_parameters, column)
+        finally:
+            profiler.stop_column()
+
+    def get_legislation_hash(self):
+        # Extracted parameters depend only on the structure of the legislation, not on the values of its parameters.
+        return self.get_legislation_index().get_hash()
+
+    def get_legislation_index(self):
+        if self.legislation_index is None:
+            # Use the results cache, to avoid computing the legislation as long as its XML files don't change.
+            self.legislation_index = legislation_indexes.LegislationIndex.load(self.tax_benefit_system,
+                results_cache = self.results_cache)
+        return self.legislation_index
+
+    def reset_modules(self):
+        if not self.keep_modules:
+            # Summaries are valid only as long as the module wrappers of their functions are kept.
+            self.function_summary_by_key.clear()
+        super(Parser, self).reset_modules()
+
+
+def extract_all(tax_benefit_system, names = None, compact = False, extractor = None):
+    """Return the input variables & parameters of the formulas of the given variables (default: of every variable).
+
+    The columns are extracted grouped by the module of their formula, so that an extractor keeping its modules (the
+    default one) parses & wraps each module, and the definitions of its helper functions, only once.
+
+    Return the sorted names of the input variables & parameters of each variable (None, None for an input variable),
+    by name, or a dependency_graphs.CompactDependencyGraph when compact is True.
+    """
+    if extractor is None:
+        extractor = setup(tax_benefit_system, keep_modules = True)
+    column_by_name = tax_benefit_system.column_by_name
+    columns_by_module_name = collections.OrderedDict()
+    for name in (column_by_name.iterkeys() if names is None else names):
+        column = column_by_name[name]
+        columns_by_module_name.setdefault(column.formula_class.__module__, []).append(column)
+    names_by_name = {}
+    for columns in columns_by_module_name.itervalues():
+        for column in columns:
+            input_variables, parameters = extractor.get_input_variables_and_parameters(column)
+            if input_variables is None:
+                names_by_name[column.name] = (None, None)
+            else:
+                names_by_name[column.name] = (sorted(input_variables), sorted(parameters))
+    if compact:
+        from . import dependency_graphs
+
+        return dependency_graphs.CompactDependencyGraph.from_dicts(
+            dict(
+                (name, input_variables_name)
+                for name, (input_variables_name, parameters_name) in names_by_name.iteritems()
+                ),
+            dict(
+                (name, parameters_name)
+                for name, (input_variables_name, parameters_name) in names_by_name.iteritems()
+                ),
+            )
+    return names_by_name
+
 
-def setup(tax_benefit_system):
+def setup(tax_benefit_system, keep_modules = False, legislation_index = None, low_memory = False, profiler = None,
+        results_cache = None, strict = True, trees_cache = None):
     return Parser(
         driver = lib2to3.pgen2.driver.Driver(lib2to3.pygram.python_grammar, convert = lib2to3.pytree.convert,
             logger = log),
+        keep_modules = keep_modules,
+        legislation_index = legislation_index,
+        low_memory = low_memory,
+        profiler = profiler,
+        results_cache = results_cache,
+        strict = strict,
         tax_benefit_system = tax_benefit_system,
+        trees_cache = trees_cache,
         )
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+
+# OpenFisca -- A versatile microsimulation software
+# By: OpenFisca Team <contact@openfisca.fr>
+#
+# Copyright (C) 2011, 2012, 2013, 2014, 2015 OpenFisca Team
+# https://github.com/openfisca
+#
+# This file is part of OpenFisca.
+#
+# OpenFisca is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# OpenFisca is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Flattened index of the nodes of a legislation, to guess parameters without loading the JSON of the legislation"""
+
+
+import hashlib
+import inspect
+import json
+
+
+class LegislationIndex(object):
+    """Type & format of each node of a legislation, by path ("" for the root node, "ir.bareme" for a child, etc)"""
+    format_by_path = None  # Format of the parameters that have one ("boolean", "integer", etc)
+    hash = None  # Hash of the structure of the legislation, computed at first use (see get_hash)
+    type_by_path = None  # Type of each node: u'Node', u'Parameter' or u'Scale'
+
+    def __init__(self, type_by_path, format_by_path = None):
+        self.format_by_path = format_by_path if format_by_path is not None else {}
+        self.type_by_path = type_by_path
+
+    @classmethod
+    def from_legislation_json(cls, legislation_json):
+        format_by_path = {}
+        type_by_path = {}
+        # Walk the legislation without recursion.
+        nodes = [(u'', legislation_json)]
+        while nodes:
+            path, node_json = nodes.pop()
+            type_by_path[path] = node_json['@type']
+            node_format = node_json.get('format')
+            if node_format is not None:
+                format_by_path[path] = node_format
+            for child_name, child_json in (node_json.get('children') or {}).iteritems():
+                nodes.append((u'{}.{}'.format(path, child_name) if path else child_name, child_json))
+        return cls(type_by_path, format_by_path = format_by_path)
+
+    def get_hash(self):
+        if self.hash is None:
+            self.hash = hashlib.sha1(json.dumps([self.type_by_path, self.format_by_path], sort_keys = True)).hexdigest()
+        return self.hash
+
+    @classmethod
+    def load(cls, tax_benefit_system, results_cache = None):
+        """Return the index of the legislation of a tax-benefit system, using the persistent cache when there is one.
+
+        When the index is in cache and its XML files haven't changed, the legislation is not computed at all.
+        """
+        legislation_xml_info_list = tax_benefit_system.legislation_xml_info_list
+        if results_cache is None or not legislation_xml_info_list:
+            # Without XML files (legislation given as JSON, etc), there is nothing to check the cache entry against.
+            return cls.from_legislation_json(tax_benefit_system.get_legislation())
+        key = results_cache.get_key(u'legislation_index', legislation_xml_info_list)
+        value = results_cache.load(key)
+        if value is not None:
+            return cls(value['type_by_path'], format_by_path = value['format_by_path'])
+        self = cls.from_legislation_json(tax_benefit_system.get_legislation())
+        dependencies_file_path = [
+            xml_file_path
+            for xml_file_path, path_in_legislation_tree in legislation_xml_info_list
+            ]
+        if tax_benefit_system.preprocess_legislation is not None:
+            dependencies_file_path.append(inspect.getsourcefile(tax_benefit_system.preprocess_legislation))
+        results_cache.dump(key, dict(
+            format_by_path = self.format_by_path,
+            type_by_path = self.type_by_path,
+            ), dependencies_file_path = dependencies_file_path)
+        return self
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+
+# OpenFisca -- A versatile microsimulation software
+# By: OpenFisca Team <contact@openfisca.fr>
+#
+# Copyright (C) 2011, 2012, 2013, 2014, 2015 OpenFisca Team
+# https://github.com/openfisca
+#
+# This file is part of OpenFisca.
+#
+# OpenFisca is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# OpenFisca is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Trie of the paths of the parameters used by formulas"""
+
+
+class ParameterTrie(object):
+    """Trie of parameter paths, whose leaves are the parameters
+
+    A formula that accesses law.ir.bareme also accesses law.ir, but only uses the parameters below it: adding a path
+    that extends a leaf turns this leaf into a node, so only the longest paths are parameters.
+    """
+    child_by_name = None
+
+    def __init__(self):
+        self.child_by_name = {}
+
+    def add(self, names):
+        """Add the path of a parameter, given as an iterable of names."""
+        trie = self
+        for name in names:
+            child = trie.child_by_name.get(name)
+            if child is None:
+                trie.child_by_name[name] = child = ParameterTrie()
+            trie = child
+
+    @classmethod
+    def from_names(cls, names):
+        """Create a trie from the dotted names of parameters."""
+        self = cls()
+        for name in names:
+            self.add(name.split(u'.'))
+        return self
+
+    def get_subtrie(self, path):
+        """Return the trie below the given path (an iterable of names), or None when there is no such path."""
+        trie = self
+        for name in path:
+            trie = trie.child_by_name.get(name)
+            if trie is None:
+                return None
+        return trie
+
+    def iter_names(self, path = ()):
+        """Iterate, in the order of their paths, over the dotted names of the parameters below the given path.
+
+        For example, trie.iter_names(['prelevements_sociaux']) iterates over the names of the parameters of node
+        prelevements_sociaux.
+        """
+        path = list(path)
+        trie = self.get_subtrie(path)
+        if trie is None or trie is self and not trie.child_by_name:
+            # Missing paths & empty tries contain no parameter.
+            return
+        # Walk the trie without recursion.
+        remaining = [(u'.'.join(path), trie)]
+        while remaining:
+            name, trie = remaining.pop()
+            if not trie.child_by_name:
+                yield name
+                continue
+            for child_name, child in sorted(trie.child_by_name.iteritems(), reverse = True):
+                remaining.append((u'{}.{}'.format(name, child_name) if name else child_name, child))
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+
+
+# OpenFisca -- A versatile microsimulation software
+# By: OpenFisca Team <contact@openfisca.fr>
+#
+# Copyright (C) 2011, 2012, 2013, 2014, 2015 OpenFisca Team
+# https://github.com/openfisca
+#
+# This file is part of OpenFisca.
+#
+# OpenFisca is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# OpenFisca is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Profiler of the time spent in each phase of the parsing, for each column & for each module"""
+
+
+import collections
+import time
+
+
+class Profiler(object):
+    """Accumulate the time spent in each phase of the parsing of the columns.
+
+    Phases are nested (for example, the first formula of a module parses the whole module while building its wrappers).
+    The duration of a phase excludes the duration of the phases nested in it.
+    """
+    calls_count_by_phase = None
+    column_name = None  # Name of the column whose parsing is profiled, or None between columns
+    duration_by_phase = None
+    duration_by_phase_by_column_name = None
+    module_name_by_column_name = None
+    phases = None  # Stack of the phases being profiled, the last one being the current phase
+    start_time = None  # Time of the last change of the current phase
+
+    def __init__(self):
+        self.calls_count_by_phase = collections.OrderedDict()
+        self.duration_by_phase = collections.OrderedDict()
+        self.duration_by_phase_by_column_name = collections.OrderedDict()
+        self.module_name_by_column_name = {}
+        self.phases = []
+
+    def add_column(self, column_name, duration_by_phase, module_name = None):
+        """Add the durations of the phases of a column profiled by another profiler (in a worker process, etc)."""
+        column_duration_by_phase = self.duration_by_phase_by_column_name.setdefault(column_name,
+            collections.OrderedDict())
+        for phase, duration in duration_by_phase.iteritems():
+            column_duration_by_phase[phase] = column_duration_by_phase.get(phase, 0.0) + duration
+            self.duration_by_phase[phase] = self.duration_by_phase.get(phase, 0.0) + duration
+        if module_name is not None:
+            self.module_name_by_column_name[column_name] = module_name
+
+    def call(self, phase, function, *args, **kwargs):
+        self.enter(phase)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            self.exit()
+
+    def enter(self, phase):
+        phases = self.phases
+        if phases:
+            self.record(phases[-1])
+        else:
+            self.start_time = time.time()
+        phases.append(phase)
+        self.calls_count_by_phase[phase] = self.calls_count_by_phase.get(phase, 0) + 1
+
+    def exit(self):
+        self.record(self.phases.pop())
+
+    def get_duration_by_module_name(self):
+        duration_by_module_name = {}
+        for column_name, duration_by_phase in self.duration_by_phase_by_column_name.iteritems():
+            module_name = self.module_name_by_column_name.get(column_name)
+            if module_name is not None:
+                duration_by_module_name[module_name] = duration_by_module_name.get(module_name, 0.0) \
+                    + sum(duration_by_phase.itervalues())
+        return duration_by_module_name
+
+    def iter_report_lines(self, slowest_count = 20):
+        duration_by_phase = self.duration_by_phase
+        total_duration = sum(duration_by_phase.itervalues())
+        yield u'Time by phase:'
+        for phase, duration in sorted(duration_by_phase.iteritems(), key = lambda item: -item[1]):
+            # Calls are not counted for the phases profiled in other processes (see add_column).
+            calls_count = self.calls_count_by_phase.get(phase)
+            yield u'  {:<12} {:9.3f} s {:6.1%}{}'.format(phase, duration,
+                duration / total_duration if total_duration else 0,
+                u'  ({} calls)'.format(calls_count) if calls_count else u'')
+        yield u'  {:<12} {:9.3f} s'.format(u'total', total_duration)
+
+        duration_by_column_name = dict(
+            (column_name, sum(column_duration_by_phase.itervalues()))
+            for column_name, column_duration_by_phase in self.duration_by_phase_by_column_name.iteritems()
+            )
+        yield u'Slowest columns:'
+        for column_name, duration in sorted(duration_by_column_name.iteritems(),
+                key = lambda item: -item[1])[:slowest_count]:
+            yield u'  {:9.3f} s  {} ({}): {}'.format(
+                duration,
+                column_name,
+                self.module_name_by_column_name.get(column_name),
+                u', '.join(
+                    u'{} {:.3f} s'.format(phase, phase_duration)
+                    for phase, phase_duration in sorted(self.duration_by_phase_by_column_name[column_name].iteritems(),
+                        key = lambda item: -item[1])
+                    ),
+                )
+
+        yield u'Slowest modules:'
+        for module_name, duration in sorted(self.get_duration_by_module_name().iteritems(),
+                key = lambda item: -item[1])[:slowest_count]:
+            yield u'  {:9.3f} s  {}'.format(duration, module_name)
+
+    def record(self, phase):
+        """Add the time elapsed since the last change of phase to the given phase (and to the current column)."""
+        now = time.time()
+        duration = now - self.start_time
+        self.start_time = now
+        self.duration_by_phase[phase] = self.duration_by_phase.get(phase, 0.0) + duration
+        column_name = self.column_name
+        if column_name is not None:
+            column_duration_by_phase = self.duration_by_phase_by_column_name[column_name]
+            column_duration_by_phase[phase] = column_duration_by_phase.get(phase, 0.0) + duration
+
+    def start_column(self, column_name, module_name = None):
+        """Charge the time of the next phases to given column, until stop_column() is called."""
+        phases = self.phases
+        if phases:
+            self.record(phases[-1])
+        self.column_name = column_name
+        self.duration_by_phase_by_column_name.setdefault(column_name, collections.OrderedDict())
+        if module_name is not None:
+            self.module_name_by_column_name[column_name] = module_name
+
+    def stop_column(self):
+        phases = self.phases
+        if phases:
+            self.record(phases[-1])
+        self.column_name = None
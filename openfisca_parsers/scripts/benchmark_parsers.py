@@ -0,0 +1,580 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+# OpenFisca -- A versatile microsimulation software
+# By: OpenFisca Team <contact@openfisca.fr>
+#
+# Copyright (C) 2011, 2012, 2013, 2014, 2015 OpenFisca Team
+# https://github.com/openfisca
+#
+# This file is part of OpenFisca.
+#
+# OpenFisca is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# OpenFisca is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Benchmark the parsers on a synthetic corpus of formulas, reporting the duration of each phase & the peak memory."""
+
+
+import argparse
+import collections
+import gc
+import importlib
+import json
+import lib2to3.pgen2.driver
+import lib2to3.pgen2.tokenize
+import lib2to3.pygram
+import lib2to3.pytree
+import logging
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import StringIO
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+
+from openfisca_core import formulas
+
+from openfisca_parsers import formulas_parsers_2to3, input_variables_extractors, profilers
+from openfisca_parsers.scripts import formulas_to_julia
+
+
+app_name = os.path.splitext(os.path.basename(__file__))[0]
+benchmarks_name = ('input_variables', 'julia')
+corpus_package_name = 'openfisca_benchmark_country'
+log = logging.getLogger(app_name)
+phases_name = ('source', 'tokenize', 'parse', 'build', 'collect', 'guess', 'juliaize', 'emit')
+report_format_version = 5
+# Statements whose durations are measured at the start of a new interpreter (see measure_startup)
+startup_statement_by_name = collections.OrderedDict((
+    ('grammar', 'import lib2to3.pygram'),
+    ('formulas_parsers_2to3', 'from openfisca_parsers import formulas_parsers_2to3'),
+    ('input_variables_extractors', 'from openfisca_parsers import input_variables_extractors'),
+    ('dependency_graphs', 'from openfisca_parsers import dependency_graphs'),
+    ('formulas_to_julia', 'from openfisca_parsers.scripts import formulas_to_julia'),
+    ('tax_benefit_system', 'import {0}; {0}.init_country()()'.format(corpus_package_name)),
+    ))
+startup_source = """\
+import sys
+import time
+start_time = time.time()
+exec sys.argv[1]
+sys.stdout.write('\\n{}\\n'.format(repr(time.time() - start_time)))
+"""
+
+# Templates of the synthetic corpus, mimicking the style of the formulas of openfisca_france
+entities_source = """\
+# -*- coding: utf-8 -*-
+
+import collections
+
+from openfisca_core import entities
+
+
+class Familles(entities.AbstractEntity):
+    column_by_name = collections.OrderedDict()
+    index_for_person_variable_name = 'idfam'
+    key_plural = 'familles'
+    key_singular = 'famille'
+    label = u'Famille'
+    role_for_person_variable_name = 'quifam'
+    roles_key = ['parents', 'enfants']
+    symbol = 'fam'
+
+
+class Individus(entities.AbstractEntity):
+    column_by_name = collections.OrderedDict()
+    is_persons_entity = True
+    key_plural = 'individus'
+    key_singular = 'individu'
+    label = u'Personne'
+    symbol = 'ind'
+"""
+formula_body_template_by_kind = dict(
+    condition = u"""\
+        {first} = simulation.calculate('{first}', period)
+        {second} = simulation.calculate('{second}', period)
+        P = simulation.legislation_at(period.start).{node}
+        return period, ({first} >= P.seuil) * not_({second} > P.plafond)
+""",
+    family = u"""\
+        {first}_holder = simulation.compute('{first}', period)
+        {family} = simulation.calculate('{family}', period)
+        P = simulation.legislation_at(period.start).{node}
+        montant = self.sum_by_entity({first}_holder)
+        return period, where({family} > P.seuil, montant * P.taux, montant)
+""",
+    helper = u"""\
+        montant = simulation.calculate('{first}', period) + simulation.calculate('{second}', period)
+        P = simulation.legislation_at(period.start).{node}
+        return period, {helper}(montant, P.taux, P.plafond)
+""",
+    persons = u"""\
+        {first} = simulation.calculate('{first}', period)
+        {second} = simulation.calculate('{second}', period)
+        P = simulation.legislation_at(period.start).{node}
+        montant = max_({first} * P.taux - P.seuil, 0) + {second}
+        return period, where({second} > P.plafond, montant, 0)
+""",
+    )
+formula_template = u"""\
+
+
+class {name}(Variable):
+    column = {column}
+    entity_class = {entity}
+    label = u"Formule {name}"
+
+    def function(self, simulation, period):
+        period = period.start.offset('first-of', 'month').period('month')
+{body}"""
+input_variable_template = u"""\
+
+
+class {name}(Variable):
+    column = FloatCol
+    entity_class = {entity}
+    label = u"Variable d'entrée {name}"
+"""
+module_header_template = u"""\
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+
+from numpy import logical_not as not_, maximum as max_, minimum as min_, where
+from openfisca_core.columns import BoolCol, FloatCol
+from openfisca_core.variables import Variable
+
+from ..entities import Familles, Individus
+
+
+def {helper}(montant, taux, plafond):
+    montant_taux = montant * taux
+    return min_(montant_taux, plafond)
+"""
+package_template = """\
+# -*- coding: utf-8 -*-
+
+\"\"\"Synthetic country package generated by {app_name}\"\"\"
+
+import importlib
+import inspect
+import json
+import os
+
+from openfisca_core.taxbenefitsystems import TaxBenefitSystem
+from openfisca_core.variables import AbstractVariable
+
+from .entities import Familles, Individus
+
+
+modules_name = {modules_name!r}
+
+
+class BenchmarkTaxBenefitSystem(TaxBenefitSystem):
+    def __init__(self):
+        with open(os.path.join(os.path.dirname(__file__), 'legislation.json')) as legislation_file:
+            legislation_json = json.load(legislation_file)
+        super(BenchmarkTaxBenefitSystem, self).__init__([Familles, Individus], legislation_json = legislation_json)
+        for module_name in modules_name:
+            module = importlib.import_module('{{}}.model.{{}}'.format(__name__, module_name))
+            for name, value in sorted(module.__dict__.iteritems()):
+                if inspect.isclass(value) and issubclass(value, AbstractVariable) \\
+                        and value.__module__ == module.__name__:
+                    self.add_variable(value)
+
+    @property
+    def legislation_json(self):
+        return self.get_legislation()
+
+
+def init_country():
+    return BenchmarkTaxBenefitSystem
+"""
+
+
+class TimedDriver(lib2to3.pgen2.driver.Driver):
+    """lib2to3 driver profiling the tokenization of sources separately from their parsing"""
+    profiler = None
+
+    def __init__(self, grammar, convert = None, logger = None, profiler = None):
+        lib2to3.pgen2.driver.Driver.__init__(self, grammar, convert = convert, logger = logger)
+        self.profiler = profiler
+
+    def parse_string(self, text, debug = False):
+        tokens = self.profiler.call('tokenize', list,
+            lib2to3.pgen2.tokenize.generate_tokens(StringIO.StringIO(text).readline))
+        return self.parse_tokens(tokens, debug)
+
+
+def generate_corpus(corpus_dir, modules_count = 20, seed = 0, variables_count = 30):
+    """Write a country package of synthetic formulas, mimicking the style of openfisca_france, in corpus_dir.
+
+    Each module defines input variables, formulas of persons & of families (calling the formulas of the previous
+    modules, the legislation parameters and some helper functions) and a helper function.
+    """
+    randomizer = random.Random(seed)
+    package_dir = os.path.join(corpus_dir, corpus_package_name)
+    if os.path.exists(package_dir):
+        shutil.rmtree(package_dir)
+    os.makedirs(os.path.join(package_dir, 'model'))
+
+    nodes_count = max(modules_count, 1)
+    legislation_json = dict(
+        children = dict(
+            (
+                u'node_{:03d}'.format(node_index),
+                {
+                    '@type': u'Node',
+                    'children': dict(
+                        plafond = {
+                            '@type': u'Parameter',
+                            'format': u'integer',
+                            'unit': u'currency',
+                            'values': [dict(start = u'2010-01-01', value = randomizer.randint(1000, 50000))],
+                            },
+                        seuil = {
+                            '@type': u'Parameter',
+                            'format': u'integer',
+                            'unit': u'currency',
+                            'values': [dict(start = u'2010-01-01', value = randomizer.randint(0, 1000))],
+                            },
+                        taux = {
+                            '@type': u'Parameter',
+                            'format': u'rate',
+                            'values': [dict(start = u'2010-01-01', value = round(randomizer.random(), 3))],
+                            },
+                        ),
+                    },
+                )
+            for node_index in range(nodes_count)
+            ),
+        start = u'2010-01-01',
+        stop = u'2016-12-31',
+        )
+    legislation_json['@type'] = u'Node'
+    with open(os.path.join(package_dir, 'legislation.json'), 'w') as legislation_file:
+        json.dump(legislation_json, legislation_file, indent = 2, sort_keys = True)
+
+    modules_name = []
+    variables_name_by_entity = dict(familles = [], individus = [])
+    for module_index in range(modules_count):
+        module_name = u'module_{:03d}'.format(module_index)
+        modules_name.append(module_name)
+        helper_name = u'plafonner_{:03d}'.format(module_index)
+        sources = [module_header_template.format(helper = helper_name)]
+        for variable_index in range(variables_count):
+            variable_name = u'variable_{:03d}_{:03d}'.format(module_index, variable_index)
+            node_name = u'node_{:03d}'.format(randomizer.randrange(nodes_count))
+            persons_variables_name = variables_name_by_entity['individus']
+            families_variables_name = variables_name_by_entity['familles']
+            if len(persons_variables_name) < 4 or randomizer.random() < 0.2:
+                entity_key_plural = randomizer.choice(['individus', 'individus', 'familles'])
+                sources.append(input_variable_template.format(
+                    entity = u'Familles' if entity_key_plural == 'familles' else u'Individus',
+                    name = variable_name,
+                    ))
+                variables_name_by_entity[entity_key_plural].append(variable_name)
+                continue
+            kind = randomizer.choice(['condition', 'family', 'helper', 'persons', 'persons'])
+            if kind == 'family' and not families_variables_name:
+                kind = 'persons'
+            entity_key_plural = 'familles' if kind == 'family' else 'individus'
+            first_name, second_name = randomizer.sample(persons_variables_name, 2)
+            sources.append(formula_template.format(
+                body = formula_body_template_by_kind[kind].format(
+                    family = randomizer.choice(families_variables_name) if families_variables_name else None,
+                    first = first_name,
+                    helper = helper_name,
+                    node = node_name,
+                    second = second_name,
+                    ),
+                column = u'BoolCol' if kind == 'condition' else u'FloatCol',
+                entity = u'Familles' if entity_key_plural == 'familles' else u'Individus',
+                name = variable_name,
+                ))
+            variables_name_by_entity[entity_key_plural].append(variable_name)
+        with open(os.path.join(package_dir, 'model', module_name + '.py'), 'w') as module_file:
+            module_file.write(u''.join(sources).encode('utf-8'))
+
+    with open(os.path.join(package_dir, 'model', '__init__.py'), 'w') as module_file:
+        module_file.write('# -*- coding: utf-8 -*-\n')
+    with open(os.path.join(package_dir, 'entities.py'), 'w') as module_file:
+        module_file.write(entities_source)
+    with open(os.path.join(package_dir, '__init__.py'), 'w') as module_file:
+        module_file.write(package_template.format(app_name = app_name,
+            modules_name = [str(name) for name in modules_name]))
+
+
+def get_git_revision():
+    """Return the git revision of the parsers, or None when they are not in a git working copy."""
+    try:
+        with open(os.devnull, 'w') as null_file:
+            return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                cwd = os.path.dirname(os.path.abspath(formulas_parsers_2to3.__file__)), stderr = null_file).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def get_wrappers_size():
+    """Return the number of live wrappers and their total size in bytes (including their __dict__, if any)."""
+    wrappers_count = 0
+    wrappers_size = 0
+    for value in gc.get_objects():
+        if isinstance(value, formulas_parsers_2to3.AbstractWrapper):
+            wrappers_count += 1
+            wrappers_size += sys.getsizeof(value)
+            wrapper_dict = getattr(value, '__dict__', None)
+            if wrapper_dict is not None:
+                wrappers_size += sys.getsizeof(wrapper_dict)
+    return wrappers_count, wrappers_size
+
+
+def get_peak_rss():
+    """Return the peak resident set size of the current process, in kilobytes."""
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss // 1024 if sys.platform == 'darwin' else peak_rss
+
+
+def measure_startup(corpus_dir, repeat = 3):
+    """Return the fastest duration of each startup statement, each run in a new interpreter."""
+    environment = os.environ.copy()
+    environment['PYTHONPATH'] = os.pathsep.join(
+        [corpus_dir, os.path.dirname(os.path.dirname(os.path.abspath(formulas_parsers_2to3.__file__)))]
+        + ([environment['PYTHONPATH']] if environment.get('PYTHONPATH') else [])
+        )
+    duration_by_name = collections.OrderedDict()
+    for name, statement in startup_statement_by_name.iteritems():
+        durations = []
+        for run_index in range(repeat):
+            output = subprocess.check_output([sys.executable, '-c', startup_source, statement], env = environment)
+            # Keep only the last line, in case the statement prints something.
+            durations.append(float(output.splitlines()[-1]))
+        duration_by_name[name] = min(durations)
+        log.info(u'Startup {}: {:.3f} s'.format(name, duration_by_name[name]))
+    return duration_by_name
+
+
+def run_benchmark(benchmark_name, strict = True):
+    """Run a benchmark in the current process (a new worker process for each run) and return its results."""
+    country_package = importlib.import_module(corpus_package_name)
+    tax_benefit_system = country_package.init_country()()
+    formula_columns = [
+        column
+        for column in tax_benefit_system.column_by_name.itervalues()
+        if not (issubclass(column.formula_class, formulas.SimpleFormula) and column.formula_class.function is None)
+            and not issubclass(column.formula_class, formulas.AbstractEntityToEntity)
+        ]
+    profiler = profilers.Profiler()
+    driver = TimedDriver(lib2to3.pygram.python_grammar, convert = lib2to3.pytree.convert, logger = log,
+        profiler = profiler)
+    errors = []
+
+    # Only the outermost guess is profiled, because the guesses are deeply nested.
+    untimed_guess = formulas_parsers_2to3.AbstractWrapper.guess
+
+    def timed_guess(self, expected):
+        phases = profiler.phases
+        if phases and phases[-1] == 'guess':
+            return untimed_guess(self, expected)
+        return profiler.call('guess', untimed_guess, self, expected)
+
+    baseline_rss = get_peak_rss()
+    formulas_parsers_2to3.AbstractWrapper.guess = timed_guess
+    start_time = time.time()
+    try:
+        if benchmark_name == 'input_variables':
+            parser = input_variables_extractors.Parser(driver = driver, keep_modules = True, profiler = profiler,
+                strict = strict, tax_benefit_system = tax_benefit_system)
+            for column in formula_columns:
+                try:
+                    parser.get_input_variables_and_parameters(column)
+                except:
+                    errors.append(dict(name = column.name, traceback = traceback.format_exc()))
+                else:
+                    if parser.failure is not None:
+                        errors.append(dict(name = column.name, traceback = parser.failure['traceback']))
+        else:
+            assert benchmark_name == 'julia', benchmark_name
+            parser = formulas_to_julia.Parser(country_package = country_package, driver = driver, profiler = profiler,
+                strict = strict, tax_benefit_system = tax_benefit_system)
+            wrappers = []
+            for column in formula_columns:
+                parser.column = column
+                try:
+                    wrappers.append((column.name, profiler.call('build', parser.FormulaClassFileInput.parse,
+                        column.formula_class, parser = parser)))
+                except:
+                    errors.append(dict(name = column.name, traceback = traceback.format_exc()))
+            # Like formulas_to_julia, juliaize the formulas & the non-formula functions after parsing all of them.
+            wrappers.extend(parser.non_formula_function_by_name.iteritems())
+            for name, wrapper in wrappers:
+                try:
+                    julia_wrapper = profiler.call('juliaize', wrapper.juliaize)
+                    profiler.call('emit', julia_wrapper.source_julia, depth = 0)
+                except:
+                    errors.append(dict(name = name, traceback = traceback.format_exc()))
+    finally:
+        formulas_parsers_2to3.AbstractWrapper.guess = untimed_guess
+    duration = time.time() - start_time
+    # Measure the wrappers still referenced by the parser at the end of the run.
+    wrappers_count, wrappers_size = get_wrappers_size()
+    peak_rss = get_peak_rss()
+    return collections.OrderedDict((
+        ('calls_count_by_phase', collections.OrderedDict(
+            (phase, profiler.calls_count_by_phase.get(phase, 0))
+            for phase in phases_name
+            )),
+        ('duration', duration),
+        ('duration_by_phase', collections.OrderedDict(
+            (phase, profiler.duration_by_phase.get(phase, 0.0))
+            for phase in phases_name
+            )),
+        ('errors', errors),
+        ('formulas_count', len(formula_columns)),
+        ('baseline_rss_kb', baseline_rss),
+        ('peak_rss_kb', peak_rss),
+        ('peak_rss_increase_kb', peak_rss - baseline_rss),
+        ('wrappers_count', wrappers_count),
+        ('wrappers_size_kb', wrappers_size // 1024),
+        ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__)
+    parser.add_argument('-b', '--benchmark', action = 'append', choices = benchmarks_name, default = None,
+        help = u'name of a benchmark to run (may be repeated, default: all)')
+    parser.add_argument('--compare', default = None,
+        help = u'path of a previous JSON report, to print the relative changes of the durations')
+    parser.add_argument('--corpus-dir', default = None,
+        help = u'path of the directory where the synthetic country package is generated (default: a temporary '
+        u'directory)')
+    parser.add_argument('-m', '--modules', default = 20, type = int,
+        help = u'number of modules of the synthetic corpus (default: 20)')
+    parser.add_argument('-n', '--variables', default = 30, type = int,
+        help = u'number of variables of each module of the synthetic corpus (default: 30)')
+    parser.add_argument('-o', '--output', default = None,
+        help = u'path of the JSON file where to write the report (default: standard output)')
+    parser.add_argument('-r', '--repeat', default = 3, type = int,
+        help = u'number of runs of each benchmark, whose fastest one is reported (default: 3)')
+    parser.add_argument('-s', '--seed', default = 0, type = int,
+        help = u'seed of the random generator of the synthetic corpus (default: 0)')
+    parser.add_argument('--trusted', action = 'store_true', default = False,
+        help = u'benchmark the parsers without the structural validation of their wrappers')
+    parser.add_argument('-v', '--verbose', action = 'store_true', default = False, help = "increase output verbosity")
+    args = parser.parse_args()
+    logging.basicConfig(level = logging.DEBUG if args.verbose else logging.WARNING, stream = sys.stderr)
+
+    corpus_dir = args.corpus_dir if args.corpus_dir is not None else tempfile.mkdtemp(prefix = app_name + '-')
+    try:
+        generate_corpus(corpus_dir, modules_count = args.modules, seed = args.seed, variables_count = args.variables)
+        sys.path.insert(0, corpus_dir)
+        country_package = importlib.import_module(corpus_package_name)
+        tax_benefit_system = country_package.init_country()()
+        source_size = sum(
+            os.path.getsize(os.path.join(country_package.__path__[0], 'model', module_name + '.py'))
+            for module_name in country_package.modules_name
+            )
+
+        result_by_benchmark_name = collections.OrderedDict()
+        for benchmark_name in (args.benchmark or benchmarks_name):
+            runs = []
+            for run_index in range(args.repeat):
+                # Run each benchmark in a new process, to measure its own peak memory with cold caches.
+                pool = multiprocessing.Pool(1)
+                try:
+                    runs.append(pool.apply(run_benchmark, (benchmark_name, not args.trusted)))
+                finally:
+                    pool.close()
+                    pool.join()
+                log.info(u'Run {} of benchmark {}: {:.3f} s'.format(run_index + 1, benchmark_name,
+                    runs[-1]['duration']))
+            result = min(runs, key = lambda run: run['duration'])
+            for error in result['errors']:
+                log.warning(u'Benchmark {} failed on {}:\n{}'.format(benchmark_name, error['name'],
+                    error['traceback'].decode('utf-8')))
+            result['durations'] = [run['duration'] for run in runs]
+            result_by_benchmark_name[benchmark_name] = result
+        startup_duration_by_name = measure_startup(corpus_dir, repeat = args.repeat)
+    finally:
+        if args.corpus_dir is None:
+            shutil.rmtree(corpus_dir)
+
+    report = collections.OrderedDict((
+        ('format_version', report_format_version),
+        ('git_revision', get_git_revision()),
+        ('time', time.strftime('%Y-%m-%dT%H:%M:%S')),
+        ('environment', collections.OrderedDict((
+            ('platform', platform.platform()),
+            ('python', platform.python_version()),
+            ))),
+        ('strict', not args.trusted),
+        ('corpus', collections.OrderedDict((
+            ('modules_count', args.modules),
+            ('seed', args.seed),
+            ('source_size', source_size),
+            ('variables_count', len(tax_benefit_system.column_by_name)),
+            ))),
+        ('benchmarks', result_by_benchmark_name),
+        ('startup', startup_duration_by_name),
+        ))
+
+    if args.compare is not None:
+        with open(args.compare) as previous_report_file:
+            previous_report = json.load(previous_report_file)
+        if previous_report.get('corpus') != json.loads(json.dumps(report['corpus'])):
+            log.warning(u'Corpus of report {} differs from current corpus'.format(args.compare))
+        for benchmark_name, result in result_by_benchmark_name.iteritems():
+            previous_result = previous_report['benchmarks'].get(benchmark_name)
+            if previous_result is None:
+                continue
+            for phase, duration in [('total', result['duration'])] + result['duration_by_phase'].items():
+                previous_duration = previous_result['duration'] if phase == 'total' \
+                    else previous_result['duration_by_phase'].get(phase)
+                if not previous_duration:
+                    continue
+                sys.stderr.write(u'{:<16} {:<9} {:9.3f} s -> {:9.3f} s  {:+7.1%}\n'.format(benchmark_name, phase,
+                    previous_duration, duration, duration / previous_duration - 1).encode('utf-8'))
+            sys.stderr.write(u'{:<16} {:<9} {:9d} KB -> {:8d} KB {:+7.1%}\n'.format(benchmark_name, 'peak_rss',
+                previous_result['peak_rss_kb'], result['peak_rss_kb'],
+                float(result['peak_rss_kb']) / previous_result['peak_rss_kb'] - 1).encode('utf-8'))
+            if previous_result.get('wrappers_size_kb') and result['wrappers_size_kb']:
+                sys.stderr.write(u'{:<16} {:<9} {:9d} KB -> {:8d} KB {:+7.1%}\n'.format(benchmark_name, 'wrappers',
+                    previous_result['wrappers_size_kb'], result['wrappers_size_kb'],
+                    float(result['wrappers_size_kb']) / previous_result['wrappers_size_kb'] - 1).encode('utf-8'))
+        for name, duration in startup_duration_by_name.iteritems():
+            previous_duration = (previous_report.get('startup') or {}).get(name)
+            if not previous_duration:
+                continue
+            sys.stderr.write(u'startup {:<26} {:9.3f} s -> {:9.3f} s  {:+7.1%}\n'.format(name, previous_duration,
+                duration, duration / previous_duration - 1).encode('utf-8'))
+
+    if args.output is None:
+        json.dump(report, sys.stdout, indent = 2)
+        sys.stdout.write('\n')
+    else:
+        with open(args.output, 'w') as report_file:
+            json.dump(report, report_file, indent = 2)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,103 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+# OpenFisca -- A versatile microsimulation software
+# By: OpenFisca Team <contact@openfisca.fr>
+#
+# Copyright (C) 2011, 2012, 2013, 2014, 2015 OpenFisca Team
+# https://github.com/openfisca
+#
+# This file is part of OpenFisca.
+#
+# OpenFisca is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# OpenFisca is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Compute an evaluation order of the variables, grouped in levels that depend only on the previous levels."""
+
+
+import argparse
+import importlib
+import json
+import logging
+import os
+import sys
+
+from openfisca_parsers import caches, dependency_graphs, input_variables_extractors
+
+
+app_name = os.path.splitext(os.path.basename(__file__))[0]
+log = logging.getLogger(app_name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__)
+    parser.add_argument('--cache-dir', default = None,
+        help = u'path of the directory where parsed Python sources & extracted variables are cached between runs '
+        u'(default: no cache)')
+    parser.add_argument('--cache-max-size', default = 256, metavar = 'MB', type = int,
+        help = u'maximum size (in megabytes) of each cache of --cache-dir, whose least recently used entries are '
+        u'removed beyond it (default: 256)')
+    parser.add_argument('-c', '--country-package', default = 'openfisca_france',
+        help = u'name of the OpenFisca package to use for country-specific variables & formulas')
+    parser.add_argument('-g', '--graph', default = None,
+        help = u'path of a .npz dependency graph saved by extract_input_variables (default: parse the formulas)')
+    parser.add_argument('-o', '--output', default = None,
+        help = u'path of the JSON file where to write the evaluation order (default: standard output)')
+    parser.add_argument('-v', '--verbose', action = 'store_true', default = False, help = "increase output verbosity")
+    args = parser.parse_args()
+    logging.basicConfig(level = logging.DEBUG if args.verbose else logging.WARNING, stream = sys.stderr)
+
+    if args.graph is not None:
+        dependency_graph = dependency_graphs.CompactDependencyGraph.load(args.graph)
+    else:
+        country_package = importlib.import_module(args.country_package)
+        TaxBenefitSystem = country_package.init_country()
+        tax_benefit_system = TaxBenefitSystem()
+        if args.cache_dir is None:
+            results_cache = None
+            trees_cache = None
+        else:
+            results_cache = caches.ResultsCache(os.path.join(args.cache_dir, 'input_variables'),
+                max_size = args.cache_max_size * 1024 * 1024)
+            trees_cache = caches.TreesCache(os.path.join(args.cache_dir, 'trees'),
+                max_size = args.cache_max_size * 1024 * 1024)
+        dependency_graph = dependency_graphs.DependencyGraph(tax_benefit_system,
+            extractor = input_variables_extractors.setup(tax_benefit_system, keep_modules = True,
+                results_cache = results_cache, trees_cache = trees_cache))
+
+    levels, cycles = dependency_graph.get_evaluation_order()
+    for cycle in cycles:
+        log.warning(u'Dependency cycle between variables: {}'.format(u', '.join(cycle)))
+    evaluation_order = dict(
+        cycles = cycles,
+        levels = levels,
+        order = [
+            name
+            for level in levels
+            for name in level
+            ],
+        )
+    if args.output is None:
+        json.dump(evaluation_order, sys.stdout, indent = 2, sort_keys = True)
+        sys.stdout.write('\n')
+    else:
+        with open(args.output, 'w') as output_file:
+            json.dump(evaluation_order, output_file, indent = 2, sort_keys = True)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
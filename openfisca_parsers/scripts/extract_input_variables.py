@@ -28,51 +28,193 @@
 
 
 import argparse
+import collections
 import importlib
+import itertools
+import json
 import logging
+import multiprocessing
 import os
 import sys
+import time
 
-from openfisca_parsers import input_variables_extractors
+from openfisca_parsers import (caches, dependency_graphs, failures, input_variables_extractors, legislation_indexes,
+    profilers)
 
 
 app_name = os.path.splitext(os.path.basename(__file__))[0]
 log = logging.getLogger(app_name)
+extractor = None  # Extractor of the current process, set by setup_extractor()
+extraction_timeout = None  # Maximum duration (in seconds) of the extraction of a column, set by setup_extractor()
+
+
+def get_input_variables_and_parameters(column_name):
+    """Return the input variables & parameters of a column, with the duration of their extraction.
+
+    When the extraction fails or times out, the result contains the failure (see failures.get_failure) instead of the
+    variables. When the parsing of the formula stops before its end, the result contains both the variables found
+    before the failure and the failure.
+    """
+    column = extractor.tax_benefit_system.column_by_name[column_name]
+    result = dict(name = column_name)
+    start_time = time.time()
+    try:
+        result['input_variables'], result['parameters'] = failures.call_with_timeout(extraction_timeout,
+            extractor.get_input_variables_and_parameters, column)
+    except:
+        result['error'] = failures.get_failure('extract')
+    else:
+        if extractor.failure is not None:
+            result['error'] = extractor.failure
+    result['duration'] = time.time() - start_time
+    profiler = extractor.profiler
+    if profiler is not None:
+        result['duration_by_phase'] = profiler.duration_by_phase_by_column_name.get(column_name)
+    return result
+
+
+def setup_extractor(tax_benefit_system, legislation_index = None, low_memory = False, profile = False,
+        results_cache = None, strict = True, timeout = None, trees_cache = None):
+    global extraction_timeout, extractor
+    extraction_timeout = timeout
+    extractor = input_variables_extractors.setup(tax_benefit_system, keep_modules = True,
+        legislation_index = legislation_index, low_memory = low_memory,
+        profiler = profilers.Profiler() if profile else None, results_cache = results_cache, strict = strict,
+        trees_cache = trees_cache)
 
 
 def main():
     parser = argparse.ArgumentParser(description = __doc__)
+    parser.add_argument('--cache-dir', default = None,
+        help = u'path of the directory where parsed Python sources & extraction results are cached between runs '
+        u'(default: no cache)')
+    parser.add_argument('--cache-max-size', default = 256, metavar = 'MB', type = int,
+        help = u'maximum size (in megabytes) of each cache of --cache-dir, whose least recently used entries are '
+        u'removed beyond it (default: 256)')
     parser.add_argument('-c', '--country-package', default = 'openfisca_france',
         help = u'name of the OpenFisca package to use for country-specific variables & formulas')
+    parser.add_argument('-g', '--graph', default = None,
+        help = u'path of a .npz file where to save the compact dependency graph of the variables')
+    parser.add_argument('-j', '--jobs', default = 1, type = int,
+        help = u'number of worker processes extracting variables in parallel (default: 1)')
+    parser.add_argument('-k', '--keep-going', action = 'store_true', default = False,
+        help = u'continue after the formulas that fail, and print a summary of the failures')
+    parser.add_argument('-l', '--json-lines', action = 'store_true', default = False,
+        help = u'print a JSON object per column (one per line) as soon as its variables are extracted, instead of text')
+    parser.add_argument('--low-memory', action = 'store_true', default = False,
+        help = u'release the parsed Python trees after each formula and parse them again when needed, to reduce the '
+        u'memory used (slower without --cache-dir)')
     parser.add_argument('-n', '--name', default = None,
         help = u'name of the formula to extract variables from (default: all)')
+    parser.add_argument('--profile', const = 20, default = None, metavar = 'N', nargs = '?', type = int,
+        help = u'print the time spent in each phase and the N slowest columns & modules (default N: 20)')
+    parser.add_argument('-t', '--timeout', default = None, type = float,
+        help = u'maximum duration (in seconds) of the extraction of the variables of a formula (default: no limit)')
+    parser.add_argument('--trusted', action = 'store_true', default = False,
+        help = u'skip the structural validation of the wrappers built by the parser, to parse faster (errors in the '
+        u'formulas are still detected)')
     parser.add_argument('-v', '--verbose', action = 'store_true', default = False, help = "increase output verbosity")
     args = parser.parse_args()
+    output_file = sys.stdout
+    if args.json_lines:
+        # Keep the standard output for the JSON lines only: logs & diagnostics printed by the parser go to stderr.
+        sys.stdout = sys.stderr
     logging.basicConfig(level = logging.DEBUG if args.verbose else logging.WARNING, stream = sys.stdout)
 
     country_package = importlib.import_module(args.country_package)
     TaxBenefitSystem = country_package.init_country()
     tax_benefit_system = TaxBenefitSystem()
-
-    extractor = input_variables_extractors.setup(tax_benefit_system)
+    if args.cache_dir is None:
+        results_cache = None
+        trees_cache = None
+    else:
+        results_cache = caches.ResultsCache(os.path.join(args.cache_dir, 'input_variables'),
+            max_size = args.cache_max_size * 1024 * 1024)
+        trees_cache = caches.TreesCache(os.path.join(args.cache_dir, 'trees'),
+            max_size = args.cache_max_size * 1024 * 1024)
 
     if args.name is None:
-        for column in tax_benefit_system.column_by_name.itervalues():
-            print column.name
-            input_variables, parameters = extractor.get_input_variables_and_parameters(column)
+        columns = tax_benefit_system.column_by_name.values()
+    else:
+        columns = [tax_benefit_system.column_by_name[args.name]]
+    columns_name = [
+        column.name
+        for column in columns
+        ]
+    if args.jobs > 1 and len(columns) > 1:
+        # Index legislation before forking, so that workers don't compute it again.
+        legislation_index = legislation_indexes.LegislationIndex.load(tax_benefit_system, results_cache = results_cache)
+        pool = multiprocessing.Pool(args.jobs, initializer = setup_extractor,
+            initargs = (tax_benefit_system, legislation_index, args.low_memory, args.profile is not None,
+                results_cache, not args.trusted, args.timeout, trees_cache))
+        # Columns of the same module are consecutive, so give them to the same worker to reuse its module wrappers.
+        # imap returns the results in the order of the columns, whatever the worker that computed them.
+        results = pool.imap(get_input_variables_and_parameters, columns_name, chunksize = 16)
+    else:
+        pool = None
+        setup_extractor(tax_benefit_system, low_memory = args.low_memory, profile = args.profile is not None,
+            results_cache = results_cache, strict = not args.trusted, timeout = args.timeout,
+            trees_cache = trees_cache)
+        results = itertools.imap(get_input_variables_and_parameters, columns_name)
+
+    # Variables are kept in memory only when the dependency graph needs them.
+    input_variables_name_by_name = {} if args.graph is not None else None
+    parameters_name_by_name = {} if args.graph is not None else None
+    # Workers profile their own columns, whose durations are merged in a profiler of the main process.
+    profiler = (extractor.profiler if pool is None else profilers.Profiler()) if args.profile is not None else None
+    failures_summary = failures.Summary()
+    for column, result in itertools.izip(columns, results):
+        column_name = column.name
+        if pool is not None and result.get('duration_by_phase') is not None:
+            profiler.add_column(column_name, result['duration_by_phase'],
+                module_name = column.formula_class.__module__)
+        error = result.get('error')
+        failures_summary.add_column(column_name, failure = error)
+        input_variables = result.get('input_variables')
+        parameters = result.get('parameters')
+        if args.json_lines:
+            output_file.write(json.dumps(collections.OrderedDict((
+                ('name', column_name),
+                ('input_variables', sorted(input_variables) if input_variables is not None else None),
+                ('parameters', sorted(parameters) if parameters is not None else None),
+                ('duration', result['duration']),
+                ('duration_by_phase', result.get('duration_by_phase')),
+                ('error', error),
+                ))) + '\n')
+            # Let the consumers of the output process each column as soon as it is extracted.
+            output_file.flush()
+        elif error is not None and 'input_variables' not in result and not args.keep_going:
+            sys.stderr.write(error['traceback'].encode('utf-8'))
+            raise ValueError(u'Extraction of variables of formula {} failed'.format(column_name).encode('utf-8'))
+        else:
+            print column_name
+            if error is not None and args.keep_going:
+                print u' Error ({}): {}'.format(error['phase'], error['type'])
             if input_variables is not None:
                 print u' Input variables:', u', '.join(sorted(input_variables))
             if parameters:
                 print u' Parameters:', u', '.join(sorted(parameters))
-    else:
-        column = tax_benefit_system.column_by_name[args.name]
-        print column.name
-        input_variables, parameters = extractor.get_input_variables_and_parameters(column)
-        if input_variables is not None:
-            print u' Input variables:', u', '.join(sorted(input_variables))
-        if parameters:
-            print u' Parameters:', u', '.join(sorted(parameters))
-
+        # Keep the variables found before a failure of the parsing, like the extractor does.
+        if input_variables_name_by_name is not None and 'input_variables' in result:
+            input_variables_name_by_name[column_name] = input_variables
+            parameters_name_by_name[column_name] = parameters
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    if args.graph is not None:
+        compact_dependency_graph = dependency_graphs.CompactDependencyGraph.from_dicts(input_variables_name_by_name,
+            parameters_name_by_name)
+        compact_dependency_graph.save(args.graph)
+
+    if profiler is not None:
+        for line in profiler.iter_report_lines(slowest_count = args.profile):
+            sys.stderr.write(line.encode('utf-8') + '\n')
+
+    if args.keep_going:
+        for line in failures_summary.iter_report_lines():
+            sys.stderr.write(line.encode('utf-8') + '\n')
+        return 1 if failures_summary.failure_by_name else 0
     return 0
 
 
@@ -33,7 +33,7 @@ import logging
 import os
 import sys
 
-from openfisca_parsers import source_formulas_extractors
+from openfisca_parsers import caches, dependency_graphs, input_variables_extractors, profilers
 
 
 app_name = os.path.splitext(os.path.basename(__file__))[0]
@@ -42,10 +42,20 @@ log = logging.getLogger(app_name)
 
 def main():
     parser = argparse.ArgumentParser(description = __doc__)
+    parser.add_argument('--cache-dir', default = None,
+        help = u'path of the directory where parsed Python sources & extracted variables are cached between runs '
+        u'(default: no cache)')
+    parser.add_argument('--cache-max-size', default = 256, metavar = 'MB', type = int,
+        help = u'maximum size (in megabytes) of each cache of --cache-dir, whose least recently used entries are '
+        u'removed beyond it (default: 256)')
     parser.add_argument('-c', '--country-package', default = 'openfisca_france',
         help = u'name of the OpenFisca package to use for country-specific variables & formulas')
-    parser.add_argument('-n', '--name', required = True,
-        help = u'name of the formula to extract source formulas from (default: all)')
+    parser.add_argument('-d', '--dependents', action = 'store_true', default = False,
+        help = u'also list the formulas that depend on the given variables')
+    parser.add_argument('-n', '--name', action = 'append', required = True,
+        help = u'name of the formula to extract source formulas from (may be repeated)')
+    parser.add_argument('--profile', const = 20, default = None, metavar = 'N', nargs = '?', type = int,
+        help = u'print the time spent in each phase and the N slowest columns & modules (default N: 20)')
     parser.add_argument('-v', '--verbose', action = 'store_true', default = False, help = "increase output verbosity")
     args = parser.parse_args()
     logging.basicConfig(level = logging.DEBUG if args.verbose else logging.WARNING, stream = sys.stdout)
@@ -53,12 +63,35 @@ def main():
     country_package = importlib.import_module(args.country_package)
     TaxBenefitSystem = country_package.init_country()
     tax_benefit_system = TaxBenefitSystem()
-
-    source_formulas = source_formulas_extractors.extract_source_formulas(tax_benefit_system, args.name)
+    if args.cache_dir is None:
+        results_cache = None
+        trees_cache = None
+    else:
+        results_cache = caches.ResultsCache(os.path.join(args.cache_dir, 'input_variables'),
+            max_size = args.cache_max_size * 1024 * 1024)
+        trees_cache = caches.TreesCache(os.path.join(args.cache_dir, 'trees'),
+            max_size = args.cache_max_size * 1024 * 1024)
+
+    # The graph extracts the input variables of each formula only once, even when it is shared by several names.
+    profiler = profilers.Profiler() if args.profile is not None else None
+    dependency_graph = dependency_graphs.DependencyGraph(tax_benefit_system,
+        extractor = input_variables_extractors.setup(tax_benefit_system, keep_modules = True, profiler = profiler,
+            results_cache = results_cache, trees_cache = trees_cache))
+    source_formulas = dependency_graph.get_source_formulas(args.name)
     if source_formulas:
         print u' Source formulas:', u'\n'.join(
             '  - {}'.format(name)
             for name in sorted(source_formulas))
+    if args.dependents:
+        dependents = dependency_graph.get_dependents(args.name)
+        if dependents:
+            print u' Dependent formulas:', u'\n'.join(
+                '  - {}'.format(name)
+                for name in sorted(dependents))
+
+    if profiler is not None:
+        for line in profiler.iter_report_lines(slowest_count = args.profile):
+            sys.stderr.write(line.encode('utf-8') + '\n')
 
     return 0
 
@@ -29,6 +29,7 @@
 
 import argparse
 import codecs
+import imp
 import importlib
 import logging
 import os
@@ -54,19 +55,32 @@ def main():
     args = parser.parse_args()
     logging.basicConfig(level = logging.DEBUG if args.verbose else logging.WARNING, stream = sys.stdout)
 
-    country_package = importlib.import_module(args.country_package)
+    if args.computed:
+        country_package = importlib.import_module(args.country_package)
+    else:
+        # Input variables are extracted from the source files: don't import the country package & OpenFisca-Core.
+        country_package = None
 
     variables_tree = create_variables_tree(country_package, input_variables = args.input,
-        computed_variables = args.computed)
+        computed_variables = args.computed, country_package_name = args.country_package)
 
     print_variables_node(variables_tree)
 
     return 0
 
 
-def create_variables_tree(country_package, input_variables = False, computed_variables = False):
+def create_variables_tree(country_package, input_variables = False, computed_variables = False,
+        country_package_name = None):
+    """Return the tree of the modules of the country package, with their input and/or computed variables.
 
-    root_dir = os.path.dirname(country_package.__file__)
+    When only input variables are requested, country_package may be None: the package named country_package_name is
+    then found without being imported.
+    """
+    if country_package is None:
+        assert not computed_variables, "Computed variables require an imported country package"
+        root_dir = imp.find_module(country_package_name)[1]
+    else:
+        root_dir = os.path.dirname(country_package.__file__)
     variables_tree = {}
 
     if input_variables:
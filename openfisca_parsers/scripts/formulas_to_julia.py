@@ -31,22 +31,26 @@ import argparse
 import codecs
 import collections
 import datetime
+import hashlib
 import importlib
 import inspect
 import itertools
+import json
 import lib2to3.pgen2.driver  # , tokenize, token
 import lib2to3.pygram
 import lib2to3.pytree
 import logging
+import multiprocessing
 import os
 import sys
 import textwrap
 import traceback
+import types
 
 import numpy as np
-from openfisca_core import formulas
+from openfisca_core import base_functions, formulas
 
-from openfisca_parsers import formulas_parsers_2to3
+from openfisca_parsers import caches, failures, formulas_parsers_2to3, profilers
 
 
 app_name = os.path.splitext(os.path.basename(__file__))[0]
@@ -73,6 +77,8 @@ julia_file_header = textwrap.dedent(u"""\
     # along with this program.  If not, see <http://www.gnu.org/licenses/>.
     """)
 log = logging.getLogger(app_name)
+manifest_format_version = 1  # Increment it when the content of the manifest or the Julia code generation changes.
+manifest_filename = '.formulas_to_julia_manifest.json'
 name_by_role_by_entity_key_singular = dict(
     famille = {
         0: u'CHEF',
@@ -81,12 +87,27 @@ name_by_role_by_entity_key_singular = dict(
         0: u'VOUS',
         },
     )
+# Formulas that can't be easily converted to Julia and are handled as input variables
+skipped_formulas_name = (
+    # 'age',  # custom Julia implementation
+    # 'age_en_mois',  # custom Julia implementation
+    # 'cmu_c_plafond',  # custom Julia implementation
+    'coefficient_proratisation',
+    # 'nombre_jours_calendaires',  # custom Julia implementation
+    # 'remuneration_apprenti',
+    # 'zone_apl',  # custom Julia implementation
+    )
+worker_keep_going = False  # Continue after the formulas that fail in a worker process, set by setup_worker()
+worker_parser_arguments = None  # Arguments of the parsers of a worker process, set by setup_worker()
+worker_timeout = None  # Maximum duration (in seconds) of each conversion phase of a formula, set by setup_worker()
 
 
 # Abstract Wrappers
 
 
 class JuliaCompilerMixin(object):
+    __slots__ = ()
+
     def testize(self, allow_array = False):
         container = self.container
         parser = self.parser
@@ -147,7 +168,7 @@ class JuliaCompilerMixin(object):
                             ),
                         )
         assert False, "{} has a non-boolean value: {}\n{}".format(self.__class__.__name__,
-            unicode(self.node).encode('utf-8'), self.__dict__)
+            unicode(self.node).encode('utf-8'), self.get_attributes())
 
 
 # Concrete Wrappers
@@ -417,25 +438,25 @@ class Attribute(JuliaCompilerMixin, formulas_parsers_2to3.Attribute):
             assert key is not None
             key = unicode(key)
             if key not in ('iterkeys', 'iteritems', 'itervalues', 'keys', 'items', 'values'):
-                node_value = parent_node.value['children'].get(key)
-                if node_value is None:
+                legislation_index = parser.get_legislation_index()
+                node_path = parent_node.get_child_path(key)
+                if node_path not in legislation_index.type_by_path:
                     # Dirty hack for tax_hab formula.
                     if key == u'taux':
-                        node_value = parent_node.value['children']['taux_plein']
+                        node_path = parent_node.get_child_path(u'taux_plein')
                     else:
                         assert key in (u'taux_plein', u'taux_reduit'), key
-                        node_value = parent_node.value['children']['taux']
-                node_type = node_value['@type']
+                        node_path = parent_node.get_child_path(u'taux')
+                node_type = legislation_index.type_by_path[node_path]
                 if node_type == u'Node':
                     hint = parser.CompactNode(
                         is_reference = parent_node.is_reference,
                         name = unicode(key),
                         parent = parent_node,
                         parser = parser,
-                        value = node_value,
                         )
                 elif node_type == u'Parameter':
-                    if node_value.get('format') == 'boolean':
+                    if legislation_index.format_by_path.get(node_path) == 'boolean':
                         hint = parser.Boolean(
                             parser = parser,
                             )
@@ -560,8 +581,8 @@ class Boolean(JuliaCompilerMixin, formulas_parsers_2to3.Boolean):
 
 
 class Call(JuliaCompilerMixin, formulas_parsers_2to3.Call):
-    def guess(self, expected):
-        guessed = super(Call, self).guess(expected)
+    def compute_guess(self, expected):
+        guessed = super(Call, self).compute_guess(expected)
         if guessed is not None:
             return guessed
 
@@ -1005,7 +1026,6 @@ class Call(JuliaCompilerMixin, formulas_parsers_2to3.Call):
                             hint = parser.CompactNode(
                                 is_reference = bool(reference),
                                 parser = parser,
-                                value = parser.tax_benefit_system.get_legislation(),
                                 ),
                             named_arguments = dict(reference = reference) if reference is not None else None,
                             parser = parser,
@@ -1726,25 +1746,25 @@ class Key(JuliaCompilerMixin, formulas_parsers_2to3.Key):
                     )
             else:
                 key = unicode(key)
-                node_value = parent_node.value['children'].get(key)
-                if node_value is None:
+                legislation_index = parser.get_legislation_index()
+                node_path = parent_node.get_child_path(key)
+                if node_path not in legislation_index.type_by_path:
                     # Dirty hack for tax_hab formula.
                     if key == u'taux':
-                        node_value = parent_node.value['children']['taux_plein']
+                        node_path = parent_node.get_child_path(u'taux_plein')
                     else:
                         assert key in (u'taux_plein', u'taux_reduit'), key
-                        node_value = parent_node.value['children']['taux']
-                node_type = node_value['@type']
+                        node_path = parent_node.get_child_path(u'taux')
+                node_type = legislation_index.type_by_path[node_path]
                 if node_type == u'Node':
                     hint = parser.CompactNode(
                         is_reference = parent_node.is_reference,
                         name = unicode(key),
                         parent = parent_node,
                         parser = parser,
-                        value = node_value,
                         )
                 elif node_type == u'Parameter':
-                    if node_value.get('format') == 'boolean':
+                    if legislation_index.format_by_path.get(node_path) == 'boolean':
                         hint = parser.Boolean(
                             parser = parser,
                             )
@@ -2019,7 +2039,7 @@ class UniformDictionary(JuliaCompilerMixin, formulas_parsers_2to3.UniformDiction
         if julia:
             self.julia = julia
 
-    def guess(self, expected):
+    def compute_guess(self, expected):
         if self.julia:
             # When iterating on a Julia dictionary, the iterator is a (key, value) couple, not a key only (as in
             # Python).
@@ -2033,7 +2053,7 @@ class UniformDictionary(JuliaCompilerMixin, formulas_parsers_2to3.UniformDiction
                     parser = parser,
                     )
 
-        return super(UniformDictionary, self).guess(expected)
+        return super(UniformDictionary, self).compute_guess(expected)
 
 
 class Variable(JuliaCompilerMixin, formulas_parsers_2to3.Variable):
@@ -2359,11 +2379,25 @@ class Parser(formulas_parsers_2to3.Parser):
     Variable = Variable
     XorExpression = XorExpression
 
-    def __init__(self, country_package = None, driver = None, tax_benefit_system = None):
-        super(Parser, self).__init__(country_package = country_package, driver = driver,
-            tax_benefit_system = tax_benefit_system)
+    def __init__(self, country_package = None, driver = None, keep_modules = False, legislation_index = None,
+            low_memory = False, profiler = None, strict = True, tax_benefit_system = None, trees_cache = None):
+        super(Parser, self).__init__(country_package = country_package, driver = driver, keep_modules = keep_modules,
+            legislation_index = legislation_index, low_memory = low_memory, profiler = profiler, strict = strict,
+            tax_benefit_system = tax_benefit_system, trees_cache = trees_cache)
         self.non_formula_function_by_name = collections.OrderedDict()
 
+    def get_columns_state(self):
+        """Return the state shared by the conversions of the columns, to restore it when a conversion fails."""
+        return (
+            self.non_formula_function_by_name.copy(),
+            set(self.python_module_by_name),
+            [
+                function_wrapper
+                for function_wrapper in self.non_formula_function_by_name.itervalues()
+                if not function_wrapper.body_parsed
+                ],
+            )
+
     def juliaize_name(self, name):
         if name == u'function':
             name = u'func'
@@ -2371,6 +2405,33 @@ class Parser(formulas_parsers_2to3.Parser):
         #     name = name[:-len(u'_holder')]
         return name
 
+    def restore_columns_state(self, state):
+        """Forget the modules & functions wrapped by a failed conversion, so that they are not written to Julia files.
+
+        The functions that were already registered, but whose body has been parsed by the failed conversion, are
+        reset, to parse their body again at their next call.
+        """
+        function_wrapper_by_name, modules_name, unparsed_function_wrappers = state
+        added_functions_id = set(
+            id(function_wrapper)
+            for name, function_wrapper in self.non_formula_function_by_name.iteritems()
+            if function_wrapper_by_name.get(name) is not function_wrapper
+            )
+        for module_name in self.python_module_by_name.keys():
+            if module_name not in modules_name:
+                del self.python_module_by_name[module_name]
+        if added_functions_id:
+            # Remove the added functions from the kept modules, so that they are registered again at their next use.
+            for module in self.python_module_by_name.itervalues():
+                for name, variable in module.variable_by_name.items():
+                    if id(variable.value) in added_functions_id:
+                        del module.variable_by_name[name]
+        self.non_formula_function_by_name.clear()
+        self.non_formula_function_by_name.update(function_wrapper_by_name)
+        for function_wrapper in unparsed_function_wrappers:
+            if function_wrapper.body_parsed:
+                function_wrapper.reset()
+
     def source_julia_column_without_function(self, is_formula = False):
         column = self.column
         tax_benefit_system = self.tax_benefit_system
@@ -2382,6 +2443,7 @@ class Parser(formulas_parsers_2to3.Parser):
             'dtype',
             'end',
             'entity',
+            'entity_class',
             'entity_key_plural',
             'enum',
             'formula_class',
@@ -2513,11 +2575,11 @@ class Parser(formulas_parsers_2to3.Parser):
         if issubclass(formula_class, formulas.AbstractEntityToEntity):
             base_function_str = u'entity_to_entity_period_value'
         elif formula_class.base_function.func_name in (
-                formulas.last_duration_last_value.func_name,
-                formulas.missing_value.func_name,
+                base_functions.last_duration_last_value.func_name,
                 base_functions.permanent_default_value.func_name,
-                formulas.requested_period_default_value.func_name,
-                formulas.requested_period_last_value.func_name,
+                base_functions.requested_period_default_value.func_name,
+                base_functions.requested_period_last_value.func_name,
+                formulas.missing_value.func_name,
                 ):
             base_function_str = formula_class.base_function.func_name
         else:
@@ -2564,6 +2626,292 @@ class Parser(formulas_parsers_2to3.Parser):
                 )
 
 
+def get_used_modules_name(formula_class, country_package):
+    """Return the names of the Python modules whose wrappers may be used when parsing a formula class.
+
+    These are the module of the formula and the modules of the country package defining the functions that its methods
+    (and, recursively, these functions) may call, directly or as attributes of the modules they use. Every module of
+    the country package that they use is included, even when it isn't called.
+    """
+    country_package_dir = os.path.dirname(country_package.__file__)
+
+    def is_in_country_package(module):
+        # Functions & modules outside country package are never parsed.
+        module_file_path = getattr(module, '__file__', None)
+        return module_file_path is not None and module_file_path.startswith(country_package_dir)
+
+    python_module = inspect.getmodule(formula_class)
+    modules_name = set([python_module.__name__])
+    remaining_codes_and_globals = [
+        (function.__code__, python_module.__dict__)
+        for function in (
+            getattr(value, '__func__', value)
+            for value in vars(formula_class).itervalues()
+            )
+        if inspect.isfunction(function)
+        ]
+    visited_codes = set()
+    while remaining_codes_and_globals:
+        code, global_by_name = remaining_codes_and_globals.pop()
+        if code in visited_codes:
+            continue
+        visited_codes.add(code)
+        for constant in code.co_consts:
+            if isinstance(constant, types.CodeType):
+                # Nested function, lambda, etc
+                remaining_codes_and_globals.append((constant, global_by_name))
+        functions = []
+        for name in code.co_names:
+            value = global_by_name.get(name)
+            if inspect.isfunction(value):
+                functions.append(value)
+            elif inspect.ismodule(value) and is_in_country_package(value):
+                modules_name.add(value.__name__)
+                # The names of the attributes of the module (helpers.f(...)) are in co_names too.
+                functions.extend(
+                    attribute
+                    for attribute in (
+                        getattr(value, attribute_name, None)
+                        for attribute_name in code.co_names
+                        )
+                    if inspect.isfunction(attribute)
+                    )
+        for function in functions:
+            function_module = inspect.getmodule(function)
+            if function_module is None or not is_in_country_package(function_module):
+                continue
+            modules_name.add(function_module.__name__)
+            remaining_codes_and_globals.append((function.__code__, function.__globals__))
+    return modules_name
+
+
+def group_columns_by_used_modules(columns, country_package):
+    """Split formula columns into groups that don't use the same modules.
+
+    A parser keeps the state of the modules it has parsed (functions parsed at their first call, etc), so the Julia
+    source of a formula may depend on the formulas parsed before it that use the same modules. Each group can be
+    translated by a distinct parser, when its formulas are parsed in the order of the columns.
+
+    Return a list of (names of the columns, names of the modules used) couples.
+    """
+    group_by_module_name = {}
+    for column in columns:
+        modules_name = get_used_modules_name(column.formula_class, country_package)
+        group = None
+        for module_name in modules_name:
+            other_group = group_by_module_name.get(module_name)
+            if other_group is None or other_group is group:
+                continue
+            if group is None:
+                group = other_group
+                continue
+            # Merge the other group into the group.
+            group['columns'].extend(other_group['columns'])
+            group['modules_name'].update(other_group['modules_name'])
+            for other_module_name in other_group['modules_name']:
+                group_by_module_name[other_module_name] = group
+        if group is None:
+            group = dict(columns = [], modules_name = set())
+        group['columns'].append(column)
+        group['modules_name'].update(modules_name)
+        for module_name in modules_name:
+            group_by_module_name[module_name] = group
+
+    column_index_by_name = dict(
+        (column.name, column_index)
+        for column_index, column in enumerate(columns)
+        )
+    groups_columns_and_modules_name = []
+    for group in dict((id(group), group) for group in group_by_module_name.itervalues()).itervalues():
+        group_columns_name = [column.name for column in group['columns']]
+        group_columns_name.sort(key = lambda column_name: column_index_by_name[column_name])
+        groups_columns_and_modules_name.append((group_columns_name, sorted(group['modules_name'])))
+    # Start with the biggest groups to balance the load of the workers.
+    groups_columns_and_modules_name.sort(key = lambda group: (-len(group[0]), column_index_by_name[group[0][0]]))
+    return groups_columns_and_modules_name
+
+
+def get_file_hash(file_path):
+    with open(file_path, 'rb') as source_file:
+        return hashlib.sha1(source_file.read()).hexdigest()
+
+
+def get_legislation_structure(node_json):
+    """Return the types & formats of the nodes of a legislation, which are the only parts of it used by formulas."""
+    structure = {
+        '@type': node_json['@type'],
+        }
+    if 'format' in node_json:
+        structure['format'] = node_json['format']
+    if 'children' in node_json:
+        structure['children'] = dict(
+            (child_name, get_legislation_structure(child_json))
+            for child_name, child_json in node_json['children'].iteritems()
+            )
+    return structure
+
+
+def load_manifest(manifest_path):
+    """Return the translations of the groups of formulas saved by the previous incremental conversions, by key."""
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path) as manifest_file:
+        manifest = json.load(manifest_file)
+    if manifest.get('format_version') != manifest_format_version:
+        return {}
+    return manifest['group_translation_by_key']
+
+
+def save_manifest(manifest_path, group_translation_by_key, previous_group_translation_by_key):
+    """Save the translations of the groups of formulas converted by a run, merged with the previous translations.
+
+    A run converting only some formulas (--formula option) keeps the translations of the other groups. The previous
+    translations of the formulas converted by the run are outdated, so they are dropped. Only the translations without
+    errors are saved, to convert the failing formulas again at next run.
+    """
+    converted_columns_name = set(
+        translation['name']
+        for columns_translation, functions_translation in group_translation_by_key.itervalues()
+        for translation in columns_translation
+        )
+    merged_group_translation_by_key = dict(
+        (group_key, group_translation)
+        for group_key, group_translation in previous_group_translation_by_key.iteritems()
+        if not any(
+            translation['name'] in converted_columns_name
+            for translation in group_translation[0]
+            )
+        )
+    merged_group_translation_by_key.update(
+        (group_key, group_translation)
+        for group_key, group_translation in group_translation_by_key.iteritems()
+        if all(
+            'julia_source' in translation
+            for translation in itertools.chain(*group_translation)
+            )
+        )
+    with open(manifest_path, 'w') as manifest_file:
+        json.dump(dict(
+            format_version = manifest_format_version,
+            group_translation_by_key = merged_group_translation_by_key,
+            ), manifest_file)
+
+
+def setup_worker(country_package, tax_benefit_system, trees_cache, keep_going = False, low_memory = False,
+        profile = False, strict = True, timeout = None):
+    global worker_keep_going, worker_parser_arguments, worker_timeout
+    worker_keep_going = keep_going
+    worker_timeout = timeout
+    worker_parser_arguments = dict(
+        country_package = country_package,
+        low_memory = low_memory,
+        profiler = profilers.Profiler() if profile else None,
+        strict = strict,
+        tax_benefit_system = tax_benefit_system,
+        trees_cache = trees_cache,
+        )
+
+
+def translate_formulas(columns_name):
+    """Parse & juliaize formulas in a new parser, in a worker process.
+
+    Return the translation of each column and of the non-formula functions registered while parsing them. Stop at the
+    first formula that fails, like the serial conversion, unless worker_keep_going is set. The translation of a failing
+    formula or function contains its failure (see failures.get_failure). When profiling, the translation of each column
+    contains the duration of each phase of its conversion.
+    """
+    parser = Parser(
+        driver = lib2to3.pgen2.driver.Driver(lib2to3.pygram.python_grammar, convert = lib2to3.pytree.convert,
+            logger = log),
+        **worker_parser_arguments
+        )
+    profiler = parser.profiler
+    tax_benefit_system = parser.tax_benefit_system
+    columns_translation = []
+    function_wrappers = []
+    for column_name in columns_name:
+        column = tax_benefit_system.column_by_name[column_name]
+        # In low-memory mode, free the lib2to3 trees of the previous formula.
+        parser.release_trees()
+        parser.column = column
+        if profiler is not None:
+            profiler.start_column(column_name, module_name = column.formula_class.__module__)
+        columns_state = parser.get_columns_state()
+        function_wrapper_by_name = columns_state[0]
+        translation = dict(name = column_name)
+        try:
+            formula_class_wrapper = failures.call_with_timeout(worker_timeout, parser.profile, 'build',
+                parser.FormulaClassFileInput.parse, column.formula_class, parser = parser)
+        except:
+            translation['parse_error'] = traceback.format_exc()
+            translation['failure'] = failures.get_failure('build')
+            if worker_keep_going:
+                parser.restore_columns_state(columns_state)
+        else:
+            try:
+                translation['julia_source'] = failures.call_with_timeout(worker_timeout, parser.profile, 'juliaize',
+                    lambda: formula_class_wrapper.juliaize().source_julia(depth = 0))
+            except:
+                node = formula_class_wrapper.node
+                translation['juliaize_error'] = u"An exception occurred When juliaizing formula {}:\n{}\n\n{}\n{}" \
+                    .format(column.name, repr(node), unicode(node), traceback.format_exc().decode('utf-8'))
+                translation['failure'] = failures.get_failure('juliaize')
+                if worker_keep_going:
+                    parser.restore_columns_state(columns_state)
+            else:
+                translation['module_name'] = formula_class_wrapper.containing_module.python.__name__
+        # Record the changes of the non-formula functions, to merge them in the order of the columns.
+        functions_change = []
+        for name, function_wrapper in parser.non_formula_function_by_name.iteritems():
+            if function_wrapper_by_name.get(name) is not function_wrapper:
+                functions_change.append((name, len(function_wrappers)))
+                function_wrappers.append(function_wrapper)
+        for name in function_wrapper_by_name:
+            if name not in parser.non_formula_function_by_name:
+                functions_change.append((name, None))
+        translation['functions_change'] = functions_change
+        if profiler is not None:
+            profiler.stop_column()
+            translation['duration_by_phase'] = profiler.duration_by_phase_by_column_name[column_name]
+        columns_translation.append(translation)
+        if 'julia_source' not in translation and not worker_keep_going:
+            break
+
+    functions_translation = []
+    for function_wrapper in function_wrappers:
+        translation = dict(
+            module_name = function_wrapper.containing_module.python.__name__,
+            name = function_wrapper.name,
+            )
+        try:
+            translation['julia_source'] = failures.call_with_timeout(worker_timeout,
+                lambda: function_wrapper.juliaize().source_julia(depth = 0))
+        except:
+            node = function_wrapper.node
+            translation['juliaize_error'] = u"An exception occurred When juliaizing function {}:\n{}\n\n{}\n{}" \
+                .format(function_wrapper.name, repr(node), unicode(node), traceback.format_exc().decode('utf-8'))
+            translation['failure'] = failures.get_failure('juliaize')
+        functions_translation.append(translation)
+    return columns_translation, functions_translation
+
+
+def write_julia_file(julia_path, julia_source):
+    """Write a Julia source file, unless it already has this content, to keep the precompilation cache of Julia.
+
+    Return True when the file has been written.
+    """
+    if os.path.exists(julia_path):
+        with codecs.open(julia_path, 'r', encoding = 'utf-8') as julia_file:
+            if julia_file.read() == julia_source:
+                return False
+    julia_dir = os.path.dirname(julia_path)
+    if not os.path.exists(julia_dir):
+        os.makedirs(julia_dir)
+    with codecs.open(julia_path, 'w', encoding = 'utf-8') as julia_file:
+        julia_file.write(julia_source)
+    return True
+
+
 def generate_date_range_value_julia_source(date_range_value_json):
     for key in date_range_value_json.iterkeys():
         assert key in (
@@ -2581,6 +2929,69 @@ def generate_date_range_value_julia_source(date_range_value_json):
         )
 
 
+def generate_entity_to_entity_julia_source(column, parser = None):
+    """Return the Julia source of a column whose formula is an EntityToPerson or a PersonToEntity converter."""
+    formula_class = column.formula_class
+    tax_benefit_system = parser.tax_benefit_system
+    if issubclass(formula_class, formulas.PersonToEntity):
+        entity = tax_benefit_system.entity_class_by_key_plural[column.entity_key_plural]
+        if formula_class.operation is None:
+            role = formula_class.roles[0]
+            # print entity.key_singular, role
+            expression = u"single_person_in_entity({variable}, get_entity(variable), {role})".format(
+                role = name_by_role_by_entity_key_singular[entity.key_singular][role],
+                variable = formula_class.variable_name,
+                )
+        elif formula_class.operation == u'add':
+            roles = formula_class.roles
+            # print entity.key_singular, roles
+            roles = u', [{}]'.format(u', '.join(
+                name_by_role_by_entity_key_singular[entity.key_singular][role]
+                for role in roles
+                )) if roles else u''
+            expression = u"sum_person_in_entity({variable}, get_entity(variable){roles})".format(
+                roles = roles,
+                variable = formula_class.variable_name,
+                )
+        elif formula_class.operation == u'or':
+            roles = formula_class.roles
+            # print entity.key_singular, roles
+            roles = u', [{}]'.format(u', '.join(
+                name_by_role_by_entity_key_singular[entity.key_singular][role]
+                for role in roles
+                )) if roles else u''
+            expression = u"any_person_in_entity({variable}, get_entity(variable){roles})".format(
+                roles = roles,
+                variable = formula_class.variable_name,
+                )
+        else:
+            assert False, u"Unexpected operation"
+    else:
+        # Roles are the ones of the entity of the converted variable.
+        entity = tax_benefit_system.entity_class_by_key_plural[
+            tax_benefit_system.column_by_name[formula_class.variable_name].entity_key_plural]
+        roles = formula_class.roles
+        # print entity.key_singular, roles
+        roles = u', [{}]'.format(u', '.join(
+            name_by_role_by_entity_key_singular[entity.key_singular][role]
+            for role in roles
+            )) if roles else u''
+        expression = u"entity_to_person({variable}{roles})".format(
+            roles = roles,
+            variable = formula_class.variable_name,
+            )
+    return textwrap.dedent(u"""
+        {call} do simulation, variable, period
+          @calculate({variable}, period, accept_other_period = true)
+          return period, {expression}
+        end
+        """).format(
+        call = parser.source_julia_column_without_function(is_formula = True),
+        expression = expression,
+        variable = formula_class.variable_name,
+        )
+
+
 def generate_legislation_node_julia_source(node_json, check_start_date_julia_source = None,
         check_stop_date_julia_source = None, comments = None, descriptions = None, julia_source_by_path = None,
         path_fragments = None):
@@ -2812,10 +3223,32 @@ def generate_string_julia_source(s):
 def main():
     parser = argparse.ArgumentParser(description = __doc__)
     parser.add_argument('julia_package_dir', help = u'path of the directory of the OpenFisca Julia package')
+    parser.add_argument('--cache-dir', default = None,
+        help = u'path of the directory where parsed Python sources are cached between runs (default: no cache)')
+    parser.add_argument('--cache-max-size', default = 256, metavar = 'MB', type = int,
+        help = u'maximum size (in megabytes) of each cache of --cache-dir, whose least recently used entries are '
+        u'removed beyond it (default: 256)')
     parser.add_argument('-c', '--country-package', default = 'openfisca_france',
         help = u'name of the OpenFisca package to use for country-specific variables & formulas')
     parser.add_argument('-f', '--formula',
         help = u'name of the OpenFisca variable to convert (all are converted by default)')
+    parser.add_argument('-i', '--incremental', action = 'store_true', default = False,
+        help = u'convert only the formulas whose sources have changed since the previous incremental conversion')
+    parser.add_argument('-j', '--jobs', default = 1, type = int,
+        help = u'number of worker processes converting formulas in parallel (default: 1)')
+    parser.add_argument('-k', '--keep-going', action = 'store_true', default = False,
+        help = u'continue after the formulas that fail, handling them as input variables, and print a summary of the '
+        u'failures')
+    parser.add_argument('--low-memory', action = 'store_true', default = False,
+        help = u'release the parsed Python trees after each formula and parse them again when needed, to reduce the '
+        u'memory used (slower without --cache-dir)')
+    parser.add_argument('--profile', const = 20, default = None, metavar = 'N', nargs = '?', type = int,
+        help = u'print the time spent in each phase and the N slowest columns & modules (default N: 20)')
+    parser.add_argument('-t', '--timeout', default = None, type = float,
+        help = u'maximum duration (in seconds) of the parsing & of the juliaization of a formula (default: no limit)')
+    parser.add_argument('--trusted', action = 'store_true', default = False,
+        help = u'skip the structural validation of the wrappers built by the parser, to parse faster (errors in the '
+        u'formulas are still detected)')
     parser.add_argument('-v', '--verbose', action = 'store_true', default = False, help = "increase output verbosity")
     args = parser.parse_args()
     logging.basicConfig(level = logging.DEBUG if args.verbose else logging.WARNING, stream = sys.stdout)
@@ -2823,12 +3256,22 @@ def main():
     country_package = importlib.import_module(args.country_package)
     TaxBenefitSystem = country_package.init_country()
     tax_benefit_system = TaxBenefitSystem()
+    if args.cache_dir is None:
+        trees_cache = None
+    else:
+        trees_cache = caches.TreesCache(os.path.join(args.cache_dir, 'trees'),
+            max_size = args.cache_max_size * 1024 * 1024)
+    profiler = profilers.Profiler() if args.profile is not None else None
 
     parser = Parser(
         country_package = country_package,
         driver = lib2to3.pgen2.driver.Driver(lib2to3.pygram.python_grammar, convert = lib2to3.pytree.convert,
             logger = log),
+        low_memory = args.low_memory,
+        profiler = profiler,
+        strict = not args.trusted,
         tax_benefit_system = tax_benefit_system,
+        trees_cache = trees_cache,
         )
 
     legislation_json = tax_benefit_system.legislation_json
@@ -2842,22 +3285,117 @@ def main():
         julia_source_by_path = parameter_julia_source_by_path,
         path_fragments = [],
         )
-    julia_path = os.path.join(args.julia_package_dir, 'src', 'parameters.jl')
-    with codecs.open(julia_path, 'w', encoding = 'utf-8') as julia_file:
-        julia_file.write(julia_file_header)
-        julia_file.write(u'\n')
-        for parameter_julia_source in parameter_julia_source_by_path.itervalues():
-            julia_file.write(parameter_julia_source)
+    parser.profile('write', write_julia_file,
+        os.path.join(args.julia_package_dir, 'src', 'parameters.jl'),
+        u''.join([julia_file_header, u'\n'] + parameter_julia_source_by_path.values()),
+        )
 
     input_variable_definition_julia_source_by_name = collections.OrderedDict()
     julia_source_by_name_by_module_name = {}
     if args.formula:
         columns = [tax_benefit_system.column_by_name[args.formula]]
     else:
-        columns = tax_benefit_system.column_by_name.itervalues()
+        columns = tax_benefit_system.column_by_name.values()
+    if args.incremental or args.jobs > 1:
+        # Parse & juliaize groups of formulas separately (in worker processes, or reusing the translations of the
+        # previous incremental conversion), then merge their results in the order of the columns.
+        formula_columns = [
+            column
+            for column in columns
+            if not (issubclass(column.formula_class, formulas.SimpleFormula) and column.formula_class.function is None)
+                and not issubclass(column.formula_class, formulas.AbstractEntityToEntity)
+                and column.name not in skipped_formulas_name
+            ]
+        groups_columns_and_modules_name = group_columns_by_used_modules(formula_columns, country_package)
+        if args.incremental:
+            manifest_path = os.path.join(args.julia_package_dir, manifest_filename)
+            previous_group_translation_by_key = load_manifest(manifest_path)
+            # The translation of a group of formulas depends on the sources of its modules and of the converter, on the
+            # types of the legislation nodes and on the entities & types of the columns.
+            common_key = hashlib.sha1(json.dumps([
+                manifest_format_version,
+                get_file_hash(inspect.getsourcefile(formulas_parsers_2to3)),
+                get_file_hash(inspect.getsourcefile(sys.modules[__name__])),
+                get_legislation_structure(tax_benefit_system.get_legislation()),
+                sorted(
+                    (column.name, column.entity_key_plural, unicode(column.dtype))
+                    for column in tax_benefit_system.column_by_name.itervalues()
+                    ),
+                ], sort_keys = True)).hexdigest()
+            groups_key = [
+                hashlib.sha1(json.dumps([
+                    common_key,
+                    group_columns_name,
+                    [
+                        (module_name, get_file_hash(inspect.getsourcefile(sys.modules[module_name])))
+                        for module_name in group_modules_name
+                        ],
+                    ])).hexdigest()
+                for group_columns_name, group_modules_name in groups_columns_and_modules_name
+                ]
+            groups_translation = [
+                previous_group_translation_by_key.get(group_key)
+                for group_key in groups_key
+                ]
+        else:
+            groups_translation = [None] * len(groups_columns_and_modules_name)
+        changed_groups_index = [
+            group_index
+            for group_index, group_translation in enumerate(groups_translation)
+            if group_translation is None
+            ]
+        changed_groups_columns_name = [
+            groups_columns_and_modules_name[group_index][0]
+            for group_index in changed_groups_index
+            ]
+        if args.jobs > 1:
+            pool = multiprocessing.Pool(args.jobs, initializer = setup_worker,
+                initargs = (country_package, tax_benefit_system, trees_cache, args.keep_going, args.low_memory,
+                    profiler is not None, not args.trusted, args.timeout))
+            for group_index, group_translation in itertools.izip(changed_groups_index,
+                    pool.imap(translate_formulas, changed_groups_columns_name)):
+                groups_translation[group_index] = group_translation
+            pool.close()
+            pool.join()
+        else:
+            setup_worker(country_package, tax_benefit_system, trees_cache, keep_going = args.keep_going,
+                low_memory = args.low_memory, profile = profiler is not None, strict = not args.trusted,
+                timeout = args.timeout)
+            for group_index, group_columns_name in itertools.izip(changed_groups_index, changed_groups_columns_name):
+                groups_translation[group_index] = translate_formulas(group_columns_name)
+        if profiler is not None:
+            # Merge the durations of the columns converted by the workers, before they are saved in the manifest.
+            for group_index in changed_groups_index:
+                for translation in groups_translation[group_index][0]:
+                    profiler.add_column(translation['name'], translation.pop('duration_by_phase'),
+                        module_name = tax_benefit_system.column_by_name[translation['name']].formula_class.__module__)
+        if args.incremental:
+            log.info(u'Converted {} groups of formulas out of {}'.format(len(changed_groups_index),
+                len(groups_translation)))
+            save_manifest(manifest_path, dict(itertools.izip(groups_key, groups_translation)),
+                previous_group_translation_by_key)
+
+        formula_translation_by_name = {}
+        functions_translation_by_column_name = {}
+        for columns_translation, functions_translation in groups_translation:
+            for translation in columns_translation:
+                formula_translation_by_name[translation['name']] = translation
+                functions_translation_by_column_name[translation['name']] = [
+                    (name, functions_translation[function_index] if function_index is not None else None)
+                    for name, function_index in translation['functions_change']
+                    ]
+        function_translation_by_name = collections.OrderedDict()
+    else:
+        formula_translation_by_name = None
+    failures_summary = failures.Summary()
     for column in columns:
         print column.name
+        # In low-memory mode, free the lib2to3 trees of the previous formula.
+        parser.release_trees()
         parser.column = column
+        failures_summary.add_column(column.name)
+        if profiler is not None:
+            profiler.start_column(column.name, module_name = column.formula_class.__module__)
 
         column_formula_class = column.formula_class
         assert column_formula_class is not None
@@ -2867,110 +3405,122 @@ def main():
             continue
         if issubclass(column_formula_class, formulas.AbstractEntityToEntity):
             # EntityToPerson or PersonToEntity converters
-            if issubclass(column_formula_class, formulas.PersonToEntity):
-                entity = tax_benefit_system.entity_class_by_key_plural[column.entity_key_plural]
-                if column_formula_class.operation is None:
-                    role = column_formula_class.roles[0]
-                    # print entity.key_singular, role
-                    expression = u"single_person_in_entity({variable}, get_entity(variable), {role})".format(
-                        role = name_by_role_by_entity_key_singular[entity.key_singular][role],
-                        variable = column_formula_class.variable_name,
-                        )
-                elif column_formula_class.operation == u'add':
-                    roles = column_formula_class.roles
-                    # print entity.key_singular, roles
-                    roles = u', [{}]'.format(u', '.join(
-                        name_by_role_by_entity_key_singular[entity.key_singular][role]
-                        for role in roles
-                        )) if roles else u''
-                    expression = u"sum_person_in_entity({variable}, get_entity(variable){roles})".format(
-                        roles = roles,
-                        variable = column_formula_class.variable_name,
-                        )
-                elif column_formula_class.operation == u'or':
-                    roles = column_formula_class.roles
-                    # print entity.key_singular, roles
-                    roles = u', [{}]'.format(u', '.join(
-                        name_by_role_by_entity_key_singular[entity.key_singular][role]
-                        for role in roles
-                        )) if roles else u''
-                    expression = u"any_person_in_entity({variable}, get_entity(variable){roles})".format(
-                        roles = roles,
-                        variable = column_formula_class.variable_name,
-                        )
-                else:
-                    assert False, u"Unexpected operation"
-            else:
-                roles = column_formula_class.roles
-                # print entity.key_singular, roles
-                roles = u', [{}]'.format(u', '.join(
-                    name_by_role_by_entity_key_singular[entity.key_singular][role]
-                    for role in roles
-                    )) if roles else u''
-                expression = u"entity_to_person({variable}{roles})".format(
-                    roles = roles,
-                    variable = column_formula_class.variable_name,
-                    )
-            julia_source = textwrap.dedent(u"""
-                {call} do simulation, variable, period
-                  @calculate({variable}, period, accept_other_period = true)
-                  return period, {expression}
-                end
-                """).format(
-                call = parser.source_julia_column_without_function(is_formula = True),
-                expression = expression,
-                variable = column_formula_class.variable_name,
-                )
+            try:
+                julia_source = parser.profile('juliaize', generate_entity_to_entity_julia_source, column,
+                    parser = parser)
+            except:
+                if not args.keep_going:
+                    raise
+                failures_summary.add_failure(column.name, failures.get_failure('juliaize'))
+                input_variable_definition_julia_source_by_name[column.name] = \
+                    parser.source_julia_column_without_function()
+                continue
             module_name = inspect.getmodule(column_formula_class).__name__
             assert module_name.startswith('openfisca_france.model.')
             module_name = module_name[len('openfisca_france.model.'):]
             julia_source_by_name_by_module_name.setdefault(module_name, {})[column.name] = julia_source
             continue
 
-        if column.name in (
-                # 'age',  # custom Julia implementation
-                # 'age_en_mois',  # custom Julia implementation
-                # 'cmu_c_plafond',  # custom Julia implementation
-                'coefficient_proratisation',
-                # 'nombre_jours_calendaires',  # custom Julia implementation
-                # 'remuneration_apprenti',
-                # 'zone_apl',  # custom Julia implementation
-                ):
+        if column.name in skipped_formulas_name:
             # Skip formulas that can't be easily converted to Julia and handle them as input variables.
             input_variable_definition_julia_source_by_name[column.name] = parser.source_julia_column_without_function()
             continue
 
+        if formula_translation_by_name is not None:
+            translation = formula_translation_by_name.get(column.name)
+            if translation is None:
+                # The worker stopped before this formula, because a previous formula failed.
+                break
+            for name, function_translation in functions_translation_by_column_name[column.name]:
+                if function_translation is None:
+                    del function_translation_by_name[name]
+                else:
+                    function_translation_by_name[name] = function_translation
+            if 'parse_error' in translation and not args.keep_going:
+                # Stop conversion of columns, but write the existing results to Julia files.
+                sys.stderr.write(translation['parse_error'])
+                break
+            if 'juliaize_error' in translation and not args.keep_going:
+                print translation['juliaize_error'].encode('utf-8')
+                raise ValueError(u'Conversion of formula {} to Julia failed'.format(column.name).encode('utf-8'))
+            if 'failure' in translation:
+                failures_summary.add_failure(column.name, translation['failure'])
+                # Handle the failing formula as an input variable, so that the formulas using it are still converted.
+                input_variable_definition_julia_source_by_name[column.name] = \
+                    parser.source_julia_column_without_function()
+                continue
+            module_name = translation['module_name']
+            assert module_name.startswith('openfisca_france.model.')
+            module_name = module_name[len('openfisca_france.model.'):]
+            julia_source_by_name_by_module_name.setdefault(module_name, {})[column.name] = translation['julia_source']
+            continue
+
+        columns_state = parser.get_columns_state() if args.keep_going else None
         try:
-            formula_class_wrapper = parser.FormulaClassFileInput.parse(column_formula_class, parser = parser)
+            formula_class_wrapper = failures.call_with_timeout(args.timeout, parser.profile, 'build',
+                parser.FormulaClassFileInput.parse, column_formula_class, parser = parser)
         except:
-            # Stop conversion of columns, but write the existing results to Julia files.
-            traceback.print_exc()
-            break
+            if not args.keep_going:
+                # Stop conversion of columns, but write the existing results to Julia files.
+                traceback.print_exc()
+                break
+            failures_summary.add_failure(column.name, failures.get_failure('build'))
+            parser.restore_columns_state(columns_state)
+            # Handle the failing formula as an input variable, so that the formulas using it are still converted.
+            input_variable_definition_julia_source_by_name[column.name] = parser.source_julia_column_without_function()
+            continue
 
         try:
-            julia_source = formula_class_wrapper.juliaize().source_julia(depth = 0)
+            julia_source = failures.call_with_timeout(args.timeout, parser.profile, 'juliaize',
+                lambda: formula_class_wrapper.juliaize().source_julia(depth = 0))
         except:
             node = formula_class_wrapper.node
             if node is not None:
                 print "An exception occurred When juliaizing formula {}:\n{}\n\n{}".format(column.name, repr(node),
                     unicode(node).encode('utf-8'))
-            raise
+            if not args.keep_going:
+                raise
+            failures_summary.add_failure(column.name, failures.get_failure('juliaize'))
+            parser.restore_columns_state(columns_state)
+            input_variable_definition_julia_source_by_name[column.name] = parser.source_julia_column_without_function()
+            continue
 
         module_name = formula_class_wrapper.containing_module.python.__name__
         assert module_name.startswith('openfisca_france.model.')
         module_name = module_name[len('openfisca_france.model.'):]
         julia_source_by_name_by_module_name.setdefault(module_name, {})[column.name] = julia_source
 
+    if profiler is not None:
+        profiler.stop_column()
+
     # Add non-formula functions to modules.
+    if formula_translation_by_name is not None:
+        for function_translation in function_translation_by_name.itervalues():
+            if 'juliaize_error' in function_translation:
+                print function_translation['juliaize_error'].encode('utf-8')
+                if not args.keep_going:
+                    raise ValueError(u'Conversion of function {} to Julia failed'.format(function_translation['name'])
+                        .encode('utf-8'))
+                failures_summary.add_failure(function_translation['name'], function_translation['failure'])
+                continue
+            module_name = function_translation['module_name']
+            assert module_name.startswith('openfisca_france.model.')
+            module_name = module_name[len('openfisca_france.model.'):]
+            julia_source_by_name_by_module_name.setdefault(module_name, {})[function_translation['name']] = \
+                function_translation['julia_source']
     for function_wrapper in parser.non_formula_function_by_name.itervalues():
         try:
-            julia_source = function_wrapper.juliaize().source_julia(depth = 0)
+            julia_source = failures.call_with_timeout(args.timeout, parser.profile, 'juliaize',
+                lambda: function_wrapper.juliaize().source_julia(depth = 0))
         except:
             node = function_wrapper.node
             if node is not None:
                 print "An exception occurred When juliaizing function {}:\n{}\n\n{}".format(function_wrapper.name,
                     repr(node), unicode(node).encode('utf-8'))
-            raise
+            if not args.keep_going:
+                raise
+            failures_summary.add_failure(function_wrapper.name, failures.get_failure('juliaize'))
+            continue
 
         module_name = function_wrapper.containing_module.python.__name__
         assert module_name.startswith('openfisca_france.model.')
@@ -2982,34 +3532,42 @@ def main():
             for column_name, julia_source in sorted(julia_source_by_name.iteritems()):
                 print(julia_source)
     else:
-        julia_path = os.path.join(args.julia_package_dir, 'src', 'input_variables.jl')
-        with codecs.open(julia_path, 'w', encoding = 'utf-8') as julia_file:
-            julia_file.write(julia_file_header)
-            julia_file.write(u'\n')
-            for input_variable_definition_julia_source in input_variable_definition_julia_source_by_name.itervalues():
-                julia_file.write(u'\n')
-                julia_file.write(input_variable_definition_julia_source)
-                julia_file.write(u'\n')
-
-        julia_path = os.path.join(args.julia_package_dir, 'src', 'formulas.jl')
-        with codecs.open(julia_path, 'w', encoding = 'utf-8') as julia_file:
-            julia_file.write(julia_file_header)
-            julia_file.write(u'\n\n')
-            for module_name in sorted(julia_source_by_name_by_module_name.iterkeys()):
-                julia_file.write(u'include("formulas/{}.jl")\n'.format(module_name.replace(u'.', u'/')))
+        # Julia files are rewritten only when their content changes.
+        parser.profile('write', write_julia_file,
+            os.path.join(args.julia_package_dir, 'src', 'input_variables.jl'),
+            u''.join([julia_file_header, u'\n'] + [
+                u'\n{}\n'.format(input_variable_definition_julia_source)
+                for input_variable_definition_julia_source in (
+                    input_variable_definition_julia_source_by_name.itervalues())
+                ]),
+            )
+
+        parser.profile('write', write_julia_file,
+            os.path.join(args.julia_package_dir, 'src', 'formulas.jl'),
+            u''.join([julia_file_header, u'\n\n'] + [
+                u'include("formulas/{}.jl")\n'.format(module_name.replace(u'.', u'/'))
+                for module_name in sorted(julia_source_by_name_by_module_name.iterkeys())
+                ]),
+            )
 
         for module_name, julia_source_by_name in julia_source_by_name_by_module_name.iteritems():
             julia_relative_path = os.path.join(*module_name.split('.')) + '.jl'
-            julia_path = os.path.join(args.julia_package_dir, 'src', 'formulas', julia_relative_path)
-            julia_dir = os.path.dirname(julia_path)
-            if not os.path.exists(julia_dir):
-                os.makedirs(julia_dir)
-            with codecs.open(julia_path, 'w', encoding = 'utf-8') as julia_file:
-                julia_file.write(julia_file_header)
-                for column_name, julia_source in sorted(julia_source_by_name.iteritems()):
-                    julia_file.write(u'\n')
-                    julia_file.write(julia_source)
+            parser.profile('write', write_julia_file,
+                os.path.join(args.julia_package_dir, 'src', 'formulas', julia_relative_path),
+                u''.join([julia_file_header] + [
+                    u'\n{}'.format(julia_source)
+                    for column_name, julia_source in sorted(julia_source_by_name.iteritems())
+                    ]),
+                )
+
+    if profiler is not None:
+        for line in profiler.iter_report_lines(slowest_count = args.profile):
+            sys.stderr.write(line.encode('utf-8') + '\n')
 
+    if args.keep_going:
+        for line in failures_summary.iter_report_lines():
+            sys.stderr.write(line.encode('utf-8') + '\n')
+        return 1 if failures_summary.failure_by_name else 0
     return 0
 
 
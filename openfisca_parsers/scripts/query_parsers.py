@@ -0,0 +1,81 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+# OpenFisca -- A versatile microsimulation software
+# By: OpenFisca Team <contact@openfisca.fr>
+#
+# Copyright (C) 2011, 2012, 2013, 2014, 2015 OpenFisca Team
+# https://github.com/openfisca
+#
+# This file is part of OpenFisca.
+#
+# OpenFisca is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# OpenFisca is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Query the daemon started by serve_parsers.py about the formulas of a country package, and print its JSON result."""
+
+
+import argparse
+import json
+import logging
+import os
+import sys
+
+from openfisca_parsers import daemons
+
+
+app_name = os.path.splitext(os.path.basename(__file__))[0]
+log = logging.getLogger(app_name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__)
+    parser.add_argument('query', choices = daemons.Daemon.queries_name,
+        help = u'input variables & parameters of formulas, Julia translation of formulas, source formulas, etc')
+    parser.add_argument('-c', '--country-package', default = 'openfisca_france',
+        help = u'name of the OpenFisca package served by the daemon (used to find its default socket)')
+    parser.add_argument('-d', '--dependents', action = 'store_true', default = False,
+        help = u'also list the formulas that depend on the given variables (source_formulas query)')
+    parser.add_argument('-n', '--name', action = 'append', default = None,
+        help = u'name of a variable (may be repeated, required by the queries about formulas)')
+    parser.add_argument('-s', '--socket', default = None,
+        help = u'path of the Unix socket of the daemon (default: openfisca_parsers-COUNTRY_PACKAGE.sock in the '
+        u'temporary directory)')
+    parser.add_argument('-v', '--verbose', action = 'store_true', default = False, help = "increase output verbosity")
+    args = parser.parse_args()
+    logging.basicConfig(level = logging.DEBUG if args.verbose else logging.WARNING, stream = sys.stderr)
+
+    request = dict(query = args.query)
+    if args.query in ('input_variables', 'julia', 'source_formulas'):
+        if not args.name:
+            parser.error(u'query {} needs at least one variable name'.format(args.query))
+        request['names'] = args.name
+    if args.dependents:
+        request['dependents'] = True
+    response = daemons.send_request(
+        args.socket if args.socket is not None else daemons.get_default_socket_path(args.country_package),
+        request)
+    error = response.get('error')
+    if error is not None:
+        sys.stderr.write((error['traceback'] or u'{}: {}\n'.format(error['type'], error['message'])).encode('utf-8'))
+        return 1
+    json.dump(response['result'], sys.stdout, indent = 2)
+    sys.stdout.write('\n')
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,86 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+
+# OpenFisca -- A versatile microsimulation software
+# By: OpenFisca Team <contact@openfisca.fr>
+#
+# Copyright (C) 2011, 2012, 2013, 2014, 2015 OpenFisca Team
+# https://github.com/openfisca
+#
+# This file is part of OpenFisca.
+#
+# OpenFisca is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# OpenFisca is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Start a daemon keeping warm parsers of a country package, to answer queries of query_parsers.py in milliseconds."""
+
+
+import argparse
+import importlib
+import logging
+import os
+import sys
+
+from openfisca_parsers import caches, daemons
+
+
+app_name = os.path.splitext(os.path.basename(__file__))[0]
+log = logging.getLogger(app_name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__)
+    parser.add_argument('--cache-dir', default = None,
+        help = u'path of the directory where parsed Python sources & extracted variables are cached between runs '
+        u'(default: no cache)')
+    parser.add_argument('--cache-max-size', default = 256, metavar = 'MB', type = int,
+        help = u'maximum size (in megabytes) of each cache of --cache-dir, whose least recently used entries are '
+        u'removed beyond it (default: 256)')
+    parser.add_argument('-c', '--country-package', default = 'openfisca_france',
+        help = u'name of the OpenFisca package to use for country-specific variables & formulas')
+    parser.add_argument('-s', '--socket', default = None,
+        help = u'path of the Unix socket to listen on (default: openfisca_parsers-COUNTRY_PACKAGE.sock in the '
+        u'temporary directory)')
+    parser.add_argument('-t', '--timeout', default = None, type = float,
+        help = u'maximum duration (in seconds) of the parsing of a formula (default: no limit)')
+    parser.add_argument('-v', '--verbose', action = 'store_true', default = False, help = "increase output verbosity")
+    args = parser.parse_args()
+    logging.basicConfig(level = logging.DEBUG if args.verbose else logging.INFO, stream = sys.stderr)
+
+    country_package = importlib.import_module(args.country_package)
+    TaxBenefitSystem = country_package.init_country()
+    tax_benefit_system = TaxBenefitSystem()
+    if args.cache_dir is None:
+        results_cache = None
+        trees_cache = None
+    else:
+        results_cache = caches.ResultsCache(os.path.join(args.cache_dir, 'input_variables'),
+            max_size = args.cache_max_size * 1024 * 1024)
+        trees_cache = caches.TreesCache(os.path.join(args.cache_dir, 'trees'),
+            max_size = args.cache_max_size * 1024 * 1024)
+
+    daemon = daemons.Daemon(country_package, tax_benefit_system,
+        args.socket if args.socket is not None else daemons.get_default_socket_path(args.country_package),
+        results_cache = results_cache, timeout = args.timeout, trees_cache = trees_cache)
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -31,8 +31,6 @@ import lib2to3.pygram
 import lib2to3.pytree
 import logging
 
-from openfisca_core import formulas
-
 from . import formulas_parsers_2to3
 
 
@@ -75,6 +73,8 @@ class Parser(formulas_parsers_2to3.Parser):
     Call = Call
 
     def get_source_formulas(self, column):
+        from openfisca_core import formulas
+
         formula_class = column.formula_class
         assert formula_class is not None, "Column {} has no formula".format(column.name)
         if issubclass(formula_class, formulas.AbstractEntityToEntity):
@@ -91,12 +91,12 @@ class Parser(formulas_parsers_2to3.Parser):
             pass
         del self.column
         del self.source_formulas
-        self.python_module_by_name.clear()
+        self.reset_modules()
         return source_formulas
 
 
-def extract_source_formulas(tax_benefit_system, name):
-    extractor = setup(tax_benefit_system)
+def extract_source_formulas(tax_benefit_system, name, keep_modules = False, trees_cache = None):
+    extractor = setup(tax_benefit_system, keep_modules = keep_modules, trees_cache = trees_cache)
 
     source_formulas = set()
     remaining_names = set([name])
@@ -112,9 +112,11 @@ def extract_source_formulas(tax_benefit_system, name):
     return source_formulas
 
 
-def setup(tax_benefit_system):
+def setup(tax_benefit_system, keep_modules = False, trees_cache = None):
     return Parser(
         driver = lib2to3.pgen2.driver.Driver(lib2to3.pygram.python_grammar, convert = lib2to3.pytree.convert,
             logger = log),
+        keep_modules = keep_modules,
         tax_benefit_system = tax_benefit_system,
+        trees_cache = trees_cache,
         )
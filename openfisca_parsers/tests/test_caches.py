@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+
+# OpenFisca -- A versatile microsimulation software
+# By: OpenFisca Team <contact@openfisca.fr>
+#
+# Copyright (C) 2011, 2012, 2013, 2014, 2015 OpenFisca Team
+# https://github.com/openfisca
+#
+# This file is part of OpenFisca.
+#
+# OpenFisca is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# OpenFisca is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Tests of the persistent on-disk caches."""
+
+
+import os
+import shutil
+import tempfile
+
+from openfisca_parsers import caches
+
+
+def test_eviction_of_least_recently_used_files():
+    cache_dir = tempfile.mkdtemp()
+    try:
+        cache = caches.ResultsCache(cache_dir, max_size = 1000)
+        keys = ['key{}'.format(index) for index in range(11)]
+        for key in keys[:10]:
+            cache.write(key, 'x' * 100)
+        assert sorted(os.listdir(cache_dir)) == sorted(key + cache.suffix for key in keys[:10])
+        # Give the files increasing ages, then use the oldest one, so that key1 & key2 become the least recently used.
+        for index, key in enumerate(keys[:10]):
+            os.utime(cache.get_file_path(key), (1000000000 + index, 1000000000 + index))
+        assert cache.read(keys[0]) == 'x' * 100
+
+        # Writing past max_size removes the least recently used files, down to 90% of max_size.
+        cache.write(keys[10], 'x' * 100)
+        remaining_keys = [keys[0]] + keys[3:]
+        assert sorted(os.listdir(cache_dir)) == sorted(key + cache.suffix for key in remaining_keys)
+        assert cache.size == 900
+        assert cache.read(keys[1]) is None
+        assert cache.read(keys[2]) is None
+    finally:
+        shutil.rmtree(cache_dir)
+
+
+def test_results_keys_depend_on_parser_code():
+    cache_dir = tempfile.mkdtemp()
+    try:
+        cache = caches.ResultsCache(cache_dir)
+        key = cache.get_key(u'input_variables_and_parameters', u'var_a')
+        cache.dump(key, [[u'entree'], [], None])
+        assert cache.load(key) == [[u'entree'], [], None]
+
+        # Results extracted by another version of the parser are not reused.
+        cache = caches.ResultsCache(cache_dir)
+        cache.code_hash = cache.get_code_hash() + u'-modified'
+        other_key = cache.get_key(u'input_variables_and_parameters', u'var_a')
+        assert other_key != key
+        assert cache.load(other_key) is None
+    finally:
+        shutil.rmtree(cache_dir)
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+
+# OpenFisca -- A versatile microsimulation software
+# By: OpenFisca Team <contact@openfisca.fr>
+#
+# Copyright (C) 2011, 2012, 2013, 2014, 2015 OpenFisca Team
+# https://github.com/openfisca
+#
+# This file is part of OpenFisca.
+#
+# OpenFisca is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# OpenFisca is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Tests of the validation of the requests sent to the daemon."""
+
+
+from openfisca_parsers import daemons
+
+
+class FakeTaxBenefitSystem(object):
+    column_by_name = dict(a = None)
+
+
+def test_request_arguments():
+    daemon = daemons.Daemon(None, FakeTaxBenefitSystem(), None)
+    assert daemon.handle_request(dict(query = u'ping')) == dict(result = u'pong')
+    for request, message in (
+            (dict(query = u'ping', names = [u'a']), u'Unexpected arguments for query ping: names. Expected: none'),
+            (
+                dict(query = u'source_formulas', names = [u'a'], dependent = True),
+                u'Unexpected arguments for query source_formulas: dependent. Expected: names, dependents',
+                ),
+            (dict(query = u'input_variables'), u'Missing arguments for query input_variables: names'),
+            (dict(query = u'julia', names = [u'b']), u'Unknown variables: "b"'),
+            ):
+        error = daemon.handle_request(request)['error']
+        assert error['phase'] == u'request', (request, error)
+        assert error['message'] == message, (request, error)
+
+
+def test_interrupted_query():
+    # Interrupting the daemon while it answers a query stops it, instead of being answered as a failure.
+    class InterruptedDaemon(daemons.Daemon):
+        def query_ping(self):
+            raise KeyboardInterrupt
+
+    daemon = InterruptedDaemon(None, FakeTaxBenefitSystem(), None)
+    try:
+        daemon.handle_request(dict(query = u'ping'))
+    except KeyboardInterrupt:
+        pass
+    else:
+        raise AssertionError('KeyboardInterrupt answered as a failure')
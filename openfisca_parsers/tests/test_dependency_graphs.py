@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+
+
+# OpenFisca -- A versatile microsimulation software
+# By: OpenFisca Team <contact@openfisca.fr>
+#
+# Copyright (C) 2011, 2012, 2013, 2014, 2015 OpenFisca Team
+# https://github.com/openfisca
+#
+# This file is part of OpenFisca.
+#
+# OpenFisca is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# OpenFisca is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Tests of the evaluation order of the variables computed from their dependencies."""
+
+
+from openfisca_parsers import dependency_graphs
+
+
+def test_chain():
+    # c uses b, which uses a, which is an input variable.
+    input_variables_name_by_name = dict(b = [u'a'], c = [u'b'])
+    assert dependency_graphs.get_strongly_connected_components(input_variables_name_by_name) == [
+        [u'a'], [u'b'], [u'c']]
+    assert dependency_graphs.get_levels(input_variables_name_by_name) == ([[u'a'], [u'b'], [u'c']], [])
+
+
+def test_diamond():
+    # d uses b & c, which both use a.
+    input_variables_name_by_name = dict(b = [u'a'], c = [u'a'], d = [u'b', u'c'])
+    components = dependency_graphs.get_strongly_connected_components(input_variables_name_by_name)
+    assert sorted(components) == [[u'a'], [u'b'], [u'c'], [u'd']]
+    # Every variable comes after the variables it uses.
+    index_by_name = dict((component[0], index) for index, component in enumerate(components))
+    for name, input_variables_name in input_variables_name_by_name.iteritems():
+        for input_variable_name in input_variables_name:
+            assert index_by_name[input_variable_name] < index_by_name[name], (input_variable_name, name)
+    assert dependency_graphs.get_levels(input_variables_name_by_name) == ([[u'a'], [u'b', u'c'], [u'd']], [])
+
+
+def test_self_reference():
+    # A formula that uses its own value (for another period) is not a cycle.
+    input_variables_name_by_name = dict(a = [u'a', u'b'], c = [u'a'])
+    assert dependency_graphs.get_levels(input_variables_name_by_name) == ([[u'b'], [u'a'], [u'c']], [])
+
+
+def test_two_cycle():
+    # a & b use each other: they are reported as a cycle and put in the same level, after the variables they use.
+    input_variables_name_by_name = dict(a = [u'b', u'x'], b = [u'a'], c = [u'b'])
+    assert dependency_graphs.get_strongly_connected_components(input_variables_name_by_name) == [
+        [u'x'], [u'a', u'b'], [u'c']]
+    assert dependency_graphs.get_levels(input_variables_name_by_name) == (
+        [[u'x'], [u'a', u'b'], [u'c']],
+        [[u'a', u'b']],
+        )
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+
+
+# OpenFisca -- A versatile microsimulation software
+# By: OpenFisca Team <contact@openfisca.fr>
+#
+# Copyright (C) 2011, 2012, 2013, 2014, 2015 OpenFisca Team
+# https://github.com/openfisca
+#
+# This file is part of OpenFisca.
+#
+# OpenFisca is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# OpenFisca is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Tests of the wrappers built by the lib2to3-based parser."""
+
+
+import imp
+import lib2to3.pgen2.driver
+import lib2to3.pygram
+import lib2to3.pytree
+import os
+import shutil
+import tempfile
+import textwrap
+
+from openfisca_parsers import formulas_parsers_2to3
+
+
+symbols = formulas_parsers_2to3.symbols
+
+
+def get_parser(**kwargs):
+    return formulas_parsers_2to3.Parser(
+        driver = lib2to3.pgen2.driver.Driver(lib2to3.pygram.python_grammar, convert = lib2to3.pytree.convert),
+        **kwargs)
+
+
+def load_module_source(name, source):
+    """Import a module written in a temporary file, whose sources remain readable by inspect."""
+    temporary_dir = tempfile.mkdtemp()
+    try:
+        module_path = os.path.join(temporary_dir, name + '.py')
+        with open(module_path, 'w') as module_file:
+            module_file.write(textwrap.dedent(source))
+        return imp.load_source(name, module_path), temporary_dir
+    except:
+        shutil.rmtree(temporary_dir)
+        raise
+
+
+def test_cyclic_guess():
+    # A guess that depends on itself returns None instead of recursing, whether guesses are memoized or not.
+    for memoize_guesses in (True, False):
+        parser = formulas_parsers_2to3.Parser()
+        parser.memoize_guesses = memoize_guesses
+        a = parser.Variable(name = u'a', parser = parser)
+        b = parser.Variable(name = u'b', parser = parser, value = a)
+        a.value = b
+        assert a.guess(parser.Number) is None, memoize_guesses
+        assert b.guess(parser.Number) is None, memoize_guesses
+        assert parser.guess_depth == 0, memoize_guesses
+        assert parser.guess_cycle_depth is None, memoize_guesses
+
+        # Once the cycle is broken, the guess is computed again.
+        number = parser.Number(parser = parser, value = 1)
+        b.value = number
+        assert a.guess(parser.Number) is number, memoize_guesses
+
+
+def test_decorated_definition_nodes():
+    module, temporary_dir = load_module_source('openfisca_parsers_decorated_helpers', """\
+        def noop(function):
+            return function
+
+
+        @noop
+        def decorated_helper(x):
+            return x + 1
+
+
+        def make_nested_helper():
+            @noop
+            def nested_helper(x):
+                return x - 1
+            return nested_helper
+        """)
+    try:
+        parser = get_parser()
+        # A top-level decorated function is found in the tree of its module.
+        node = parser.get_definition_node(module.decorated_helper)
+        assert node.type == symbols.funcdef and node.children[1].value == u'decorated_helper', repr(node)
+        assert node.parent.type == symbols.decorated, repr(node.parent)
+        assert parser.get_file_input_node(node) is parser.get_file_input_node(parser.get_definition_node(module.noop))
+
+        # A nested decorated function is parsed alone, without its decorators.
+        node = parser.get_definition_node(module.make_nested_helper())
+        assert node.type == symbols.funcdef and node.children[1].value == u'nested_helper', repr(node)
+        assert parser.get_file_input_node(node) is not parser.get_file_input_node(
+            parser.get_definition_node(module.noop))
+    finally:
+        shutil.rmtree(temporary_dir)
+
+
+class Point(formulas_parsers_2to3.AbstractWrapper):
+    label = u'point'
+    x = None
+
+
+class LabeledPoint(Point):
+    label = u'labeled point'  # Overrides the default of Point
+    y = 0
+
+
+class ColorMixin(object):
+    __slots__ = ()
+
+    def get_color(self):
+        return self.color
+
+
+class ColoredPoint(ColorMixin, Point):
+    color = u'black'
+
+
+def test_wrapper_slots():
+    parser = formulas_parsers_2to3.Parser()
+    assert Point.__slots__ == (u'label', u'x')
+    # Attributes redeclared by a subclass keep the slot of their base class.
+    assert LabeledPoint.__slots__ == (u'y',)
+
+    point = Point(parser = parser)
+    assert not hasattr(point, '__dict__')
+    assert point.label == u'point'
+    assert point.x is None
+    point.x = 1
+    assert point.x == 1
+    assert Point(parser = parser).x is None
+
+    labeled_point = LabeledPoint(parser = parser)
+    assert labeled_point.label == u'labeled point'
+    assert labeled_point.x is None
+    assert labeled_point.y == 0
+    labeled_point.label = u'other label'
+    assert labeled_point.label == u'other label'
+    assert LabeledPoint(parser = parser).label == u'labeled point'
+
+    colored_point = ColoredPoint(parser = parser)
+    assert not hasattr(colored_point, '__dict__')
+    assert colored_point.get_color() == u'black'
+
+    # Undeclared attributes can't be set nor read.
+    for wrapper in (point, labeled_point, colored_point):
+        try:
+            wrapper.undeclared = 1
+        except AttributeError:
+            pass
+        else:
+            raise AssertionError('Undeclared attribute set on {}'.format(wrapper))
+        try:
+            wrapper.undeclared
+        except AttributeError:
+            pass
+        else:
+            raise AssertionError('Undeclared attribute read on {}'.format(wrapper))
+
+    # Only the attributes that are set are returned, not the defaults.
+    assert point.get_attributes() == dict(container = None, guessed_by_expected = None, hint = None, node = None,
+        parser = parser, x = 1)
+    assert labeled_point.get_attributes() == dict(container = None, guessed_by_expected = None, hint = None,
+        label = u'other label', node = None, parser = parser)
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+
+
+# OpenFisca -- A versatile microsimulation software
+# By: OpenFisca Team <contact@openfisca.fr>
+#
+# Copyright (C) 2011, 2012, 2013, 2014, 2015 OpenFisca Team
+# https://github.com/openfisca
+#
+# This file is part of OpenFisca.
+#
+# OpenFisca is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# OpenFisca is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Tests of the grouping & of the incremental conversion of formulas to Julia."""
+
+
+import importlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import textwrap
+
+from openfisca_parsers.scripts import formulas_to_julia
+
+
+package_name = 'openfisca_julia_country'
+source_by_module_name = {
+    '__init__': u'',
+    'helpers': u"""\
+        from . import rates
+
+
+        def double_rate(x):
+            return rates.rate(x) * 2
+        """,
+    'model': u"""\
+        from . import helpers
+
+
+        class formula_using_module_attribute(object):
+            def function(self, simulation, period):
+                return period, helpers.double_rate(1)
+
+
+        class formula_without_helper(object):
+            def function(self, simulation, period):
+                return period, 1
+        """,
+    'rates': u"""\
+        def rate(x):
+            return x * 0.5
+        """,
+    }
+temporary_dir = None
+
+
+def setup_module():
+    global temporary_dir
+    temporary_dir = tempfile.mkdtemp()
+    package_dir = os.path.join(temporary_dir, package_name)
+    os.makedirs(package_dir)
+    for module_name, source in source_by_module_name.iteritems():
+        with open(os.path.join(package_dir, module_name + '.py'), 'w') as module_file:
+            module_file.write(textwrap.dedent(source))
+    sys.path.insert(0, temporary_dir)
+
+
+def teardown_module():
+    sys.path.remove(temporary_dir)
+    for module_name in list(sys.modules):
+        if module_name == package_name or module_name.startswith(package_name + '.'):
+            del sys.modules[module_name]
+    shutil.rmtree(temporary_dir)
+
+
+def test_used_modules_name():
+    country_package = importlib.import_module(package_name)
+    model = importlib.import_module(package_name + '.model')
+    # A helper called as an attribute of its module is followed, like the functions it calls.
+    assert formulas_to_julia.get_used_modules_name(model.formula_using_module_attribute, country_package) == set([
+        package_name + '.helpers',
+        package_name + '.model',
+        package_name + '.rates',
+        ])
+    assert formulas_to_julia.get_used_modules_name(model.formula_without_helper, country_package) == set([
+        package_name + '.model',
+        ])
+
+
+def get_group_translation(columns_name, failing_columns_name = ()):
+    return [
+        [
+            dict(name = column_name) if column_name in failing_columns_name
+                else dict(julia_source = u'# {}'.format(column_name), name = column_name)
+            for column_name in columns_name
+            ],
+        [],
+        ]
+
+
+def test_manifest():
+    manifest_dir = tempfile.mkdtemp()
+    try:
+        manifest_path = os.path.join(manifest_dir, formulas_to_julia.manifest_filename)
+        assert formulas_to_julia.load_manifest(manifest_path) == {}
+
+        formulas_to_julia.save_manifest(manifest_path, dict(
+            key_a = get_group_translation([u'a1', u'a2']),
+            key_b = get_group_translation([u'b']),
+            key_c = get_group_translation([u'c'], failing_columns_name = [u'c']),
+            ), {})
+        group_translation_by_key = formulas_to_julia.load_manifest(manifest_path)
+        # Translations with errors are not kept, to convert their formulas again at next run.
+        assert sorted(group_translation_by_key) == [u'key_a', u'key_b']
+
+        # A run converting only a2 (--formula option), whose source has changed, replaces the translation of its
+        # previous group and keeps the other groups.
+        formulas_to_julia.save_manifest(manifest_path, dict(
+            key_a_changed = get_group_translation([u'a2']),
+            ), group_translation_by_key)
+        group_translation_by_key = formulas_to_julia.load_manifest(manifest_path)
+        assert sorted(group_translation_by_key) == [u'key_a_changed', u'key_b']
+        assert group_translation_by_key[u'key_b'] == get_group_translation([u'b'])
+
+        # A manifest written by another version of the converter is ignored.
+        with open(manifest_path, 'w') as manifest_file:
+            json.dump(dict(
+                format_version = formulas_to_julia.manifest_format_version + 1,
+                group_translation_by_key = group_translation_by_key,
+                ), manifest_file)
+        assert formulas_to_julia.load_manifest(manifest_path) == {}
+    finally:
+        shutil.rmtree(manifest_dir)
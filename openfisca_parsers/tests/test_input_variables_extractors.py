@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+
+
+# OpenFisca -- A versatile microsimulation software
+# By: OpenFisca Team <contact@openfisca.fr>
+#
+# Copyright (C) 2011, 2012, 2013, 2014, 2015 OpenFisca Team
+# https://github.com/openfisca
+#
+# This file is part of OpenFisca.
+#
+# OpenFisca is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# OpenFisca is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Tests of the extraction of input variables, on a small country package written in a temporary directory."""
+
+
+import importlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+from openfisca_parsers import formulas_parsers_2to3, input_variables_extractors
+
+
+country_package_name = 'openfisca_helper_country'
+country_package_source = u"""\
+# -*- coding: utf-8 -*-
+
+import json
+import os
+
+from openfisca_core.taxbenefitsystems import TaxBenefitSystem
+
+from .entities import Familles, Individus
+from .model import helpers
+
+
+class HelperTaxBenefitSystem(TaxBenefitSystem):
+    def __init__(self):
+        with open(os.path.join(os.path.dirname(__file__), 'legislation.json')) as legislation_file:
+            legislation_json = json.load(legislation_file)
+        super(HelperTaxBenefitSystem, self).__init__([Familles, Individus], legislation_json = legislation_json)
+        for name in ('entree', 'var_a', 'var_b', 'var_c'):
+            self.add_variable(getattr(helpers, name))
+
+    @property
+    def legislation_json(self):
+        return self.get_legislation()
+
+
+def init_country():
+    return HelperTaxBenefitSystem
+"""
+entities_source = u"""\
+# -*- coding: utf-8 -*-
+
+import collections
+
+from openfisca_core import entities
+
+
+class Familles(entities.AbstractEntity):
+    column_by_name = collections.OrderedDict()
+    index_for_person_variable_name = 'idfam'
+    key_plural = 'familles'
+    key_singular = 'famille'
+    label = u'Famille'
+    role_for_person_variable_name = 'quifam'
+    roles_key = ['parents', 'enfants']
+    symbol = 'fam'
+
+
+class Individus(entities.AbstractEntity):
+    column_by_name = collections.OrderedDict()
+    is_persons_entity = True
+    key_plural = 'individus'
+    key_singular = 'individu'
+    label = u'Personne'
+    symbol = 'ind'
+"""
+legislation_json = {
+    '@type': u'Node',
+    'children': {
+        'taux': {
+            '@type': u'Parameter',
+            'format': u'rate',
+            'values': [dict(start = u'2010-01-01', value = 0.5)],
+            },
+        },
+    'start': u'2010-01-01',
+    'stop': u'2016-12-31',
+    }
+module_source = u"""\
+# -*- coding: utf-8 -*-
+
+from openfisca_core.columns import FloatCol
+from openfisca_core.variables import Variable
+
+from ..entities import Individus
+
+
+def valeur_precedente(formule, simulation, period):
+    return simulation.calculate(formule.__class__.__name__, period.last_year)
+
+
+class entree(Variable):
+    column = FloatCol
+    entity_class = Individus
+    label = u"Variable d'entrée"
+
+
+class var_a(Variable):
+    column = FloatCol
+    entity_class = Individus
+    label = u"Formule utilisant une entrée & sa valeur précédente"
+
+    def function(self, simulation, period):
+        entree = simulation.calculate('entree', period)
+        return period, entree + valeur_precedente(self, simulation, period)
+
+
+class var_b(Variable):
+    column = FloatCol
+    entity_class = Individus
+    label = u"Formule utilisant sa valeur précédente"
+
+    def function(self, simulation, period):
+        return period, valeur_precedente(self, simulation, period)
+
+
+class var_c(Variable):
+    column = FloatCol
+    entity_class = Individus
+    label = u"Formule utilisant un paramètre"
+
+    def function(self, simulation, period):
+        entree = simulation.calculate('entree', period)
+        P = simulation.legislation_at(period.start)
+        return period, entree * P.taux
+"""
+tax_benefit_system = None
+temporary_dir = None
+
+
+def setup_module():
+    global tax_benefit_system, temporary_dir
+    temporary_dir = tempfile.mkdtemp()
+    package_dir = os.path.join(temporary_dir, country_package_name)
+    os.makedirs(os.path.join(package_dir, 'model'))
+    with open(os.path.join(package_dir, '__init__.py'), 'w') as module_file:
+        module_file.write(country_package_source)
+    with open(os.path.join(package_dir, 'entities.py'), 'w') as module_file:
+        module_file.write(entities_source)
+    with open(os.path.join(package_dir, 'legislation.json'), 'w') as legislation_file:
+        json.dump(legislation_json, legislation_file)
+    with open(os.path.join(package_dir, 'model', '__init__.py'), 'w') as module_file:
+        module_file.write('# -*- coding: utf-8 -*-\n')
+    with open(os.path.join(package_dir, 'model', 'helpers.py'), 'w') as module_file:
+        module_file.write(module_source.encode('utf-8'))
+    sys.path.insert(0, temporary_dir)
+    country_package = importlib.import_module(country_package_name)
+    tax_benefit_system = country_package.init_country()()
+
+
+def teardown_module():
+    sys.path.remove(temporary_dir)
+    for module_name in list(sys.modules):
+        if module_name == country_package_name or module_name.startswith(country_package_name + '.'):
+            del sys.modules[module_name]
+    shutil.rmtree(temporary_dir)
+
+
+def test_helper_using_formula_name():
+    # A helper receiving the formula itself must not reuse, for var_b, the summary of its call by var_a.
+    for keep_modules in (False, True):
+        extractor = input_variables_extractors.setup(tax_benefit_system, keep_modules = keep_modules)
+        for name, expected_input_variables in (
+                ('var_a', set([u'entree', u'var_a'])),
+                ('var_b', set([u'var_b'])),
+                ):
+            input_variables, parameters = extractor.get_input_variables_and_parameters(
+                tax_benefit_system.column_by_name[name])
+            assert extractor.failure is None, (keep_modules, name, extractor.failure)
+            assert input_variables == expected_input_variables, (keep_modules, name, input_variables)
+            assert parameters == set(), (keep_modules, name, parameters)
+
+
+def test_low_memory_release():
+    extractor = input_variables_extractors.setup(tax_benefit_system, keep_modules = True, low_memory = True)
+    input_variables, parameters = extractor.get_input_variables_and_parameters(
+        tax_benefit_system.column_by_name['var_a'])
+    assert extractor.failure is None, extractor.failure
+    assert input_variables == set([u'entree', u'var_a']), input_variables
+
+    # Once the formula is processed, the helper kept by its module only holds the position of its node.
+    helpers_module = extractor.python_module_by_name[country_package_name + '.model.helpers']
+    helper, = [
+        function
+        for function in helpers_module.iter_functions()
+        if function.name == u'valeur_precedente'
+        ]
+    assert isinstance(helper.node, formulas_parsers_2to3.SourceSpan), helper.node
+    # Error messages print the released node, parsed again from its source.
+    assert repr(helper.node).startswith('Node(funcdef, '), repr(helper.node)
+    assert u'def valeur_precedente(formule, simulation, period):' in unicode(helper.node), unicode(helper.node)
+    assert u'period.last_year' in unicode(helper.node), unicode(helper.node)
+
+    # The body of the kept helper is parsed again from its source at its next call.
+    input_variables, parameters = extractor.get_input_variables_and_parameters(
+        tax_benefit_system.column_by_name['var_b'])
+    assert extractor.failure is None, extractor.failure
+    assert input_variables == set([u'var_b']), input_variables
+    assert helper.body_parsed is False
+    assert isinstance(helper.node, formulas_parsers_2to3.SourceSpan), helper.node
+
+
+def test_trusted_mode():
+    # Skipping the structural validation of the wrappers doesn't change the extracted variables.
+    for keep_modules in (False, True):
+        strict_extractor = input_variables_extractors.setup(tax_benefit_system, keep_modules = keep_modules)
+        trusted_extractor = input_variables_extractors.setup(tax_benefit_system, keep_modules = keep_modules,
+            strict = False)
+        assert trusted_extractor.strict is False
+        for name, expected_input_variables, expected_parameters in (
+                ('var_a', set([u'entree', u'var_a']), set()),
+                ('var_b', set([u'var_b']), set()),
+                ('var_c', set([u'entree']), set([u'taux'])),
+                ):
+            column = tax_benefit_system.column_by_name[name]
+            for extractor in (strict_extractor, trusted_extractor):
+                input_variables, parameters = extractor.get_input_variables_and_parameters(column)
+                assert extractor.failure is None, (keep_modules, extractor.strict, name, extractor.failure)
+                assert input_variables == expected_input_variables, (keep_modules, extractor.strict, name,
+                    input_variables)
+                assert parameters == expected_parameters, (keep_modules, extractor.strict, name, parameters)
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+
+
+# OpenFisca -- A versatile microsimulation software
+# By: OpenFisca Team <contact@openfisca.fr>
+#
+# Copyright (C) 2011, 2012, 2013, 2014, 2015 OpenFisca Team
+# https://github.com/openfisca
+#
+# This file is part of OpenFisca.
+#
+# OpenFisca is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# OpenFisca is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Tests of the trie of the parameters used by formulas."""
+
+
+from openfisca_parsers import parameter_tries
+
+
+def test_iter_names():
+    trie = parameter_tries.ParameterTrie.from_names([
+        u'ir.bareme',
+        u'ir',  # Prefix of a parameter: not a parameter itself
+        u'prelevements_sociaux.csg.taux',
+        u'prelevements_sociaux.crds',
+        u'prelevements_sociaux',
+        ])
+    assert list(trie.iter_names()) == [
+        u'ir.bareme',
+        u'prelevements_sociaux.crds',
+        u'prelevements_sociaux.csg.taux',
+        ]
+    assert list(trie.iter_names([u'prelevements_sociaux'])) == [
+        u'prelevements_sociaux.crds',
+        u'prelevements_sociaux.csg.taux',
+        ]
+    assert list(trie.iter_names([u'ir', u'bareme'])) == [u'ir.bareme']
+    assert list(trie.iter_names([u'missing'])) == []
+    assert list(parameter_tries.ParameterTrie().iter_names()) == []
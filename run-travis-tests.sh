@@ -19,3 +19,6 @@ then
         exit 1
     fi
 fi
+
+pip install --editable . nose
+nosetests openfisca_parsers